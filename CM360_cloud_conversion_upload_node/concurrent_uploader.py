@@ -0,0 +1,168 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sends API requests in parallel with an AIMD (additive increase,
+# multiplicative decrease) concurrency limit: every success adds roughly one
+# worker per round trip, a quota error or a 5xx halves the number of workers
+# (once per round trip, not once per failed request) and the request is
+# retried after a backoff, or the Retry-After of the response.
+
+import collections
+import threading
+import time
+
+from concurrent import futures
+
+from googleapiclient import errors
+
+from instrumentation import log
+
+QUOTA_ERROR_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+
+def is_throttling_error(error):
+    """True for 429s, quota related 403s and 5xx responses."""
+    if not isinstance(error, errors.HttpError):
+        return False
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status == 403:
+        content = error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+        return any(reason in content for reason in QUOTA_ERROR_REASONS)
+    return False
+
+
+def retry_after_seconds(error):
+    """The delay-seconds of a Retry-After header, None without one."""
+    try:
+        return max(0.0, float(error.resp.get('retry-after')))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+class ConcurrentUploader(object):
+    """Executes request payloads concurrently under an adaptive limit.
+
+    Args:
+        send(:obj:`callable`): send(payload, http) -> response; http is the
+          thread's own transport (None without http_factory).
+        max_concurrency(:obj:`int`): Upper bound of parallel requests.
+        initial_concurrency(:obj:`int`): Parallel requests at start.
+        max_attempts(:obj:`int`): Attempts per payload on throttling errors.
+        backoff_seconds(:obj:`float`): First retry delay, doubled per attempt.
+        http_factory(:obj:`callable`): Builds a transport per worker thread,
+          httplib2 transports are not thread safe.
+    """
+
+    def __init__(self, send, max_concurrency=8, initial_concurrency=2,
+                 max_attempts=5, backoff_seconds=1.0, http_factory=None):
+        self.send = send
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(min(max(1, initial_concurrency), self.max_concurrency))
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.http_factory = http_factory
+        self.latencies = []
+        self.throttled = 0
+        self.peak_concurrency = 0
+        self._last_decrease = 0.0
+        self._local = threading.local()
+
+    def _execute(self, payload):
+        http = None
+        if self.http_factory:
+            http = getattr(self._local, 'http', None)
+            if http is None:
+                http = self._local.http = self.http_factory()
+        start = time.perf_counter()
+        try:
+            return self.send(payload, http)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def run(self, payloads):
+        """Uploads all payloads.
+
+        Returns:
+          list: one (response, error) tuple per payload, in payload order
+        """
+        results = [None] * len(payloads)
+        pending = collections.deque((index, 1, 0.0) for index in range(len(payloads)))
+        in_flight = {}
+        with futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while pending or in_flight:
+                now = time.monotonic()
+                deferred = collections.deque()
+                while pending and len(in_flight) < int(self.limit):
+                    index, attempt, ready_at = pending.popleft()
+                    if ready_at > now:
+                        deferred.append((index, attempt, ready_at))
+                        continue
+                    future = executor.submit(self._execute, payloads[index])
+                    in_flight[future] = (index, attempt, now)
+                pending.extendleft(reversed(deferred))
+                self.peak_concurrency = max(self.peak_concurrency, len(in_flight))
+                if not in_flight:
+                    time.sleep(max(0.0, min(ready_at for _, _, ready_at in pending) - now))
+                    continue
+                timeout = None
+                if pending and len(in_flight) < int(self.limit):
+                    # a free slot waits for the next retry to be due, a full
+                    # pool only for a request to finish
+                    timeout = max(0.0, min(ready_at for _, _, ready_at in pending) - now)
+                done, _ = futures.wait(in_flight, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    index, attempt, submitted_at = in_flight.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+                        results[index] = (future.result(), None)
+                    elif is_throttling_error(error):
+                        self.throttled += 1
+                        if submitted_at >= self._last_decrease:
+                            # requests sent before the last decrease saw the old limit
+                            self.limit = max(1.0, self.limit / 2)
+                            self._last_decrease = time.monotonic()
+                        if attempt < self.max_attempts:
+                            delay = self.backoff_seconds * 2 ** (attempt - 1)
+                            retry_after = retry_after_seconds(error)
+                            if retry_after is not None:
+                                delay = max(delay, retry_after)
+                            pending.append((index, attempt + 1, time.monotonic() + delay))
+                        else:
+                            results[index] = (None, error)
+                    else:
+                        results[index] = (None, error)
+        return results
+
+    def report(self):
+        log('Concurrent upload stats', upload={
+            'requests': len(self.latencies),
+            'throttled': self.throttled,
+            'peak_concurrency': self.peak_concurrency,
+            'final_concurrency_limit': round(self.limit, 2),
+            'latency_p50_s': round(percentile(self.latencies, 50), 4),
+            'latency_p95_s': round(percentile(self.latencies, 95), 4),
+            'latency_max_s': round(max(self.latencies or [0.0]), 4),
+        })
@@ -17,11 +17,28 @@
 import base64
 import datetime
 import google.auth
-import google.auth.impersonated_credentials
-import json
 import os
 import pytz
-from googleapiclient import discovery
+import time
+
+from concurrent_uploader import ConcurrentUploader
+from instrumentation import export_metrics
+from instrumentation import increment
+from instrumentation import log
+from instrumentation import log_payload
+from instrumentation import observe
+from instrumentation import reset_metrics
+from instrumentation import timer
+from rate_limiter import rate_limiter_from_uri
+from upload_retry import RetryPolicy
+from upload_retry import dead_letter_sink_from_uri
+from upload_retry import read_dead_letters
+from upload_retry import upload_with_retries
+from upload_ledger import ledger_from_uri
+from upload_ledger import row_ledger_key
+from shards import load_shard
+from shards import message_conversions
+from wire_format import decode_message
 
 API_SCOPES = ['https://www.googleapis.com/auth/dfareporting',
               'https://www.googleapis.com/auth/dfatrafficking',
@@ -29,11 +46,94 @@ API_SCOPES = ['https://www.googleapis.com/auth/dfareporting',
               'https://www.googleapis.com/auth/devstorage.read_write']
 CM360_API_NAME = 'dfareporting'
 CM360_API_VERSION = 'v4'
+# Base URL of the API instead of the one of the discovery document, e.g. the
+# local emulator of benchmarks/api_emulator.py (http://host:port/dfareporting/v4/)
+CM360_API_ENDPOINT = os.getenv('CM360_API_ENDPOINT', '')
 PROJECT_TIMEZONE = os.getenv('TIMEZONE')
+# batchinsert requests sent in parallel, adjusted between 1 and the max
+# depending on quota errors
+CM360_MAX_CONCURRENCY = int(os.getenv('CM360_MAX_CONCURRENCY', '8'))
+CM360_INITIAL_CONCURRENCY = int(os.getenv('CM360_INITIAL_CONCURRENCY', '2'))
+CM360_BATCH_SIZE = 100
+# Failed conversions are resent up to RETRY_MAX_ATTEMPTS times, then written
+# to DEAD_LETTER_SINK (file:///path.ndjson or bq://project.dataset.table)
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '4'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '1.0'))
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.5'))
+DEAD_LETTER_SINK = os.getenv('DEAD_LETTER_SINK', '')
+# Accepted conversions are recorded here (sqlite:///path or
+# bq://project.dataset.table) so the delegator does not send them again
+UPLOAD_LEDGER = os.getenv('UPLOAD_LEDGER', '')
+# batchinsert requests per second of all the instances together, taken from
+# the bucket of RATE_LIMITER (memory://, sqlite:///path or redis://host:port/db);
+# set a little under the project quota
+RATE_LIMITER = os.getenv('RATE_LIMITER', '')
+CM360_QPS_LIMIT = float(os.getenv('CM360_QPS_LIMIT', '0'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '1'))
 
-def setup():
+# Tokens are refreshed once they get within this margin of their expiry
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Credentials and API client kept for the lifetime of a warm instance. The
+# client libraries are imported by the functions building them, a cold start
+# only pays for the ones the message needs.
+SERVICE_CACHE = {}
+CLIENT_CACHE_STATS = {'hits': 0, 'misses': 0, 'refreshes': 0, 'auth_seconds': 0.0}
+# BigQuery client of the claim-check delivery, created on first use
+bigquery_client = None
+# Limiter of the API requests, created on first use
+rate_limiter = None
+
+def refresh_if_expiring(credentials):
+    if credentials.valid and credentials.expiry and \
+            credentials.expiry - TOKEN_REFRESH_MARGIN > datetime.datetime.utcnow():
+        return
+    import google.auth.transport.requests
+    start = time.perf_counter()
+    credentials.refresh(google.auth.transport.requests.Request())
+    CLIENT_CACHE_STATS['refreshes'] += 1
+    CLIENT_CACHE_STATS['auth_seconds'] += time.perf_counter() - start
+    observe('auth', time.perf_counter() - start)
+
+def get_credentials():
+    cached = SERVICE_CACHE.get(CM360_API_NAME)
+    if cached:
+        refresh_if_expiring(cached['credentials'])
+        return cached['credentials']
+    start = time.perf_counter()
     credentials, project = google.auth.default(scopes=API_SCOPES)
-    return discovery.build(CM360_API_NAME, CM360_API_VERSION, credentials=credentials)
+    CLIENT_CACHE_STATS['auth_seconds'] += time.perf_counter() - start
+    observe('auth', time.perf_counter() - start)
+    refresh_if_expiring(credentials)
+    return credentials
+
+def setup():
+    cached = SERVICE_CACHE.get(CM360_API_NAME)
+    if cached:
+        CLIENT_CACHE_STATS['hits'] += 1
+        refresh_if_expiring(cached['credentials'])
+        return cached['service']
+    CLIENT_CACHE_STATS['misses'] += 1
+    from googleapiclient import discovery
+    credentials = get_credentials()
+    # built from the discovery document bundled with google-api-python-client
+    service = discovery.build(CM360_API_NAME, CM360_API_VERSION, credentials=credentials,
+                              cache_discovery=False, static_discovery=True,
+                              client_options={'api_endpoint': CM360_API_ENDPOINT} if CM360_API_ENDPOINT else None)
+    SERVICE_CACHE[CM360_API_NAME] = {'credentials': credentials, 'service': service}
+    return service
+
+def get_bigquery_client():
+    global bigquery_client
+    if bigquery_client is None:
+        from google.cloud import bigquery
+        bigquery_client = bigquery.Client()
+    return bigquery_client
+
+def get_rate_limiter():
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = rate_limiter_from_uri(RATE_LIMITER, 'cm360', CM360_QPS_LIMIT, RATE_LIMIT_BURST)
+    return rate_limiter
 
 def today_date():
     tz = pytz.timezone(PROJECT_TIMEZONE)
@@ -45,69 +145,174 @@ def time_now_str():
     return datetime.datetime.now(tz).strftime("%m-%d-%Y, %H:%M:%S")
 
 
-def upload_data(rows, profile_id, fl_configuration_id, fl_activity_id):
-    print('Starting conversions for ' + time_now_str())
-    if not fl_activity_id or not fl_configuration_id:
-        print('Please make sure to provide a value for both floodlightActivityId and floodlightConfigurationId!!')
-        return
-    # Build the API connection
-    service = setup()
-    # upload_log = ''
-    print('Authorization successful')
-    currentrow = 0
-    all_conversions = """{"kind": "dfareporting#conversionsBatchInsertRequest", "conversions": ["""
-    while currentrow < len(rows):
-        for row in rows[currentrow:min(currentrow+100, len(rows))]:
-            conversion = json.dumps({
-                'kind': 'dfareporting#conversion',
-                'gclid': row['conversionVisitExternalClickId'],
-                'floodlightActivityId': fl_activity_id, # (Use short form CM Floodlight Activity Id )
-                'floodlightConfigurationId': fl_configuration_id, # (Can be found in CM UI)
-                'ordinal': row['conversionId'],
-                'timestampMicros': row['conversionTimestampMicros'],
-                'value': row['conversionRevenue'],
-                'quantity': row['conversionQuantity'] if 'conversionQuantity' in row else 1 #(Alternatively, this can be hardcoded to 1)
-            })
-            # print('Conversion: ', conversion) # uncomment if you want to output each conversion
-            all_conversions = all_conversions + conversion + ','
-        all_conversions = all_conversions[:-1] + ']}'
-        payload = json.loads(all_conversions)
-        print(f'CM360 request payload: {payload}')
+def build_conversion(row, fl_configuration_id, fl_activity_id):
+    return {
+        'kind': 'dfareporting#conversion',
+        'gclid': row['conversionVisitExternalClickId'],
+        'floodlightActivityId': fl_activity_id, # (Use short form CM Floodlight Activity Id )
+        'floodlightConfigurationId': fl_configuration_id, # (Can be found in CM UI)
+        'ordinal': row['conversionId'],
+        'timestampMicros': row['conversionTimestampMicros'],
+        'value': row['conversionRevenue'],
+        'quantity': row['conversionQuantity'] if 'conversionQuantity' in row else 1 #(Alternatively, this can be hardcoded to 1)
+    }
+
+
+def log_response(response):
+    # only the failed lines are logged, accepted ones are counted
+    if response['hasFailures']:
+        for line in response['status']:
+            for error in line.get('errors') or []:
+                log('Error in line', 'WARNING', code=error['code'], error=error['message'],
+                    gclid=line['conversion']['gclid'], ordinal=line['conversion']['ordinal'])
+
+
+def failed_conversions(response, conversions):
+    # status lines come back in request order
+    failures = []
+    if response['hasFailures']:
+        for conversion, line in zip(conversions, response['status']):
+            if line.get('errors'):
+                failures.append((conversion, line['errors'][0]))
+    return failures
+
+
+def upload_conversions(conversions, profile_id, service, http_factory):
+    limiter = get_rate_limiter()
+    payloads = []
+    for currentrow in range(0, len(conversions), CM360_BATCH_SIZE):
+        payloads.append({
+            'kind': 'dfareporting#conversionsBatchInsertRequest',
+            'conversions': conversions[currentrow:currentrow + CM360_BATCH_SIZE]
+        })
+
+    def send(payload, http):
+        log_payload('CM360 request payload', payload)
         request = service.conversions().batchinsert(profileId=profile_id, body=payload)
-        print('[{}] - CM360 API Request: '.format(time_now_str()), request)
-        response = request.execute()
-        print('[{}] - CM360 API Response: '.format(time_now_str()), response)
-        if not response['hasFailures']:
-            print('Successfully inserted batch of 100.')
+        if limiter is not None:
+            limiter.acquire()
+        increment('api_calls')
+        with timer('api_call'):
+            response = request.execute(http=http)
+        log_payload('CM360 API response', response)
+        return response
+
+    uploader = ConcurrentUploader(
+        send,
+        max_concurrency=CM360_MAX_CONCURRENCY,
+        initial_concurrency=CM360_INITIAL_CONCURRENCY,
+        http_factory=http_factory)
+    failures = []
+    for payload, (response, error) in zip(payloads, uploader.run(payloads)):
+        if error is not None:
+            log('[{}] - CM360 API Error: {}'.format(time_now_str(), error), 'ERROR')
+            failures.extend((conversion, error) for conversion in payload['conversions'])
         else:
-            status = response['status']
-            for line in status:
-                try:
-                    if line['errors']:
-                        for error in line['errors']:
-                            print('Error in line ' + json.dumps(line['conversion']))
-                            print('\t[%s]: %s' % (error['code'], error['message']))
-                except:
-                    print('Conversion with gclid ' + line['gclid'] + ' inserted.')
-        print('Either finished or found errors.')
-        currentrow += 100
-        all_conversions = """{"kind": "dfareporting#conversionsBatchInsertRequest", "conversions": ["""
+            log_response(response)
+            failures.extend(failed_conversions(response, payload['conversions']))
+    uploader.report()
+    return failures
+
+
+def upload_data(rows, profile_id, fl_configuration_id, fl_activity_id, service=None, conversions=None):
+    log('Starting conversions for ' + time_now_str())
+    if not fl_activity_id or not fl_configuration_id:
+        log('Please make sure to provide a value for both floodlightActivityId and floodlightConfigurationId!!', 'ERROR')
+        return
+    http_factory = None
+    if service is None:
+        # Build the API connection, each upload thread gets its own transport
+        service = setup()
+        credentials = get_credentials()
+        import google_auth_httplib2
+        import httplib2
+        http_factory = lambda: google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    log('Authorization successful')
+    if conversions is None:
+        increment('rows_received', len(rows))
+        with timer('transform'):
+            conversions = [build_conversion(row, fl_configuration_id, fl_activity_id) for row in rows]
+    policy = RetryPolicy(
+        max_attempts=RETRY_MAX_ATTEMPTS,
+        base_delay=RETRY_BASE_DELAY,
+        budget_ratio=RETRY_BUDGET_RATIO)
+    ledger = ledger_from_uri(UPLOAD_LEDGER)
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limiter.reset_stats()
+    on_accepted = None
+    if ledger is not None:
+        on_accepted = lambda accepted: ledger.record(
+            [(conversion['gclid'], conversion['ordinal'], 'cm360') for conversion in accepted])
+    stats = upload_with_retries(
+        conversions,
+        lambda pending: upload_conversions(pending, profile_id, service, http_factory),
+        policy,
+        dead_letter_sink_from_uri(DEAD_LETTER_SINK),
+        'cm360',
+        {
+            'profile_id': profile_id,
+            'floodlight_configuration_id': fl_configuration_id,
+            'floodlight_activity_id': fl_activity_id,
+        },
+        on_accepted=on_accepted)
+    if limiter is not None:
+        stats['rate_limit'] = limiter.report()
+    log('Either finished or found errors.', upload=stats, client_cache=CLIENT_CACHE_STATS)
+    return stats
+
+
+def replay_dead_letters(sink_uri, service=None):
+    """Uploads again the CM360 conversions of a dead-letter sink."""
+    by_context = {}
+    for record in read_dead_letters(sink_uri):
+        if record['destination'] != 'cm360':
+            continue
+        context = record['context']
+        key = (context['profile_id'], context['floodlight_configuration_id'], context['floodlight_activity_id'])
+        by_context.setdefault(key, []).append(record['conversion'])
+    for (profile_id, fl_configuration_id, fl_activity_id), conversions in by_context.items():
+        upload_data(None, profile_id, fl_configuration_id, fl_activity_id,
+                    service=service, conversions=conversions)
+
+
+def read_shard_conversions(shard, cloud_client=None):
+    """Reads the rows of a shard descriptor published by the delegator."""
+    uploaded_keys = None
+    ledger = ledger_from_uri(UPLOAD_LEDGER)
+    if ledger is not None:
+        with timer('ledger_load'):
+            uploaded_keys = ledger.load_index('cm360')
+    with timer('fetch'):
+        conversions, stats = load_shard(
+            cloud_client or get_bigquery_client(), shard, uploaded_keys, lambda row: row_ledger_key(row, 'cm360'),
+            'cm360')
+    for name, value in stats.items():
+        increment(name, value)
+    log('Read shard', shard=shard, **stats)
+    return conversions
 
 
 def main(event, context):
-    print('[{}] - Start CM360 conversion upload'.format(time_now_str()))
-    print(f'EVENT: {event}')
+    reset_metrics()
+    log('[{}] - Start CM360 conversion upload'.format(time_now_str()))
 
     # decode pub/sub payload
-    payload = base64.b64decode(event.get('data')).decode('ascii')
-    json_payload = json.loads(payload)
+    with timer('deserialize'):
+        # columnar or JSON, see wire_format.py
+        json_payload = decode_message(base64.b64decode(event.get('data')), event.get('attributes'))
 
-    print(f'Payload: {json_payload}')
+    log_payload('Payload', json_payload)
     # General required data
-    conversion_data = json_payload['data']['conversions'] if 'conversions' in json_payload['data'] else None
+    conversion_data = message_conversions(json_payload['data'])
     config = json_payload['data']['config'] if 'config' in json_payload['data'] else None
+    if 'shard' in json_payload['data']:
+        # claim-check delivery: the message only says which rows to read
+        conversion_data = read_shard_conversions(json_payload['data']['shard'])
+        if not conversion_data:
+            log('No conversion left to upload in the shard')
 
-    if conversion_data is not None:
+    if conversion_data:
         # CM specific data
         profile_id = config['profile_id'] if 'profile_id' in config else None
 
@@ -122,6 +327,7 @@ def main(event, context):
                 floodlight_configuration_id,
                 floodlight_activity_id)
         else:
-            print('Missing values profile_id, floodlight_activity_id or floodlight_configuration_id. PLease check pub/sub message. Upload aborted!')
-    else:
-        print('No conversion data passed into the function! Please check your workflow for downstream errors')
\ No newline at end of file
+            log('Missing values profile_id, floodlight_activity_id or floodlight_configuration_id. PLease check pub/sub message. Upload aborted!', 'ERROR')
+    elif 'shard' not in json_payload['data']:
+        log('No conversion data passed into the function! Please check your workflow for downstream errors', 'ERROR')
+    export_metrics('cm360', event_id=getattr(context, 'event_id', None))
\ No newline at end of file
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Token bucket shared by every instance calling an API; copied next to both
+# upload nodes (keep the copies identical).
+#
+# Each request takes a token before it is sent. The bucket refills at `rate`
+# tokens per second up to `burst`. A request finding it empty still takes
+# its token, the bucket going below zero, and sleeps until the token is due:
+# one atomic update of the shared state per request, no polling, and the
+# instances together never send faster than `rate`. Backends:
+#   memory://                     the threads of one process
+#   sqlite:///tmp/limiter.db      the processes of one machine, local runs
+#   redis://host:6379/0           Redis (redis package), updated by a script
+# Every request updates the bucket, so the backend has to take the quota's
+# rate of writes to one key: Redis does, a Firestore document (about one
+# write per second, contended transactions aborted) does not.
+
+import sqlite3
+import threading
+import time
+
+from instrumentation import increment
+from instrumentation import observe
+from instrumentation import percentile
+
+# waits kept for the percentiles of report()
+MAX_WAIT_SAMPLES = 10000
+
+
+def take_token(tokens, updated_at, now, rate, burst, cost=1):
+    """Refills a bucket and takes cost tokens from it.
+
+    Returns:
+      tuple: (tokens left, negative when reserved ahead, seconds to wait)
+    """
+    if tokens is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+    tokens -= cost
+    return tokens, (-tokens / rate if tokens < 0 else 0.0)
+
+
+class MemoryBucketStore(object):
+
+    def __init__(self):
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, name, rate, burst, cost=1):
+        with self._lock:
+            now = time.time()
+            tokens, updated_at = self.buckets.get(name, (None, now))
+            tokens, wait = take_token(tokens, updated_at, now, rate, burst, cost)
+            self.buckets[name] = (tokens, now)
+        return wait
+
+
+class SqliteBucketStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limiter ('
+                'name TEXT PRIMARY KEY, tokens REAL, updated_at REAL)')
+
+    def take(self, name, rate, burst, cost=1):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # the write lock is held from the read to the update
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM rate_limiter WHERE name = ?', (name,)).fetchone()
+            now = time.time()
+            tokens, wait = take_token(row[0] if row else None, row[1] if row else now, now, rate, burst, cost)
+            connection.execute('INSERT OR REPLACE INTO rate_limiter VALUES (?, ?, ?)', (name, tokens, now))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        return wait
+
+
+class RedisBucketStore(object):
+    """One hash per bucket, refilled and taken from by a script on the server
+    clock, so the clocks of the instances do not matter."""
+
+    SCRIPT = '''
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = burst
+if state[1] then
+  tokens = math.min(burst, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate)
+end
+tokens = tokens - cost
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+if tokens < 0 then
+  return tostring(-tokens / rate)
+end
+return '0'
+'''
+
+    def __init__(self, url, client=None):
+        self.url = url
+        self.client = client
+        self.script = None
+
+    def take(self, name, rate, burst, cost=1):
+        if self.script is None:
+            if self.client is None:
+                import redis
+                self.client = redis.Redis.from_url(self.url)
+            self.script = self.client.register_script(self.SCRIPT)
+        return float(self.script(keys=[f'rate_limiter:{name}'], args=[rate, burst, cost]))
+
+
+def bucket_store_from_uri(uri):
+    """memory://, sqlite:///path or redis://host:port/db."""
+    if uri.startswith('memory://'):
+        return MemoryBucketStore()
+    if uri.startswith('sqlite://'):
+        return SqliteBucketStore(uri[len('sqlite://'):])
+    if uri.startswith('redis://') or uri.startswith('rediss://'):
+        return RedisBucketStore(uri)
+    raise ValueError(f'Unsupported rate limiter store: {uri}')
+
+
+class RateLimiter(object):
+    """Requests of one API, at most rate per second across all instances.
+
+    Args:
+        store: A bucket store shared by the instances.
+        name(:obj:`str`): Bucket of the API quota, e.g. 'cm360'.
+        rate(:obj:`float`): Requests per second, set a little under the quota.
+        burst(:obj:`float`): Requests that may be sent at once after a pause.
+    """
+
+    def __init__(self, store, name, rate, burst=1.0):
+        self.store = store
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.acquired = 0
+            self.waited = 0
+            self.wait_seconds = 0.0
+            self.waits = []
+            self.started = time.perf_counter()
+
+    def acquire(self, cost=1):
+        """Blocks until the request may be sent, returns the seconds waited."""
+        wait = self.store.take(self.name, self.rate, self.burst, cost)
+        if wait > 0:
+            time.sleep(wait)
+        observe('rate_limit_wait', wait)
+        increment('rate_limit_acquired')
+        with self._lock:
+            self.acquired += 1
+            self.wait_seconds += wait
+            if wait > 0:
+                self.waited += 1
+            if len(self.waits) < MAX_WAIT_SAMPLES:
+                self.waits.append(wait)
+        return wait
+
+    def report(self):
+        """Wait statistics since reset_stats(), and the rate reached."""
+        with self._lock:
+            waits = sorted(self.waits)
+            elapsed = time.perf_counter() - self.started
+            return {
+                'rate': self.rate,
+                'acquired': self.acquired,
+                'waited': self.waited,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'p50_wait_seconds': round(percentile(waits, 0.50) or 0.0, 3),
+                'p95_wait_seconds': round(percentile(waits, 0.95) or 0.0, 3),
+                'max_wait_seconds': round(waits[-1] if waits else 0.0, 3),
+                'requests_per_second': round(self.acquired / elapsed, 2) if elapsed else None,
+            }
+
+
+def rate_limiter_from_uri(uri, name, rate, burst=1.0):
+    """The limiter of an API, None without a store or a rate."""
+    if not uri or not rate:
+        return None
+    return RateLimiter(bucket_store_from_uri(uri), name, rate, burst)
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Ledger of the conversions accepted by CM360/SA360, shared by the delegator
+# and the upload nodes (keep the copies identical).
+#
+# The upload nodes record every accepted conversion, keyed on
+# (gclid, ordinal/conversionId, destination); the delegator loads the keys of
+# its destination and skips rows that were already uploaded. Backends:
+#   sqlite:///tmp/upload_ledger.db       local runs and tests
+#   bq://project.dataset.table           production
+# Keys are kept as signed 64-bit hashes in a sorted array (8 bytes per key),
+# so tens of millions of keys fit in a few hundred MB and a lookup is a
+# binary search.
+
+import array
+import bisect
+import datetime
+import hashlib
+import sqlite3
+
+from instrumentation import log
+
+
+def ledger_key(gclid, ordinal, destination):
+    digest = hashlib.blake2b(
+        f'{gclid}\x1f{ordinal}\x1f{destination}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def row_ledger_key(row, destination):
+    """Key of a transformed table row, as published by the delegator."""
+    return ledger_key(row['conversionVisitExternalClickId'], row['conversionId'], destination)
+
+
+class MembershipIndex(object):
+    """Sorted array of key hashes with binary search lookups."""
+
+    def __init__(self, keys=()):
+        self.keys = array.array('q', sorted(keys))
+
+    @classmethod
+    def from_sorted_bytes(cls, data):
+        index = cls()
+        index.keys.frombytes(data)
+        return index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        position = bisect.bisect_left(self.keys, key)
+        return position < len(self.keys) and self.keys[position] == key
+
+
+class SqliteLedger(object):
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS upload_ledger ('
+                'key_hash INTEGER PRIMARY KEY, gclid TEXT, ordinal TEXT, '
+                'destination TEXT, uploaded_at TEXT)')
+
+    def record(self, entries):
+        uploaded_at = datetime.datetime.utcnow().isoformat()
+        with sqlite3.connect(self.path) as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO upload_ledger VALUES (?, ?, ?, ?, ?)',
+                [(ledger_key(gclid, ordinal, destination), gclid, str(ordinal), destination, uploaded_at)
+                 for gclid, ordinal, destination in entries])
+
+    def load_index(self, destination):
+        with sqlite3.connect(self.path) as connection:
+            cursor = connection.execute(
+                'SELECT key_hash FROM upload_ledger WHERE destination = ? ORDER BY key_hash', (destination,))
+            index = MembershipIndex()
+            index.keys.extend(key_hash for key_hash, in cursor)
+            return index
+
+
+class BigQueryLedger(object):
+
+    SCHEMA = [
+        ('key_hash', 'INT64'),
+        ('gclid', 'STRING'),
+        ('ordinal', 'STRING'),
+        ('destination', 'STRING'),
+        ('uploaded_at', 'TIMESTAMP'),
+    ]
+
+    def __init__(self, table_id, cloud_client=None):
+        self.table_id = table_id
+        self.cloud_client = cloud_client
+
+    def client(self):
+        if self.cloud_client is None:
+            from google.cloud import bigquery
+            self.cloud_client = bigquery.Client()
+        return self.cloud_client
+
+    def record(self, entries):
+        uploaded_at = datetime.datetime.utcnow().isoformat()
+        rows = [{
+            'key_hash': ledger_key(gclid, ordinal, destination),
+            'gclid': gclid,
+            'ordinal': str(ordinal),
+            'destination': destination,
+            'uploaded_at': uploaded_at,
+        } for gclid, ordinal, destination in entries]
+        for start in range(0, len(rows), 10000):
+            insert_errors = self.client().insert_rows_json(self.table_id, rows[start:start + 10000])
+            if insert_errors:
+                log(f'Could not record uploads in {self.table_id}: {insert_errors}', 'ERROR')
+
+    def load_index(self, destination):
+        from google.cloud import bigquery
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('destination', 'STRING', destination)])
+        query = f'SELECT DISTINCT key_hash FROM `{self.table_id}` WHERE destination = @destination'
+        job = self.client().query(query, job_config=job_config)
+        try:
+            import pyarrow.compute as pc
+        except ImportError:
+            # the upload nodes do not ship pyarrow, one python int per key
+            return MembershipIndex(row['key_hash'] for row in job.result())
+        column = job.to_arrow().column('key_hash')
+        # sorted in Arrow and copied as raw int64s, no python int per key
+        keys = pc.take(column, pc.array_sort_indices(column)).combine_chunks()
+        data = keys.buffers()[1].to_pybytes()
+        return MembershipIndex.from_sorted_bytes(data[keys.offset * 8:(keys.offset + len(keys)) * 8])
+
+
+def ledger_from_uri(uri):
+    """sqlite:///path, bq://project.dataset.table or empty for no ledger."""
+    if not uri:
+        return None
+    if uri.startswith('sqlite://'):
+        return SqliteLedger(uri[len('sqlite://'):])
+    if uri.startswith('bq://'):
+        return BigQueryLedger(uri[len('bq://'):])
+    raise ValueError(f'Unsupported upload ledger: {uri}')
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Resubmission of failed conversions and dead-letter sinks, shared by the
+# CM360 and SA360 upload nodes (keep both copies identical).
+#
+# Only the conversions that failed are sent again, after a jittered
+# exponential backoff and within a retry budget. Conversions failing with a
+# permanent error, or still failing when attempts or budget run out, are
+# written to a dead-letter sink:
+#   file:///tmp/dead_letter.ndjson       one JSON record per line
+#   bq://project.dataset.table           BigQuery table, see BIGQUERY_SCHEMA
+# Records keep the API conversion body and its context (profile id, ...) so
+# they can be replayed with read_dead_letters().
+
+import datetime
+import json
+import random
+import time
+
+from googleapiclient import errors
+
+from instrumentation import increment
+from instrumentation import log
+
+RETRYABLE_HTTP_STATUSES = (408, 429, 500, 502, 503, 504)
+QUOTA_ERROR_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+# per conversion error codes worth another attempt, anything else is permanent
+RETRYABLE_CONVERSION_ERROR_CODES = ('INTERNAL', 'UNAVAILABLE', 'DEADLINE_EXCEEDED')
+BIGQUERY_SCHEMA = [
+    ('destination', 'STRING'),
+    ('failed_at', 'TIMESTAMP'),
+    ('attempts', 'INT64'),
+    ('retryable', 'BOOL'),
+    ('error', 'STRING'),
+    ('conversion', 'STRING'),
+    ('context', 'STRING'),
+]
+
+
+def is_retryable(error):
+    """Classifies a request exception or a per conversion API error."""
+    if isinstance(error, errors.HttpError):
+        status = error.resp.status
+        if status in RETRYABLE_HTTP_STATUSES:
+            return True
+        if status == 403:
+            content = error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+            return any(reason in content for reason in QUOTA_ERROR_REASONS)
+        return False
+    if isinstance(error, dict):
+        return error.get('code') in RETRYABLE_CONVERSION_ERROR_CODES
+    # timeouts and connection resets surface as plain OSErrors
+    return isinstance(error, (OSError, TimeoutError))
+
+
+def describe_error(error):
+    if isinstance(error, dict):
+        return f"[{error.get('code')}]: {error.get('message')}"
+    return str(error)
+
+
+class RetryPolicy(object):
+    """Attempts, jittered exponential backoff and a retry budget.
+
+    Args:
+        max_attempts(:obj:`int`): Attempts per conversion, first one included.
+        base_delay(:obj:`float`): Backoff of the first retry in seconds.
+        max_delay(:obj:`float`): Backoff ceiling in seconds.
+        budget_ratio(:obj:`float`): Conversions that may be resent in one
+          upload, as a ratio of the conversions uploaded.
+    """
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=32.0, budget_ratio=0.5, seed=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self._random = random.Random(seed)
+
+    def delay(self, attempt):
+        # "full jitter": uniform between 0 and the exponential backoff
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class NdjsonDeadLetterSink(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        with open(self.path, 'a') as dead_letter_file:
+            for record in records:
+                dead_letter_file.write(json.dumps(record) + '\n')
+
+    def read(self):
+        with open(self.path) as dead_letter_file:
+            return [json.loads(line) for line in dead_letter_file if line.strip()]
+
+
+class BigQueryDeadLetterSink(object):
+
+    def __init__(self, table_id, cloud_client=None):
+        self.table_id = table_id
+        self.cloud_client = cloud_client
+
+    def client(self):
+        if self.cloud_client is None:
+            from google.cloud import bigquery
+            self.cloud_client = bigquery.Client()
+        return self.cloud_client
+
+    def write(self, records):
+        rows = [dict(record, conversion=json.dumps(record['conversion']),
+                     context=json.dumps(record['context'])) for record in records]
+        insert_errors = self.client().insert_rows_json(self.table_id, rows)
+        if insert_errors:
+            log(f'Could not write dead letters to {self.table_id}: {insert_errors}', 'ERROR')
+
+    def read(self):
+        query = f'SELECT * FROM `{self.table_id}`'
+        return [dict(row.items(), conversion=json.loads(row['conversion']), context=json.loads(row['context']))
+                for row in self.client().query(query).result()]
+
+
+def dead_letter_sink_from_uri(uri):
+    """file:///path.ndjson, bq://project.dataset.table or empty for none."""
+    if not uri:
+        return None
+    if uri.startswith('file://'):
+        return NdjsonDeadLetterSink(uri[len('file://'):])
+    if uri.startswith('bq://'):
+        return BigQueryDeadLetterSink(uri[len('bq://'):])
+    raise ValueError(f'Unsupported dead-letter sink: {uri}')
+
+
+def read_dead_letters(uri):
+    """Returns the dead-letter records of a sink, for replay."""
+    return dead_letter_sink_from_uri(uri).read()
+
+
+def upload_with_retries(conversions, upload_round, policy, dead_letter_sink, destination, context,
+                        on_accepted=None):
+    """Uploads conversions, resending only the ones that failed.
+
+    Args:
+        conversions(:obj:`list`): API conversion bodies.
+        upload_round(:obj:`callable`): upload_round(conversions) uploads a
+          list and returns the failures as (conversion, error) tuples, error
+          being an exception or a per conversion API error dict.
+        policy(:obj:`RetryPolicy`): Attempts, backoff and budget.
+        dead_letter_sink: NdjsonDeadLetterSink, BigQueryDeadLetterSink or None.
+        destination(:obj:`str`): 'cm360' or 'sa360', stored with dead letters.
+        context(:obj:`dict`): Request parameters needed to replay.
+        on_accepted(:obj:`callable`): Called with the conversions accepted
+          by each round, e.g. to record them in the upload ledger.
+    The counters conversions_uploaded, conversions_failed (per round),
+    conversions_retried and conversions_dead_lettered are incremented.
+    Returns:
+      dict: uploaded, retried, dead_lettered counts
+    """
+    budget = int(len(conversions) * policy.budget_ratio)
+    stats = {'uploaded': 0, 'retried': 0, 'dead_lettered': 0}
+    pending = conversions
+    attempt = 1
+    while pending:
+        failures = upload_round(pending)
+        stats['uploaded'] += len(pending) - len(failures)
+        increment('conversions_uploaded', len(pending) - len(failures))
+        increment('conversions_failed', len(failures))
+        if on_accepted is not None:
+            failed_ids = set(id(conversion) for conversion, _ in failures)
+            on_accepted([conversion for conversion in pending if id(conversion) not in failed_ids])
+        retry = []
+        dead = []
+        for conversion, error in failures:
+            if is_retryable(error) and attempt < policy.max_attempts and budget > 0:
+                retry.append(conversion)
+                budget -= 1
+            else:
+                dead.append((conversion, error))
+        if dead:
+            stats['dead_lettered'] += len(dead)
+            increment('conversions_dead_lettered', len(dead))
+            failed_at = datetime.datetime.utcnow().isoformat()
+            records = [{
+                'destination': destination,
+                'failed_at': failed_at,
+                'attempts': attempt,
+                'retryable': is_retryable(error),
+                'error': describe_error(error),
+                'conversion': conversion,
+                'context': context,
+            } for conversion, error in dead]
+            if dead_letter_sink is not None:
+                dead_letter_sink.write(records)
+            else:
+                for record in records:
+                    log('Dropped conversion', 'ERROR', dead_letter=record)
+        if retry:
+            delay = policy.delay(attempt)
+            log(f'Resubmitting {len(retry)} failed conversions in {delay:.1f}s (attempt {attempt + 1})', 'WARNING')
+            time.sleep(delay)
+            stats['retried'] += len(retry)
+            increment('conversions_retried', len(retry))
+        pending = retry
+        attempt += 1
+    return stats
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Adaptive request batches for SA360 conversion().insert.
+#
+# The batch size grows toward the per request limit while requests are fast
+# and rarely fail, shrinks when they get slow and halves on throttling. A
+# request rejected because of its size, timing out or rejected whole by one
+# invalid conversion (400) is split in half and both halves are sent again,
+# down to single conversions, so only the offending conversions fail. Splits
+# are bounded per upload so a request failing for every conversion does not
+# turn into one request per conversion.
+
+import collections
+import math
+import time
+
+from googleapiclient import errors
+
+from instrumentation import increment
+from instrumentation import log
+
+QUOTA_ERROR_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+PAYLOAD_SIZE_ERROR_MARKERS = ('too large', 'exceeds the limit', 'too many conversions')
+TIMEOUT_HTTP_STATUSES = (408, 504)
+# weight of the past in the request error rate, about the last 10 requests
+ERROR_RATE_DECAY = 0.9
+
+
+def error_content(error):
+    return error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+
+
+def is_payload_size_error(error):
+    if not isinstance(error, errors.HttpError):
+        return False
+    if error.resp.status == 413:
+        return True
+    return error.resp.status == 400 and any(
+        marker in error_content(error).lower() for marker in PAYLOAD_SIZE_ERROR_MARKERS)
+
+
+def is_timeout_error(error):
+    if isinstance(error, errors.HttpError):
+        return error.resp.status in TIMEOUT_HTTP_STATUSES
+    # socket timeouts of the transport
+    return isinstance(error, TimeoutError)
+
+
+def is_invalid_request_error(error):
+    return isinstance(error, errors.HttpError) and error.resp.status == 400
+
+
+def is_throttling_error(error):
+    """True for 429s, quota related 403s and 5xx responses other than timeouts."""
+    if not isinstance(error, errors.HttpError):
+        return False
+    status = error.resp.status
+    if status == 429 or (status >= 500 and status not in TIMEOUT_HTTP_STATUSES):
+        return True
+    return status == 403 and any(reason in error_content(error) for reason in QUOTA_ERROR_REASONS)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+class AdaptiveBatcher(object):
+    """Uploads conversions in batches of an adaptive size.
+
+    The size is kept between uploads, so a warm instance starts from the
+    size it last settled on. A request rejected for its size also lowers the
+    ceiling of the size below that request for the lifetime of the batcher.
+
+    Args:
+        initial_size(:obj:`int`): Conversions in the first request.
+        max_size(:obj:`int`): Upper bound, the API limit per request.
+        min_size(:obj:`int`): Lower bound of the size; splits still go down
+          to single conversions.
+        target_latency(:obj:`float`): Requests slower than this, in seconds,
+          shrink the size by a quarter instead of growing it.
+        growth(:obj:`float`): Factor applied to the size after a fast request.
+        max_error_rate(:obj:`float`): Recent share of requests throttled,
+          timed out or too large above which the size stops growing; invalid
+          conversions do not count.
+        split_ratio(:obj:`float`): Splits allowed per upload, as a ratio of
+          the conversions uploaded.
+    """
+
+    def __init__(self, initial_size=100, max_size=200, min_size=10, target_latency=5.0,
+                 growth=1.25, max_error_rate=0.1, split_ratio=0.1):
+        self.max_size = max(1, max_size)
+        self.min_size = min(max(1, min_size), self.max_size)
+        self.size_limit = self.max_size
+        self.size = float(min(max(initial_size, self.min_size), self.max_size))
+        self.target_latency = target_latency
+        self.growth = growth
+        self.max_error_rate = max_error_rate
+        self.split_ratio = split_ratio
+        self.error_rate = 0.0
+        self.split_budget = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.sizes = collections.Counter()
+        self.latencies = []
+        self.splits = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    def batch_size(self):
+        return int(self.size)
+
+    def _record(self, failed):
+        self.error_rate = ERROR_RATE_DECAY * self.error_rate + (1 - ERROR_RATE_DECAY) * (1.0 if failed else 0.0)
+
+    def _send(self, batch, send):
+        self.sizes[len(batch)] += 1
+        start = time.perf_counter()
+        try:
+            failures = send(batch)
+        except (errors.HttpError, OSError) as error:
+            self.latencies.append(time.perf_counter() - start)
+            # an invalid conversion says nothing about the health of the API
+            self._record(is_payload_size_error(error) or not is_invalid_request_error(error))
+            return self._on_error(batch, send, error)
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        self._record(False)
+        if latency > self.target_latency:
+            self.size = max(self.min_size, self.size * 0.75)
+        elif self.error_rate <= self.max_error_rate and len(batch) >= self.batch_size():
+            # only full batches tell whether a larger one would be fine
+            self.size = min(self.size_limit, self.size * self.growth)
+        return failures
+
+    def _on_error(self, batch, send, error):
+        if is_payload_size_error(error) or is_timeout_error(error):
+            # the next batches would fail the same way
+            self.size = max(self.min_size, min(self.size, len(batch) // 2))
+            if is_payload_size_error(error):
+                self.size_limit = max(self.min_size, min(self.size_limit, len(batch) - 1))
+        elif is_throttling_error(error):
+            self.size = max(self.min_size, self.size / 2)
+            return [(conversion, error) for conversion in batch]
+        elif not is_invalid_request_error(error):
+            return [(conversion, error) for conversion in batch]
+        if len(batch) < 2 or self.split_budget <= 0:
+            return [(conversion, error) for conversion in batch]
+        self.split_budget -= 1
+        self.splits += 1
+        increment('batch_splits')
+        log(f'Splitting a batch of {len(batch)} conversions in half: {error}', 'WARNING')
+        half = len(batch) // 2
+        return self._send(batch[:half], send) + self._send(batch[half:], send)
+
+    def run(self, conversions, send):
+        """Uploads the conversions.
+
+        Args:
+            conversions(:obj:`list`): API conversion bodies.
+            send(:obj:`callable`): send(batch) makes one request and returns
+              the failed lines as (conversion, error) tuples; request errors
+              are raised.
+        Returns:
+          list: (conversion, error) tuples of the conversions not uploaded
+        """
+        start = time.perf_counter()
+        self.split_budget = math.ceil(len(conversions) * self.split_ratio)
+        failures = []
+        position = 0
+        while position < len(conversions):
+            batch = conversions[position:position + self.batch_size()]
+            position += len(batch)
+            failures.extend(self._send(batch, send))
+        self.seconds += time.perf_counter() - start
+        self.uploaded += len(conversions) - len(failures)
+        self.failed += len(failures)
+        return failures
+
+    def report(self):
+        stats = {
+            'requests': sum(self.sizes.values()),
+            'splits': self.splits,
+            'batch_sizes': dict(sorted(self.sizes.items())),
+            'final_batch_size': self.batch_size(),
+            'batch_size_limit': self.size_limit,
+            'conversions_uploaded': self.uploaded,
+            'conversions_failed': self.failed,
+            'conversions_per_second': round(self.uploaded / self.seconds, 1) if self.seconds else None,
+            'latency_p50_s': round(percentile(self.latencies, 50), 4),
+            'latency_p95_s': round(percentile(self.latencies, 95), 4),
+        }
+        log('Adaptive batch stats', upload=stats)
+        return stats
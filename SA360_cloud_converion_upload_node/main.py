@@ -17,19 +17,30 @@
 import base64
 import datetime
 import google.auth
-import google.auth.impersonated_credentials
-import json
+import os
 import pytz
+import time
 
-from io import StringIO
-
-import google_auth_httplib2
-from googleapiclient import discovery
 from googleapiclient import errors
 
-from google.cloud import bigquery
-from google.cloud import pubsub
-from google.cloud import storage
+from adaptive_batcher import AdaptiveBatcher
+from instrumentation import export_metrics
+from instrumentation import increment
+from instrumentation import log
+from instrumentation import log_payload
+from instrumentation import observe
+from instrumentation import reset_metrics
+from instrumentation import timer
+from rate_limiter import rate_limiter_from_uri
+from upload_retry import RetryPolicy
+from upload_retry import dead_letter_sink_from_uri
+from upload_retry import read_dead_letters
+from upload_retry import upload_with_retries
+from upload_ledger import ledger_from_uri
+from upload_ledger import row_ledger_key
+from shards import load_shard
+from shards import message_conversions
+from wire_format import decode_message
 
 GCS_BUCKET_NAME = 'conversion_upload_log'
 IMPERSONATED_SVC_ACCOUNT = 'your-service-account@your-project-name.iam.gserviceaccount.com'
@@ -39,12 +50,79 @@ API_SCOPES = [
 ]
 SA360_API_NAME = 'doubleclicksearch'
 SA360_API_VERSION = 'v2'
+# Base URL of the API instead of the one of the discovery document, e.g. the
+# local emulator of benchmarks/api_emulator.py (http://host:port/)
+SA360_API_ENDPOINT = os.getenv('SA360_API_ENDPOINT', '')
 # Defaults to America/New_York, please update to 
 # your respective timezone if needed.
 PROJECT_TIMEZONE = 'America/New_York'
+# Conversions per conversion().insert request: the size starts at
+# SA360_BATCH_SIZE and adapts between SA360_MIN_BATCH_SIZE and the API limit
+# SA360_MAX_BATCH_SIZE, shrinking when requests take over SA360_TARGET_LATENCY
+SA360_BATCH_SIZE = int(os.getenv('SA360_BATCH_SIZE', '100'))
+SA360_MIN_BATCH_SIZE = int(os.getenv('SA360_MIN_BATCH_SIZE', '10'))
+SA360_MAX_BATCH_SIZE = int(os.getenv('SA360_MAX_BATCH_SIZE', '200'))
+SA360_TARGET_LATENCY = float(os.getenv('SA360_TARGET_LATENCY', '5.0'))
+# Failed conversions are resent up to RETRY_MAX_ATTEMPTS times, then written
+# to DEAD_LETTER_SINK (file:///path.ndjson or bq://project.dataset.table)
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '4'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '1.0'))
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.5'))
+DEAD_LETTER_SINK = os.getenv('DEAD_LETTER_SINK', '')
+# Accepted conversions are recorded here (sqlite:///path or
+# bq://project.dataset.table) so the delegator does not send them again
+UPLOAD_LEDGER = os.getenv('UPLOAD_LEDGER', '')
+# conversion().insert requests per second of all the instances together,
+# taken from the bucket of RATE_LIMITER (memory://, sqlite:///path or
+# redis://host:port/db); set a little under the project quota
+RATE_LIMITER = os.getenv('RATE_LIMITER', '')
+SA360_QPS_LIMIT = float(os.getenv('SA360_QPS_LIMIT', '0'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '1'))
+
+
+# Impersonated tokens are requested for an hour and refreshed
+# once they get within TOKEN_REFRESH_MARGIN of their expiry.
+TOKEN_LIFETIME = 3600
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Credentials and API client kept for the lifetime of a warm instance. The
+# client libraries are imported by the functions building them, a cold start
+# only pays for the ones the message needs.
+SERVICE_CACHE = {}
+CLIENT_CACHE_STATS = {'hits': 0, 'misses': 0, 'refreshes': 0, 'auth_seconds': 0.0}
+# BigQuery client of the claim-check delivery, created on first use
+bigquery_client = None
+# Limiter of the API requests, created on first use
+rate_limiter = None
+# Batch size learned by earlier uploads of a warm instance
+BATCHER = AdaptiveBatcher(
+    initial_size=SA360_BATCH_SIZE,
+    max_size=SA360_MAX_BATCH_SIZE,
+    min_size=SA360_MIN_BATCH_SIZE,
+    target_latency=SA360_TARGET_LATENCY)
+
+
+def refresh_if_expiring(credentials):
+  if credentials.expiry and credentials.expiry - TOKEN_REFRESH_MARGIN > datetime.datetime.utcnow():
+    return
+  import google.auth.transport.requests
+  start = time.perf_counter()
+  credentials.refresh(google.auth.transport.requests.Request())
+  CLIENT_CACHE_STATS['refreshes'] += 1
+  CLIENT_CACHE_STATS['auth_seconds'] += time.perf_counter() - start
+  observe('auth', time.perf_counter() - start)
 
 
 def setup():
+  cached = SERVICE_CACHE.get(IMPERSONATED_SVC_ACCOUNT)
+  if cached:
+    CLIENT_CACHE_STATS['hits'] += 1
+    refresh_if_expiring(cached['credentials'])
+    return cached['service']
+  CLIENT_CACHE_STATS['misses'] += 1
+  import google.auth.impersonated_credentials
+  import google_auth_httplib2
+  from googleapiclient import discovery
+  start = time.perf_counter()
   source_credentials, project_id = google.auth.default()
 
   target_credentials = google.auth.impersonated_credentials.Credentials(
@@ -52,15 +130,41 @@ def setup():
       target_principal=IMPERSONATED_SVC_ACCOUNT,
       target_scopes=API_SCOPES,
       delegates=[],
-      lifetime=500)
+      lifetime=TOKEN_LIFETIME)
+  CLIENT_CACHE_STATS['auth_seconds'] += time.perf_counter() - start
+  observe('auth', time.perf_counter() - start)
+  refresh_if_expiring(target_credentials)
 
   http = google_auth_httplib2.AuthorizedHttp(target_credentials)
-  # setup API service here
-  return discovery.build(
+  # setup API service here, from the discovery document bundled
+  #   with google-api-python-client (no discovery HTTP call)
+  service = discovery.build(
       SA360_API_NAME,
       SA360_API_VERSION,
       cache_discovery=False,
-      http=http)
+      static_discovery=True,
+      http=http,
+      client_options={'api_endpoint': SA360_API_ENDPOINT} if SA360_API_ENDPOINT else None)
+  SERVICE_CACHE[IMPERSONATED_SVC_ACCOUNT] = {
+      'credentials': target_credentials,
+      'service': service,
+  }
+  return service
+
+
+def get_bigquery_client():
+  global bigquery_client
+  if bigquery_client is None:
+    from google.cloud import bigquery
+    bigquery_client = bigquery.Client()
+  return bigquery_client
+
+
+def get_rate_limiter():
+  global rate_limiter
+  if rate_limiter is None:
+    rate_limiter = rate_limiter_from_uri(RATE_LIMITER, 'sa360', SA360_QPS_LIMIT, RATE_LIMIT_BURST)
+  return rate_limiter
 
 # Unused function but can be utilized to upload logs to Cloud Storage
 def upload_log_blob(data_string, destination_blob_prefix):
@@ -69,6 +173,7 @@ def upload_log_blob(data_string, destination_blob_prefix):
   destination_log_file = '{}_upload_log_{}.txt'.format(destination_blob_prefix,
                                                        today)
 
+  from google.cloud import storage
   storage_client = storage.Client()
   bucket = storage_client.bucket(GCS_BUCKET_NAME)
   blob = bucket.blob(destination_log_file)
@@ -76,7 +181,7 @@ def upload_log_blob(data_string, destination_blob_prefix):
   # blob.upload_from_filename(source_file_name)
   blob.upload_from_string(data_string)
 
-  print('[{}] - Data uploaded to {}.'.format(time_now_str(), destination_log_file))
+  log('[{}] - Data uploaded to {}.'.format(time_now_str(), destination_log_file))
 
 
 def today_date():
@@ -91,69 +196,130 @@ def time_now_str():
 
 
 
-def upload_data(rows):
-    service = setup()
-    upload_log = ''
-    print('Authorization successful')
-    currentrow = 0
-    # For each row, create a conversion object:
-    all_conversions = """{"kind": "doubleclicksearch#conversionList", "conversion": ["""
-    while currentrow < len(rows):
-        for row in rows[currentrow:min(currentrow+100, len(rows))]:
-            conversion = json.dumps({
-                'clickId': row['conversionVisitExternalClickId'],
-                'conversionId': row['conversionId'],
-                'conversionTimestamp': row['conversionTimestampMillis'],
-                'segmentationType': 'FLOODLIGHT',
-                'segmentationName': row['floodlightActivity'],
-                'type': row['conversionType'],
-                'revenueMicros': int(row['conversionRevenue'] * 1000000),
-                'currencyCode': 'USD'
-            })
-            all_conversions = all_conversions + conversion + ','
-        all_conversions = all_conversions[:-1] + ']}'
-        request = service.conversion().insert(body=json.loads(all_conversions))
-        print('[{}] - SA360 API Request: '.format(time_now_str()), request)
-        try:
+def build_conversion(row):
+    return {
+        'clickId': row['conversionVisitExternalClickId'],
+        'conversionId': row['conversionId'],
+        'conversionTimestamp': row['conversionTimestampMillis'],
+        'segmentationType': 'FLOODLIGHT',
+        'segmentationName': row['floodlightActivity'],
+        'type': row['conversionType'],
+        'revenueMicros': int(row['conversionRevenue'] * 1000000),
+        'currencyCode': 'USD'
+    }
+
+
+def insert_conversions(batch, service):
+    body = {'kind': 'doubleclicksearch#conversionList', 'conversion': batch}
+    request = service.conversion().insert(body=body)
+    log_payload('SA360 request payload', body)
+    failures = []
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        increment('api_calls')
+        with timer('api_call'):
             response = request.execute()
-            print('[{}] - SA360 API Response: '.format(time_now_str()), request)
-            if 'hasFailures' not in response:
-                print('Successfully inserted batch of 100.')
-            else:
-                status = response['status']
-                print(status)
-                for line in status:
-                    try:
-                        if line['errors']:
-                            for error in line['errors']:
-                                err_msg = 'Error in line ' + json.dumps(line['conversion'])
-                                print('[Conversion Insert Errors][{}] - {}\n'.format(time_now_str(), err_msg))
-                                print('\t[%s]: %s\n' % (error['code'], error['message']))
-                    except:
-                        print('Conversion with gclid ' + line['gclid'] + ' inserted.')
-        except errors.HttpError as e:
-            print('[Conversion HTTP Errors][{}] - {}\n'.format(time_now_str(), e))
-            # errorlist = json.loads(e.content)['error']['errors']
-            # for error in errorlist:
-            #   print(error['message'])
-        print('Either finished or found errors.')
-        currentrow += 100
-        print(all_conversions)
-        # Reset all_conversions
-        all_conversions = """{"kind": "doubleclicksearch#conversionList", "conversion": ["""
+    except (errors.HttpError, OSError) as e:
+        log('[Conversion HTTP Errors][{}] - {}'.format(time_now_str(), e), 'ERROR', conversions=len(batch))
+        raise
+    log_payload('SA360 API response', response)
+    if 'hasFailures' in response:
+        # only the failed lines are logged, accepted ones are counted
+        for conversion, line in zip(batch, response['status']):
+            if line.get('errors'):
+                for error in line['errors']:
+                    log('[Conversion Insert Errors][{}]'.format(time_now_str()), 'WARNING',
+                        code=error['code'], error=error['message'], click_id=conversion['clickId'],
+                        conversion_id=conversion['conversionId'])
+                failures.append((conversion, line['errors'][0]))
+    return failures
+
+
+def upload_conversions(conversions, service):
+    return BATCHER.run(conversions, lambda batch: insert_conversions(batch, service))
+
+
+def upload_data(rows, service=None, conversions=None):
+    service = service or setup()
+    log('Authorization successful')
+    # For each row, create a conversion object:
+    if conversions is None:
+        increment('rows_received', len(rows))
+        with timer('transform'):
+            conversions = [build_conversion(row) for row in rows]
+    policy = RetryPolicy(
+        max_attempts=RETRY_MAX_ATTEMPTS,
+        base_delay=RETRY_BASE_DELAY,
+        budget_ratio=RETRY_BUDGET_RATIO)
+    ledger = ledger_from_uri(UPLOAD_LEDGER)
+    BATCHER.reset_stats()
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limiter.reset_stats()
+    on_accepted = None
+    if ledger is not None:
+        on_accepted = lambda accepted: ledger.record(
+            [(conversion['clickId'], conversion['conversionId'], 'sa360') for conversion in accepted])
+    stats = upload_with_retries(
+        conversions,
+        lambda pending: upload_conversions(pending, service),
+        policy,
+        dead_letter_sink_from_uri(DEAD_LETTER_SINK),
+        'sa360',
+        {},
+        on_accepted=on_accepted)
+    stats['batching'] = BATCHER.report()
+    if limiter is not None:
+        stats['rate_limit'] = limiter.report()
+    log('Either finished or found errors.', upload=stats, client_cache=CLIENT_CACHE_STATS)
+    return stats
+
+
+def replay_dead_letters(sink_uri, service=None):
+    """Uploads again the SA360 conversions of a dead-letter sink."""
+    conversions = [record['conversion'] for record in read_dead_letters(sink_uri)
+                   if record['destination'] == 'sa360']
+    if conversions:
+        upload_data(None, service=service, conversions=conversions)
+
+
+def read_shard_conversions(shard, cloud_client=None):
+    """Reads the rows of a shard descriptor published by the delegator."""
+    uploaded_keys = None
+    ledger = ledger_from_uri(UPLOAD_LEDGER)
+    if ledger is not None:
+        with timer('ledger_load'):
+            uploaded_keys = ledger.load_index('sa360')
+    with timer('fetch'):
+        conversions, stats = load_shard(
+            cloud_client or get_bigquery_client(), shard, uploaded_keys, lambda row: row_ledger_key(row, 'sa360'),
+            'sa360')
+    for name, value in stats.items():
+        increment(name, value)
+    log('Read shard', shard=shard, **stats)
+    return conversions
 
 
 def main(event, context):
-    print('[{}] Start SA360 conversion upload!'.format(time_now_str()))
-    print('Event: ', event)
-    cloud_client = bigquery.Client()
+    reset_metrics()
+    log('[{}] Start SA360 conversion upload!'.format(time_now_str()))
     # decode pub/sub payload
-    payload = base64.b64decode(event.get('data')).decode('ascii')
-    json_payload = json.loads(payload)
+    with timer('deserialize'):
+        # columnar or JSON, see wire_format.py
+        json_payload = decode_message(base64.b64decode(event.get('data')), event.get('attributes'))
     
-    print('Payload: ', json_payload)
-    conversion_data = json_payload['data']['conversions']
+    log_payload('Payload', json_payload)
+    if 'shard' in json_payload['data']:
+        # claim-check delivery: the message only says which rows to read
+        conversion_data = read_shard_conversions(json_payload['data']['shard'])
+        if not conversion_data:
+            log('No conversion left to upload in the shard')
+    else:
+        conversion_data = message_conversions(json_payload['data'])
     if conversion_data:
         upload_data(conversion_data)
-    else:
-        print('No conversion data passed into the function! Please check your workflow for downstream errors')
\ No newline at end of file
+    elif 'shard' not in json_payload['data']:
+        log('No conversion data passed into the function! Please check your workflow for downstream errors', 'ERROR')
+    export_metrics('sa360', event_id=getattr(context, 'event_id', None))
\ No newline at end of file
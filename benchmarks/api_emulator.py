@@ -0,0 +1,348 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local HTTP emulator of the two upload endpoints:
+#
+#   POST {cm360 endpoint}userprofiles/{profileId}/conversions/batchinsert
+#       dfareporting v4 conversions.batchinsert
+#   POST {sa360 endpoint}doubleclicksearch/v2/conversion
+#       doubleclicksearch v2 conversion.insert
+#
+# The upload code reaches it through CM360_API_ENDPOINT / SA360_API_ENDPOINT
+# (PB_CM360_API_ENDPOINT in the Composer template), passed to discovery.build
+# as client_options. Tokens are not checked. Per API, the emulator applies:
+#
+#   qps            requests per second, above it 429 rateLimitExceeded
+#   daily_quota    requests per day (per run), above it 403 dailyLimitExceeded
+#   latency        'fixed:S', 'uniform:LOW:HIGH', 'lognormal:MEDIAN:SIGMA' or
+#                  'exponential:MEAN' seconds, plus per_row_latency per row
+#   row_failure_rate  rows answered with an error line (hasFailures); sticky
+#                  failures are the same rows on every attempt
+#   burst_every / burst_seconds   burst_seconds of burst_status (503)
+#                  responses ending every burst_every seconds
+#
+# Every request is recorded (GET /_emulator/requests, or appended to
+# record_path as NDJSON); GET /_emulator/stats summarises them per API.
+#
+#   python api_emulator.py --port 8080 --qps 10 --latency lognormal:0.3:0.5 \
+#       --row-failure-rate 0.01 --burst-every 60 --burst-seconds 5
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+
+from http import server
+
+CM360_PATH = re.compile(r'^/dfareporting/v4/userprofiles/(?P<profile_id>[^/]+)/conversions/batchinsert$')
+SA360_PATH = re.compile(r'^/doubleclicksearch/v2/conversion$')
+
+
+def latency_sampler(spec, rng):
+    """A function drawing request latencies in seconds from a spec string."""
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(':')] if params else []
+    if kind == 'fixed':
+        return lambda: values[0] if values else 0.0
+    if kind == 'uniform':
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        # median and sigma of the underlying normal
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1])
+    if kind == 'exponential':
+        return lambda: rng.expovariate(1.0 / values[0])
+    raise ValueError(f'Unknown latency distribution {spec}')
+
+
+def error_body(code, message, reason):
+    return {'error': {'code': code, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+
+
+class ApiState(object):
+    """Quotas and counters of one emulated API."""
+
+    def __init__(self, qps, daily_quota):
+        self.qps = qps
+        self.daily_quota = daily_quota
+        self.window = []
+        self.requests_today = 0
+
+
+class ApiEmulator(object):
+    """CM360 batchinsert and SA360 conversion.insert served over HTTP.
+
+    Args:
+        qps(:obj:`float`): Requests per second of each API, None for no limit.
+        daily_quota(:obj:`int`): Requests of each API before every further
+          one gets a 403 dailyLimitExceeded, None for no limit.
+        latency(:obj:`str`): Latency distribution of a request.
+        per_row_latency(:obj:`float`): Extra seconds per conversion.
+        row_failure_rate(:obj:`float`): Share of the conversions answered
+          with an error line.
+        row_error_code(:obj:`str`): Code of those errors, INVALID_ARGUMENT
+          is permanent for the nodes, INTERNAL is retried.
+        sticky_failures(:obj:`bool`): The failing conversions are picked by
+          their id and fail on every attempt, otherwise at random.
+        burst_every(:obj:`float`): Seconds between the starts of 5xx bursts.
+        burst_seconds(:obj:`float`): Length of a burst.
+        burst_status(:obj:`int`): Status answered during a burst.
+        record_path(:obj:`str`): NDJSON file every request is appended to.
+    """
+
+    def __init__(self, qps=None, daily_quota=None, latency='fixed:0', per_row_latency=0.0,
+                 row_failure_rate=0.0, row_error_code='INVALID_ARGUMENT', sticky_failures=True,
+                 burst_every=None, burst_seconds=0.0, burst_status=503, record_path=None, seed=0):
+        self._random = random.Random(seed)
+        self.latency = latency_sampler(latency, self._random)
+        self.per_row_latency = per_row_latency
+        self.row_failure_rate = row_failure_rate
+        self.row_error_code = row_error_code
+        self.sticky_failures = sticky_failures
+        self.burst_every = burst_every
+        self.burst_seconds = burst_seconds
+        self.burst_status = burst_status
+        self.record_path = record_path
+        self.seed = seed
+        self.apis = {'cm360': ApiState(qps, daily_quota), 'sa360': ApiState(qps, daily_quota)}
+        self.requests = []
+        self.accepted_keys = {'cm360': set(), 'sa360': set()}
+        self.rejected_keys = {'cm360': set(), 'sa360': set()}
+        self.duplicates = {'cm360': 0, 'sa360': 0}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.started = time.monotonic()
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    @property
+    def cm360_endpoint(self):
+        return self.base_url + 'dfareporting/v4/'
+
+    @property
+    def sa360_endpoint(self):
+        return self.base_url
+
+    def start(self, host='127.0.0.1', port=0):
+        emulator = self
+
+        class Handler(RequestHandler):
+            pass
+        Handler.emulator = emulator
+        self._server = server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self.started = time.monotonic()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def in_burst(self):
+        if not self.burst_every:
+            return False
+        # the last burst_seconds of every period, the first one burst_every
+        # seconds after the start
+        return (time.monotonic() - self.started) % self.burst_every >= self.burst_every - self.burst_seconds
+
+    def admit(self, api):
+        """None when the request is within the quotas, else (status, body)."""
+        state = self.apis[api]
+        with self._lock:
+            if state.daily_quota is not None and state.requests_today >= state.daily_quota:
+                return 403, error_body(403, 'Daily limit exceeded', 'dailyLimitExceeded')
+            if state.qps is not None:
+                now = time.monotonic()
+                state.window = [start for start in state.window if now - start < 1.0]
+                if len(state.window) >= state.qps:
+                    return 429, error_body(429, 'Rate limit exceeded', 'rateLimitExceeded')
+                state.window.append(now)
+            state.requests_today += 1
+        return None
+
+    def fails(self, key):
+        if not self.row_failure_rate:
+            return False
+        if self.sticky_failures:
+            return zlib.crc32(f'{self.seed}:{key}'.encode('utf-8')) / 2 ** 32 < self.row_failure_rate
+        with self._lock:
+            return self._random.random() < self.row_failure_rate
+
+    def respond(self, api, conversions, kind):
+        """The hasFailures/status response, recording the accepted conversions."""
+        status = []
+        with self._lock:
+            keys = self.accepted_keys[api]
+        for conversion in conversions:
+            if api == 'cm360':
+                key = (conversion.get('gclid'), conversion.get('ordinal'))
+            else:
+                key = (conversion.get('clickId'), conversion.get('conversionId'))
+            line = {'conversion': conversion}
+            if self.fails(key):
+                line['errors'] = [{'code': self.row_error_code, 'message': 'Injected by the emulator'}]
+                with self._lock:
+                    self.rejected_keys[api].add(key)
+            else:
+                with self._lock:
+                    if key in keys:
+                        self.duplicates[api] += 1
+                    keys.add(key)
+            status.append(line)
+        response = {'kind': kind, 'hasFailures': any('errors' in line for line in status), 'status': status}
+        if api == 'sa360':
+            response['conversion'] = conversions
+        return response
+
+    def handle(self, api, body):
+        """(status, response body, rows, failed rows) of a request."""
+        conversions = body.get('conversions' if api == 'cm360' else 'conversion') or []
+        if self.in_burst():
+            return self.burst_status, error_body(self.burst_status, 'Backend Error', 'backendError'), \
+                len(conversions), 0
+        rejected = self.admit(api)
+        if rejected is not None:
+            return rejected + (len(conversions), 0)
+        time.sleep(self.latency() + self.per_row_latency * len(conversions))
+        kind = 'dfareporting#conversionsBatchInsertResponse' if api == 'cm360' else 'doubleclicksearch#conversionList'
+        response = self.respond(api, conversions, kind)
+        failed = sum(1 for line in response['status'] if 'errors' in line)
+        return 200, response, len(conversions), failed
+
+    def record(self, entry):
+        with self._lock:
+            self.requests.append(entry)
+            if self.record_path:
+                with open(self.record_path, 'a') as record_file:
+                    record_file.write(json.dumps(entry) + '\n')
+
+    def stats(self):
+        """Per API: requests by status, rows accepted and failed, duplicate
+        conversions accepted again and accepted rows per second."""
+        with self._lock:
+            requests = list(self.requests)
+        result = {}
+        for api in self.apis:
+            entries = [entry for entry in requests if entry['api'] == api]
+            statuses = {}
+            for entry in entries:
+                statuses[str(entry['status'])] = statuses.get(str(entry['status']), 0) + 1
+            accepted = sum(entry['rows'] - entry['failed_rows'] for entry in entries if entry['status'] == 200)
+            seconds = max(entry['time'] for entry in entries) - min(entry['time'] for entry in entries) \
+                if entries else 0.0
+            result[api] = {
+                'requests': len(entries),
+                'statuses': statuses,
+                'rows_accepted': accepted,
+                'rows_failed': sum(entry['failed_rows'] for entry in entries),
+                'duplicates': self.duplicates[api],
+                'rows_per_second': round(accepted / seconds, 1) if seconds else None,
+            }
+        return result
+
+
+class RequestHandler(server.BaseHTTPRequestHandler):
+    emulator = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/_emulator/stats':
+            self.send_json(200, self.emulator.stats())
+        elif self.path == '/_emulator/requests':
+            self.send_json(200, self.emulator.requests)
+        else:
+            self.send_json(404, error_body(404, 'Not found', 'notFound'))
+
+    def do_POST(self):
+        start = time.monotonic()
+        path = self.path.split('?', 1)[0]
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        match = CM360_PATH.match(path)
+        api = 'cm360' if match else 'sa360' if SA360_PATH.match(path) else None
+        if api is None:
+            self.send_json(404, error_body(404, f'No emulated method at {path}', 'notFound'))
+            return
+        status, response, rows, failed = self.emulator.handle(api, body)
+        self.send_json(status, response)
+        self.emulator.record({
+            'time': time.time(),
+            'api': api,
+            'path': path,
+            'profile_id': match.group('profile_id') if match else None,
+            'status': status,
+            'rows': rows,
+            'failed_rows': failed,
+            'seconds': round(time.monotonic() - start, 4),
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--qps', type=float)
+    parser.add_argument('--daily-quota', type=int)
+    parser.add_argument('--latency', default='fixed:0.1')
+    parser.add_argument('--per-row-latency', type=float, default=0.0)
+    parser.add_argument('--row-failure-rate', type=float, default=0.0)
+    parser.add_argument('--row-error-code', default='INVALID_ARGUMENT')
+    parser.add_argument('--random-failures', action='store_true', help='not the same rows on every attempt')
+    parser.add_argument('--burst-every', type=float)
+    parser.add_argument('--burst-seconds', type=float, default=0.0)
+    parser.add_argument('--burst-status', type=int, default=503)
+    parser.add_argument('--record', help='NDJSON file recording every request')
+    args = parser.parse_args()
+
+    emulator = ApiEmulator(
+        qps=args.qps, daily_quota=args.daily_quota, latency=args.latency,
+        per_row_latency=args.per_row_latency, row_failure_rate=args.row_failure_rate,
+        row_error_code=args.row_error_code, sticky_failures=not args.random_failures,
+        burst_every=args.burst_every, burst_seconds=args.burst_seconds, burst_status=args.burst_status,
+        record_path=args.record).start(args.host, args.port)
+    print(f'CM360_API_ENDPOINT={emulator.cm360_endpoint}')
+    print(f'SA360_API_ENDPOINT={emulator.sa360_endpoint}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(emulator.stats(), indent=2))
+    finally:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
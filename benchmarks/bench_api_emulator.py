@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# upload_data of the CM360 node, of the SA360 node and of the Composer
+# template over HTTP, through their discovery clients pointed at the local
+# emulator of api_emulator.py: a per-second quota, lognormal latency, a share
+# of the conversions rejected in hasFailures responses and 5xx bursts. Only
+# the credentials are faked. Reports the accepted conversions per second,
+# the responses by status and the conversions lost or uploaded twice. What
+# upload_data reports must match the conversions the emulator accepted.
+#
+#   python bench_api_emulator.py --rows 5000 --qps 20 --burst-every 4 --burst-seconds 0.5
+
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import time
+
+from unittest import mock
+
+from google.oauth2 import credentials
+
+import api_emulator
+import fakes
+
+TABLE = 'business_data.conversion_final'
+CM360_CONFIG = ('1000001', '2000002', '3000003')
+
+
+def fake_credentials(*args, **kwargs):
+    # google.auth credentials (the discovery client wraps them itself) whose
+    # token stays valid for the run, the emulator does not check it
+    return credentials.Credentials(
+        token='emulator', expiry=datetime.datetime.utcnow() + datetime.timedelta(days=1))
+
+
+def upload(label, modules, rows, emulator):
+    node, composer = modules
+    with mock.patch('google.auth.default', lambda *a, **k: (fake_credentials(), 'project')), \
+            mock.patch('google.auth.impersonated_credentials.Credentials', fake_credentials), \
+            contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        if label == 'cm360':
+            node.SERVICE_CACHE.clear()
+            node.CM360_API_ENDPOINT = emulator.cm360_endpoint
+            result = node.upload_data(rows, *CM360_CONFIG)
+        elif label == 'sa360':
+            node.SERVICE_CACHE.clear()
+            node.SA360_API_ENDPOINT = emulator.sa360_endpoint
+            result = node.upload_data(rows)
+        else:
+            composer.PB_SERVICE_CACHE.clear()
+            composer.PB_CM360_API_ENDPOINT = emulator.cm360_endpoint
+            result = composer.upload_data('UTC', rows, *CM360_CONFIG)
+        seconds = time.perf_counter() - start
+    return seconds, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--qps', type=float, default=20)
+    parser.add_argument('--latency', default='lognormal:0.05:0.5')
+    parser.add_argument('--row-failure-rate', type=float, default=0.01)
+    parser.add_argument('--burst-every', type=float, default=4.0)
+    parser.add_argument('--burst-seconds', type=float, default=0.5)
+    parser.add_argument('--retry-base-delay', type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    cm360 = fakes.load_module('CM360_cloud_conversion_upload_node/main.py', 'cm360_main')
+    sa360 = fakes.load_module('SA360_cloud_converion_upload_node/main.py', 'sa360_main')
+    composer = fakes.load_module('composer_flavor/SA360_push_conversion_template.py', 'composer_push')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    for node in (cm360, sa360):
+        node.RETRY_BASE_DELAY = args.retry_base_delay
+    cloud_client = fakes.FakeBigQueryClient({TABLE: fakes.synthetic_transformed_rows(args.rows)})
+    rows = [shards.normalize_row(row) for row in cloud_client.list_rows(TABLE)]
+
+    for label, modules in (('cm360', (cm360, None)), ('sa360', (sa360, None)), ('composer', (None, composer))):
+        emulator = api_emulator.ApiEmulator(
+            qps=args.qps, latency=args.latency, row_failure_rate=args.row_failure_rate,
+            burst_every=args.burst_every, burst_seconds=args.burst_seconds).start()
+        try:
+            seconds, result = upload(label, modules, rows, emulator)
+        finally:
+            emulator.stop()
+        api = 'sa360' if label == 'sa360' else 'cm360'
+        stats = emulator.stats()[api]
+        accepted = len(emulator.accepted_keys[api])
+        rejected = len(emulator.rejected_keys[api] - emulator.accepted_keys[api])
+        # what upload_data reports must match what the emulator accepted
+        assert result['uploaded'] == stats['rows_accepted'], (label, result, stats)
+        if label == 'composer':
+            assert result['uploaded'] + result['failed'] + result['unsent'] == len(rows), (label, result)
+        else:
+            assert result['uploaded'] + result['dead_lettered'] == len(rows), (label, result)
+        statuses = ', '.join(f'{status}: {count}' for status, count in sorted(stats['statuses'].items()))
+        print(f'{label:>8}: {seconds:7.2f}s {accepted / seconds:8.0f} conversions/s, {accepted} accepted, '
+              f'{rejected} rejected, {len(rows) - accepted - rejected} lost to errors, '
+              f'{stats["duplicates"]} accepted twice, '
+              f'{stats["requests"]} requests ({statuses})')
+
+
+if __name__ == '__main__':
+    main()
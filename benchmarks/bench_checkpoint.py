@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Delegator runs longer than the function timeout, through main() with fake
+# clients, for a whole table (rows and Arrow fetch), filtered jobs (query
+# results), the incremental mode and a table published to two destinations:
+#   rerun:   no checkpoints, the invocation is killed at the timeout and the
+#            payload is run again
+#   resume:  a file checkpoint store, every invocation stops at its deadline
+#            and publishes the payload again, until the run is done
+#   killed:  a file checkpoint store, the invocation is killed at the timeout
+#            before its deadline and the payload is run again
+# Every conversion must get published, none twice when resumed and at most
+# about a checkpoint interval of them when killed; reports the invocations,
+# the conversions published twice and the rows/s of an uninterrupted run
+# with and without checkpoints.
+#
+#   python bench_checkpoint.py --rows 100000 --timeout 1.0 --checkpoint-interval 0.2
+
+import argparse
+import base64
+import collections
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+from unittest import mock
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import fakes
+
+DATASET = 'business_data'
+TABLE = 'conversion_final'
+TOPIC = 'sa360_conversion_upload'
+CM360_TOPIC = 'cm360_conversion_upload'
+CM360_CONFIG = {'profile_id': '1000001', 'floodlight_configuration_id': '2000002',
+                'floodlight_activity_id': '3000003'}
+DELEGATOR_TOPIC = 'delegator_trigger'
+ACCOUNTS = ['700000000000002', '700000000000005']
+
+
+def sources(arrow_table):
+    """label -> (payload, FETCH_MODE, (topic, conversion id) expected)"""
+    all_ids = arrow_table.column('conversionId').to_pylist()
+    account_ids = arrow_table.filter(
+        pc.is_in(arrow_table.column('accountId'), value_set=pa.array(ACCOUNTS))).column('conversionId').to_pylist()
+    single = {'dataset_name': DATASET, 'table_name': TABLE, 'topic': TOPIC}
+    destinations = {'dataset_name': DATASET, 'table_name': TABLE, 'destinations': [
+        {'topic': CM360_TOPIC, 'cm360_config': CM360_CONFIG}, {'topic': TOPIC}]}
+    return {
+        'table': (single, 'rows', {(TOPIC, key) for key in all_ids}),
+        'table arrow': (single, 'arrow', {(TOPIC, key) for key in all_ids}),
+        'filtered jobs': (dict(single, jobs=[{'name': account, 'filter': f"accountId = '{account}'"}
+                                             for account in ACCOUNTS]), 'rows',
+                          {(TOPIC, key) for key in account_ids}),
+        'incremental': (dict(single, mode='incremental'), 'rows', {(TOPIC, key) for key in all_ids}),
+        'destinations': (destinations, 'rows', {(topic, key) for topic in (CM360_TOPIC, TOPIC) for key in all_ids}),
+    }
+
+
+def pubsub_event(data):
+    return {'@type': 'type.googleapis.com/google.pubsub.v1.PubsubMessage',
+            'data': base64.b64encode(data).decode('ascii')}
+
+
+def published_ids(shards, publisher_client):
+    ids = collections.Counter()
+    for topic, data, _ in publisher_client.messages:
+        topic = topic.rsplit('/', 1)[-1]
+        if topic != DELEGATOR_TOPIC:
+            ids.update((topic, row['conversionId'])
+                       for row in shards.message_conversions(json.loads(data)['data']))
+    return ids
+
+
+def killing_publish(publish, kill_at, killed):
+    # the function timeout, the invocation dies wherever it is
+    def wrapper(pipeline, *args, **kwargs):
+        if time.perf_counter() >= kill_at:
+            killed.append(kill_at)
+            raise TimeoutError('killed at the function timeout')
+        return publish(pipeline, *args, **kwargs)
+    return wrapper
+
+
+def run(delegator, arrow_table, payload, fetch_mode, scenario, timeout, latency, interval, directory):
+    """Invokes main() until the run is done, returns the publisher and the invocations."""
+    cloud_client = fakes.FakeBigQueryClient({f'{DATASET}.{TABLE}': arrow_table})
+    publisher_client = fakes.FakePublisherClient(latency=latency)
+    checkpoint_store = '' if scenario in ('rerun', 'single') else f'file://{directory}/{scenario}_checkpoints.json'
+    # killed runs only stop at the timeout
+    function_timeout = timeout if scenario == 'resume' else 3600
+    event = payload
+    invocations = 0
+    killed = []
+    while event is not None:
+        seen = len(publisher_client.messages)
+        publish = delegator.PipelinedPublisher.publish
+        if invocations == 0 and scenario in ('rerun', 'killed'):
+            publish = killing_publish(publish, time.perf_counter() + timeout, killed)
+        with mock.patch.object(delegator, 'bigquery_client', cloud_client), \
+                mock.patch.object(delegator, 'publisher', publisher_client), \
+                mock.patch.object(delegator, 'FETCH_MODE', fetch_mode), \
+                mock.patch.object(delegator, 'CHECKPOINT_STORE', checkpoint_store), \
+                mock.patch.object(delegator, 'CHECKPOINT_INTERVAL_SECONDS', interval), \
+                mock.patch.object(delegator, 'CHECKPOINT_MARGIN_SECONDS', 0), \
+                mock.patch.object(delegator, 'FUNCTION_TIMEOUT_SECONDS', function_timeout), \
+                mock.patch.object(delegator, 'DELEGATOR_TOPIC', DELEGATOR_TOPIC), \
+                mock.patch.object(delegator, 'WATERMARK_STORE', f'file://{directory}/{scenario}_watermark.json'), \
+                mock.patch.object(delegator.PipelinedPublisher, 'publish', publish), \
+                contextlib.redirect_stdout(io.StringIO()):
+            try:
+                delegator.main(event, None)
+            except TimeoutError:
+                # single table runs die, a job of a jobs payload is failed
+                pass
+        invocations += 1
+        retriggers = [data for topic, data, _ in publisher_client.messages[seen:]
+                      if topic.endswith('/' + DELEGATOR_TOPIC)]
+        if retriggers:
+            event = pubsub_event(retriggers[-1])
+        elif invocations == 1 and killed:
+            # the scheduler, or an operator, runs the payload again
+            event = payload
+        else:
+            event = None
+    return publisher_client, invocations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--timeout', type=float, default=1.0, help='seconds of an invocation')
+    parser.add_argument('--latency', type=float, default=0.005, help='Pub/Sub publish latency')
+    # a fifth of the invocation, the deployed function saves every second of 540
+    parser.add_argument('--checkpoint-interval', type=float, default=0.2,
+                        help='CHECKPOINT_INTERVAL_SECONDS, the conversions sent twice after a kill grow with it')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    arrow_table = fakes.synthetic_transformed_rows(args.rows, null_ratio=0.0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label, (payload, fetch_mode, expected) in sources(arrow_table).items():
+            rates = {}
+            for checkpoints in (False, True):
+                start = time.perf_counter()
+                scenario = 'single' if not checkpoints else 'uninterrupted'
+                run(delegator, arrow_table, payload, fetch_mode, scenario, None, args.latency,
+                    args.checkpoint_interval, directory)
+                rates[checkpoints] = len(expected) / (time.perf_counter() - start)
+            print(f'{label}: {len(expected)} conversions, uninterrupted run {rates[False]:.0f} rows/s, '
+                  f'{rates[True]:.0f} rows/s with checkpoints')
+            for scenario in ('rerun', 'resume', 'killed'):
+                publisher_client, invocations = run(delegator, arrow_table, payload, fetch_mode, scenario,
+                                                    args.timeout, args.latency, args.checkpoint_interval,
+                                                    directory)
+                ids = published_ids(shards, publisher_client)
+                missing = expected - set(ids)
+                duplicates = sum(count - 1 for count in ids.values())
+                assert not missing, f'{label} {scenario}: {len(missing)} conversions not published'
+                print(f'  {scenario:>7}: {invocations} invocations, {duplicates} conversions published twice')
+                if scenario == 'resume':
+                    assert not duplicates, f'{label}: a resumed run published conversions twice'
+                if scenario == 'killed':
+                    # the messages published since the last save, at most an interval of them (the
+                    # rate of the whole run understates the one of the publish loop), and the
+                    # message in flight of every topic
+                    topics = len({topic for topic, _ in expected})
+                    bound = 2 * rates[True] * args.checkpoint_interval + delegator.MESSAGE_MAX_ROWS * topics
+                    assert duplicates <= bound, \
+                        f'{label}: a killed run published {duplicates} conversions twice, more than {bound:.0f}'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sequential vs concurrent (AIMD) CM360 upload_data against a fake
+# discovery service with request latency and a QPS quota.
+#
+#   python benchmarks/bench_cm360_upload.py --rows 5000 --latency 0.1 --qps 20
+
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import fakes
+
+TABLE = 'dataset.transformed'
+
+
+def run(node, rows, service, max_concurrency):
+    node.CM360_MAX_CONCURRENCY = max_concurrency
+    node.CM360_INITIAL_CONCURRENCY = min(2, max_concurrency)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        node.upload_data(rows, 'profile', 'config', 'activity', service=service)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--qps', type=int, default=20)
+    parser.add_argument('--max-concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'America/New_York')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    node = fakes.load_module('CM360_cloud_conversion_upload_node/main.py', 'cm360_main')
+    cloud_client = fakes.FakeBigQueryClient({TABLE: fakes.synthetic_transformed_rows(args.rows)})
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = [row for batch in delegator.get_data(TABLE, cloud_client, 1000) for row in batch]
+
+    for label, concurrency in (('sequential', 1), ('concurrent', args.max_concurrency)):
+        service = fakes.FakeConversionsService(latency=args.latency, qps=args.qps)
+        elapsed = run(node, rows, service, concurrency)
+        print(f'{label:>10}: {elapsed:8.3f}s {service.accepted / elapsed:10.0f} conversions/s '
+              f'{service.calls} calls, {service.throttled} throttled, {len(rows) - service.accepted} lost')
+        assert service.accepted == len(rows), f'{label}: {len(rows) - service.accepted} conversions not accepted'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cold start of the delegator and of both upload nodes: every run is a fresh
+# interpreter that imports main.py, then the client libraries the first
+# invocation needs in production (the lazy imports), then calls main() once
+# with fake clients. Reports the median of --repeat runs and the heavy
+# modules loaded by the import alone, and exits with an error when a
+# function goes over the budget of cold_start_budget.json (import, first
+# call and total cold start time, modules main.py must not import).
+#
+#   python bench_cold_start.py --repeat 5
+#   python bench_cold_start.py --root /path/to/an/older/checkout --no-budget
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import fakes
+
+BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start_budget.json')
+HEAVY_MODULES = ['google.cloud.bigquery', 'google.cloud.pubsub', 'google.cloud.storage',
+                 'googleapiclient.discovery', 'google.auth.impersonated_credentials',
+                 'google.auth.transport.requests', 'google_auth_httplib2', 'httplib2', 'pyarrow']
+FUNCTIONS = {
+    'delegator': ('converion_upload_delegator', ['google.cloud.bigquery', 'google.cloud.pubsub']),
+    'cm360': ('CM360_cloud_conversion_upload_node',
+              ['googleapiclient.discovery', 'google.auth.transport.requests', 'google_auth_httplib2',
+               'httplib2']),
+    'sa360': ('SA360_cloud_converion_upload_node',
+              ['googleapiclient.discovery', 'google.auth.impersonated_credentials',
+               'google.auth.transport.requests', 'google_auth_httplib2']),
+}
+
+# runs in the folder of the function, prints one JSON line
+CHILD = '''
+import base64, importlib, json, sys, time
+from unittest import mock
+sys.path.insert(0, '.')
+start = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - start
+loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+start = time.perf_counter()
+for name in LAZY_MODULES:
+    importlib.import_module(name)
+lazy_seconds = time.perf_counter() - start
+
+sys.path.insert(0, BENCHMARKS)
+import fakes
+import shards
+table = fakes.synthetic_transformed_rows(ROWS)
+cloud_client = fakes.FakeBigQueryClient({'business_data.conversion_final': table})
+config = {'profile_id': '1000001', 'floodlight_configuration_id': '2000002', 'floodlight_activity_id': '3000003'}
+service = fakes.FakeConversionsService(latency=0.0)
+if FUNCTION == 'delegator':
+    main.publisher = fakes.FakePublisherClient(latency=0.0)
+    event = {'dataset_name': 'business_data', 'table_name': 'conversion_final', 'topic': 'cm360_conversion_upload',
+             'cm360_config': config}
+else:
+    rows = [shards.normalize_row(row) for row in cloud_client.list_rows('business_data.conversion_final')]
+    data = {'conversions': rows}
+    if FUNCTION == 'cm360':
+        data['config'] = config
+        main.SERVICE_CACHE[main.CM360_API_NAME] = {'credentials': fakes.FakeCredentials(), 'service': service}
+    else:
+        main.SERVICE_CACHE[main.IMPERSONATED_SVC_ACCOUNT] = {'credentials': fakes.FakeCredentials(),
+                                                            'service': service}
+    event = {'data': base64.b64encode(json.dumps({'data': data}).encode('utf-8')).decode('ascii')}
+with mock.patch('google.cloud.bigquery.Client', lambda *a, **k: cloud_client), \\
+        mock.patch('sys.stdout', new=open('/dev/null', 'w')):
+    start = time.perf_counter()
+    main.main(event, None)
+    call_seconds = time.perf_counter() - start
+print(json.dumps({'import_ms': import_seconds * 1000, 'lazy_import_ms': lazy_seconds * 1000,
+                  'first_call_ms': call_seconds * 1000, 'loaded': loaded}))
+'''
+
+
+def run_child(root, function, rows):
+    folder, lazy_modules = FUNCTIONS[function]
+    code = (f'HEAVY_MODULES = {HEAVY_MODULES!r}\nLAZY_MODULES = {lazy_modules!r}\n'
+            f'BENCHMARKS = {os.path.dirname(os.path.abspath(__file__))!r}\n'
+            f'FUNCTION = {function!r}\nROWS = {rows}\n' + CHILD)
+    env = dict(os.environ, TIMEZONE=os.environ.get('TIMEZONE', 'UTC'))
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(root, folder), env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def over_budget(function, result, budget):
+    errors = []
+    limits = budget.get(function, {})
+    for key in ('import_ms', 'first_call_ms', 'cold_start_ms'):
+        if key in limits and result[key] > limits[key]:
+            errors.append(f'{function} {key} {result[key]:.1f} over the budget of {limits[key]}')
+    for name in sorted(set(result['loaded']) & set(limits.get('forbidden_modules', []))):
+        errors.append(f'{function} imports {name} at module load')
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=fakes.REPO_ROOT, help='checkout holding the Cloud Functions')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=200, help='conversions of the first invocation')
+    parser.add_argument('--budget', default=BUDGET)
+    parser.add_argument('--no-budget', action='store_true', help='only report')
+    args = parser.parse_args()
+
+    budget = {}
+    if not args.no_budget:
+        with open(args.budget) as budget_file:
+            budget = json.load(budget_file)
+    errors = []
+    for function in FUNCTIONS:
+        runs = [run_child(args.root, function, args.rows) for _ in range(args.repeat)]
+        result = {key: statistics.median(run[key] for run in runs)
+                  for key in ('import_ms', 'lazy_import_ms', 'first_call_ms')}
+        result['cold_start_ms'] = result['import_ms'] + result['lazy_import_ms'] + result['first_call_ms']
+        result['loaded'] = runs[0]['loaded']
+        print(f'{function:>9}: import {result["import_ms"]:7.1f}ms, lazy imports {result["lazy_import_ms"]:7.1f}ms, '
+              f'first call {result["first_call_ms"]:7.1f}ms, cold start {result["cold_start_ms"]:7.1f}ms, '
+              f'heavy modules at import: {", ".join(result["loaded"]) or "none"}')
+        errors.extend(over_budget(function, result, budget))
+    for error in errors:
+        print(f'BUDGET EXCEEDED: {error}')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
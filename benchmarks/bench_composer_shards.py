@@ -0,0 +1,142 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The Composer push_conversion task vs the sharded DAG: plan_shards, the
+# push_conversion_shard tasks run by a pool of --parallelism workers (what
+# max_active_tis_per_dag allows) and summarize_shards. One request fails
+# the first time it is sent, its shard fails and is retried alone, the way
+# Airflow retries a mapped task instance. Both runs must upload the same
+# conversions.
+#
+#   python bench_composer_shards.py --rows 50000 --shard-rows 5000 --parallelism 4
+
+import argparse
+import contextlib
+import io
+import os
+import threading
+import time
+
+from concurrent import futures
+from unittest import mock
+
+import fakes
+
+DATASET = 'business_data'
+TABLE = 'conversion_final'
+
+
+class FlakyService(object):
+    '''Records the ordinals uploaded and fails the first request carrying
+    fail_ordinal.'''
+
+    def __init__(self, service, fail_ordinal=None):
+        self.service = service
+        self.fail_ordinal = fail_ordinal
+        self.ordinals = []
+        self._lock = threading.Lock()
+
+    def conversions(self):
+        return self
+
+    def batchinsert(self, profileId, body):
+        ordinals = [conversion['ordinal'] for conversion in body['conversions']]
+        with self._lock:
+            if self.fail_ordinal in ordinals:
+                self.fail_ordinal = None
+                raise OSError('connection reset')
+            self.ordinals.extend(ordinals)
+        return self.service.batchinsert(profileId, body)
+
+
+def load_composer():
+    composer = fakes.load_module('composer_flavor/SA360_push_conversion_template.py', 'composer_push')
+    # the placeholders install.sh fills in
+    composer.PB_TIMEZONE = os.environ['TIMEZONE']
+    composer.PB_DS_BUSINESS_DATA = DATASET
+    composer.PB_CM360_TABLE = TABLE
+    composer.PB_CM360_PROFILE_ID = '1000001'
+    composer.PB_CM360_FL_CONFIG_ID = '2000002'
+    composer.PB_CM360_FL_ACTIVITY_ID = '3000003'
+    return composer
+
+
+def run(composer, cloud_client, service, body):
+    composer.PB_SERVICE_CACHE[(composer.PB_SA_EMAIL, tuple(composer.PB_API_SCOPES),
+                               composer.PB_CM360_API_NAME, composer.PB_CM360_API_VERSION)] = {
+        'credentials': fakes.FakeCredentials(), 'service': service}
+    with mock.patch.object(composer.bigquery, 'Client', lambda *a, **k: cloud_client), \
+            contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = body()
+        elapsed = time.perf_counter() - start
+    composer.PB_SERVICE_CACHE.clear()
+    return elapsed, result
+
+
+def run_dag(composer, parallelism):
+    """plan >> mapped uploads (one retry per failed shard) >> reduce"""
+    shards = composer.plan_shards()
+    results = {}
+    attempts = 0
+    pending = shards
+    for attempt in range(2):
+        with futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+            outcomes = {index: executor.submit(composer.push_conversion_shard, **kwargs)
+                        for index, kwargs in enumerate(pending)}
+        attempts += len(outcomes)
+        failed = []
+        for index, outcome in outcomes.items():
+            if outcome.exception():
+                failed.append(pending[index])
+            else:
+                results[pending[index]['shard']['start_index']] = outcome.result()
+        pending = failed
+        if not pending:
+            break
+    return composer.summarize_shards(shards, list(results.values())), attempts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--shard-rows', type=int, default=5000)
+    parser.add_argument('--parallelism', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per CM360 request')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    composer = load_composer()
+    composer.PB_SHARD_ROWS = args.shard_rows
+    cloud_client = fakes.FakeBigQueryClient({f'{DATASET}.{TABLE}': fakes.synthetic_transformed_rows(args.rows)})
+    ordinal = cloud_client.get_table(f'{DATASET}.{TABLE}').arrow_table.column('conversionId')[args.rows // 2].as_py()
+
+    task = FlakyService(fakes.FakeConversionsService(latency=args.latency))
+    task_seconds, _ = run(composer, cloud_client, task, composer.push_conversion)
+    dag = FlakyService(fakes.FakeConversionsService(latency=args.latency), fail_ordinal=ordinal)
+    dag_seconds, (summary, attempts) = run(composer, cloud_client, dag, lambda: run_dag(composer, args.parallelism))
+
+    assert set(task.ordinals) == set(dag.ordinals), 'the runs uploaded different conversions'
+    assert summary['failed_shards'] == 0, summary
+    print(f'    task: {task_seconds:8.3f}s {len(task.ordinals) / task_seconds:9.0f} conversions/s, '
+          f'{len(task.ordinals)} uploaded')
+    print(f'     dag: {dag_seconds:8.3f}s {len(set(dag.ordinals)) / dag_seconds:9.0f} conversions/s, '
+          f'{summary["shards"]} shards, {attempts} shard attempts, '
+          f'{len(dag.ordinals) - len(set(dag.ordinals))} conversions sent again by the retried shard')
+
+
+if __name__ == '__main__':
+    main()
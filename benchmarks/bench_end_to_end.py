@@ -0,0 +1,245 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# End to end run of the pipeline against the in-process fakes, per size:
+#
+#   generate   fixture conversions scaled up by synthetic.py
+#   profit     the profit query, through the local profit engine
+#   delegator  main() of the delegator, CM360 and SA360 payloads
+#   cm360      main() of the CM360 node, once per published message
+#   sa360      main() of the SA360 node, once per published message
+#   composer   push_conversion() of the Composer flavor
+#
+# Every stage reports its time, rows/s and peak RSS, plus bytes published and
+# API calls where it applies. --output also writes the results as JSON;
+# --baseline prints the rows/s of every stage against an earlier result file.
+#
+#   python bench_end_to_end.py --rows 10000 100000 --output results.json
+#   python bench_end_to_end.py --rows 10000 100000 --baseline results.json
+
+import argparse
+import base64
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+
+from unittest import mock
+
+import fakes
+import synthetic
+
+DATASET = 'business_data'
+TABLE = 'conversion_final'
+CM360_TOPIC = 'cm360_conversion_upload'
+SA360_TOPIC = 'sa360_conversion_upload'
+CM360_CONFIG = {
+    'profile_id': '1234567',
+    'floodlight_activity_id': '7654321',
+    'floodlight_configuration_id': '1111111',
+}
+
+
+def current_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+class PeakRss(object):
+    '''Samples the resident set size while a stage runs.'''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+@contextlib.contextmanager
+def stage(results, name, rows):
+    '''Times a stage and records rows/s and peak RSS, the body adds its own counters.'''
+    counters = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), PeakRss() as rss:
+        start = time.perf_counter()
+        yield counters
+        seconds = time.perf_counter() - start
+    rows = counters.pop('rows', rows)
+    results[name] = dict({
+        'seconds': round(seconds, 4),
+        'rows': rows,
+        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        'peak_rss_mb': round(rss.peak / 2 ** 20, 1),
+    }, **counters)
+
+
+def pubsub_event(message):
+    return {'data': base64.b64encode(message).decode('ascii')}
+
+
+def cache_service(cache, key, service):
+    cache[key] = {'credentials': fakes.FakeCredentials(), 'service': service}
+
+
+def run_size(modules, fixtures, num_rows, args):
+    delegator, cm360, sa360, composer, profit_gen = modules
+    conversions, campaigns, margins = fixtures
+    results = {}
+
+    with stage(results, 'generate', num_rows):
+        scaled = synthetic.scale_conversions(conversions, margins, num_rows, seed=args.seed)
+    with stage(results, 'profit', num_rows) as counters:
+        profit_rows = profit_gen.generate_profit(scaled, campaigns, margins)
+        table = synthetic.transformed_table(profit_rows)
+        counters['output_rows'] = table.num_rows
+    del scaled, profit_rows
+    cloud_client = fakes.FakeBigQueryClient({f'{DATASET}.{TABLE}': table})
+
+    messages = {}
+    with stage(results, 'delegator', 2 * table.num_rows) as counters:
+        publisher_client = fakes.FakePublisherClient(latency=args.publish_latency)
+        with mock.patch.object(delegator, 'bigquery_client', cloud_client), \
+                mock.patch.object(delegator, 'publisher', publisher_client):
+            for topic, config in ((CM360_TOPIC, CM360_CONFIG), (SA360_TOPIC, None)):
+                event = {'dataset_name': DATASET, 'table_name': TABLE, 'topic': topic}
+                if config:
+                    event['cm360_config'] = config
+                delegator.main(event, None)
+        for topic, data, attributes in publisher_client.messages:
+            messages.setdefault(topic.rsplit('/', 1)[-1], []).append(data)
+        counters['messages'] = len(publisher_client.messages)
+        counters['bytes_published'] = publisher_client.bytes_published
+
+    for name, node, topic, cache_key in (
+            ('cm360', cm360, CM360_TOPIC, cm360.CM360_API_NAME),
+            ('sa360', sa360, SA360_TOPIC, sa360.IMPERSONATED_SVC_ACCOUNT)):
+        service = fakes.FakeConversionsService(latency=args.api_latency)
+        cache_service(node.SERVICE_CACHE, cache_key, service)
+        with stage(results, name, table.num_rows) as counters:
+            for data in messages.get(topic, []):
+                node.main(pubsub_event(data), None)
+            counters['rows'] = service.accepted
+            counters['api_calls'] = service.calls
+        node.SERVICE_CACHE.clear()
+
+    service = fakes.FakeConversionsService(latency=args.api_latency)
+    cache_service(composer.PB_SERVICE_CACHE,
+                  (composer.PB_SA_EMAIL, tuple(composer.PB_API_SCOPES),
+                   composer.PB_CM360_API_NAME, composer.PB_CM360_API_VERSION), service)
+    with stage(results, 'composer', table.num_rows) as counters, \
+            mock.patch.object(composer.bigquery, 'Client', lambda *a, **k: cloud_client):
+        composer.push_conversion()
+        counters['rows'] = service.accepted
+        counters['api_calls'] = service.calls
+    composer.PB_SERVICE_CACHE.clear()
+    return results
+
+
+def load_modules():
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    cm360 = fakes.load_module('CM360_cloud_conversion_upload_node/main.py', 'cm360_main')
+    sa360 = fakes.load_module('SA360_cloud_converion_upload_node/main.py', 'sa360_main')
+    sa360.PROJECT_TIMEZONE = os.environ['TIMEZONE']
+    composer = fakes.load_module('composer_flavor/SA360_push_conversion_template.py', 'composer_push')
+    # the placeholders install.sh fills in
+    composer.PB_TIMEZONE = os.environ['TIMEZONE']
+    composer.PB_DS_BUSINESS_DATA = DATASET
+    composer.PB_CM360_TABLE = TABLE
+    composer.PB_CM360_PROFILE_ID = CM360_CONFIG['profile_id']
+    composer.PB_CM360_FL_CONFIG_ID = CM360_CONFIG['floodlight_configuration_id']
+    composer.PB_CM360_FL_ACTIVITY_ID = CM360_CONFIG['floodlight_activity_id']
+    return delegator, cm360, sa360, composer, synthetic.profit_gen
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=fakes.REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f'\nrows/s against {baseline_path} ({baseline.get("commit")}):')
+    for size, stages in results['sizes'].items():
+        for name, current in stages.items():
+            previous = baseline.get('sizes', {}).get(size, {}).get(name)
+            if previous and previous.get('rows_per_second') and current.get('rows_per_second'):
+                ratio = current['rows_per_second'] / previous['rows_per_second']
+                print(f'{size:>10} {name:<10} {ratio:6.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='conversions to generate, 10000 up to 10000000')
+    parser.add_argument('--api-latency', type=float, default=0.0)
+    parser.add_argument('--publish-latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    modules = load_modules()
+    fixtures = synthetic.load_fixtures()
+    results = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'settings': {'api_latency': args.api_latency, 'publish_latency': args.publish_latency,
+                     'seed': args.seed},
+        'sizes': {},
+    }
+    for num_rows in args.rows:
+        stages = run_size(modules, fixtures, num_rows, args)
+        results['sizes'][str(num_rows)] = stages
+        for name, values in stages.items():
+            extra = ', '.join(f'{key} {value}' for key, value in values.items()
+                              if key not in ('seconds', 'rows', 'rows_per_second', 'peak_rss_mb'))
+            print(f'{num_rows:>10} {name:<10} {values["seconds"]:9.3f}s {values["rows_per_second"] or 0:12,.0f} rows/s '
+                  f'{values["peak_rss_mb"]:8.1f} MB  {extra}')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'Results written to {args.output}')
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The same table published to the CM360 and the SA360 topics by two
+# delegator runs (one payload per destination) and by one run with a
+# "destinations" list, through main(), for the rows and Arrow fetch modes
+# and a filtered job. A share of the CM360 conversions is already in the
+# UPLOAD_LEDGER. Every topic must get the same conversions either way;
+# reports the bytes read from BigQuery, the delegator CPU time and the
+# messages published per destination.
+#
+#   python bench_fan_out.py --rows 50000
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+from unittest import mock
+
+import fakes
+
+DATASET = 'business_data'
+TABLE = 'conversion_final'
+ROW_FILTER = "accountId = '700000000000002'"
+CM360_CONFIG = {'profile_id': '1000001', 'floodlight_configuration_id': '2000002',
+                'floodlight_activity_id': '3000003'}
+DESTINATIONS = [
+    {'name': 'cm360', 'topic': 'cm360_conversion_upload', 'cm360_config': CM360_CONFIG},
+    {'name': 'sa360', 'topic': 'sa360_conversion_upload'},
+]
+
+
+def payloads(fan_out, row_filter):
+    """The payloads of one delegator run each."""
+    base = {'dataset_name': DATASET, 'table_name': TABLE}
+    if fan_out:
+        runs = [dict(base, destinations=DESTINATIONS)]
+    else:
+        runs = [dict(base, topic=destination['topic'], **({'cm360_config': destination['cm360_config']}
+                                                          if 'cm360_config' in destination else {}))
+                for destination in DESTINATIONS]
+    if row_filter:
+        runs = [{'jobs': [dict(payload, name='advertiser', filter=row_filter)]} for payload in runs]
+    return runs
+
+
+def topic_conversions(shards, messages):
+    conversions = collections.defaultdict(list)
+    for topic, data, _ in messages:
+        message = json.loads(data)['data']
+        for row in shards.message_conversions(message):
+            conversions[topic.rsplit('/', 1)[-1]].append(json.dumps([row, message.get('config')], sort_keys=True))
+    return {topic: sorted(values) for topic, values in conversions.items()}
+
+
+def run(delegator, arrow_table, fan_out, row_filter, fetch_mode, ledger_uri):
+    cloud_client = fakes.FakeBigQueryClient({f'{DATASET}.{TABLE}': arrow_table})
+    publisher_client = fakes.FakePublisherClient(latency=0.0)
+    cpu_start = time.process_time()
+    with mock.patch.object(delegator, 'bigquery_client', cloud_client), \
+            mock.patch.object(delegator, 'publisher', publisher_client), \
+            mock.patch.object(delegator, 'FETCH_MODE', fetch_mode), \
+            mock.patch.object(delegator, 'UPLOAD_LEDGER', ledger_uri), \
+            contextlib.redirect_stdout(io.StringIO()):
+        for payload in payloads(fan_out, row_filter):
+            delegator.main(payload, None)
+    cpu_seconds = time.process_time() - cpu_start
+    return cpu_seconds, cloud_client.bytes_read, publisher_client.messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--uploaded-ratio', type=float, default=0.1,
+                        help='share of the CM360 conversions already in the ledger')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    ledger_module = fakes.load_module('converion_upload_delegator/upload_ledger.py', 'upload_ledger')
+    arrow_table = fakes.synthetic_transformed_rows(args.rows)
+    uploaded = arrow_table.slice(0, int(args.rows * args.uploaded_ratio)).to_pylist()
+
+    with tempfile.TemporaryDirectory() as directory:
+        ledger_uri = f'sqlite://{directory}/ledger.db'
+        ledger_module.ledger_from_uri(ledger_uri).record(
+            [(row['conversionVisitExternalClickId'], row['conversionId'], 'cm360') for row in uploaded])
+        for read, row_filter in (('table', None), ('filtered', ROW_FILTER)):
+            for fetch_mode in ('rows', 'arrow'):
+                results = {}
+                for label, fan_out in (('one run per destination', False), ('destinations', True)):
+                    results[label] = run(delegator, arrow_table, fan_out, row_filter, fetch_mode, ledger_uri)
+                conversions = [topic_conversions(shards, messages) for _, _, messages in results.values()]
+                assert conversions[0] == conversions[1], f'{read} {fetch_mode}: the topics got different conversions'
+                for label, (cpu_seconds, bytes_read, messages) in results.items():
+                    per_topic = collections.Counter(topic.rsplit('/', 1)[-1] for topic, _, _ in messages)
+                    print(f'{read:>8} {fetch_mode:>5} {label:>23}: {cpu_seconds:6.2f}s CPU, '
+                          f'{bytes_read / 2 ** 20:7.1f} MB read, messages '
+                          + ', '.join(f'{topic} {count}' for topic, count in sorted(per_topic.items()))
+                          + ', conversions ' + ', '.join(f'{topic} {len(values)}'
+                                                         for topic, values in sorted(conversions[0].items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The flattened_conversions step of the profit query, the former three-way
+# UNNEST cross join vs the zipped UNNEST of the query template and of the
+# Composer stored procedure template, run with DuckDB. The u-variables are
+# extracted with the expressions of the query template from the
+# solution_test conversions, scaled up and with baskets repeated
+# --basket-repeat times, plus duplicated conversions and arrays of uneven
+# lengths. All three must return the same rows. DuckDB plans the cross join
+# as a join on the offsets, BigQuery filters the k^3 combinations of a
+# basket of k items; both counts of unnested rows are reported.
+#
+#   pip install duckdb
+#   python bench_flatten_sql.py --rows 20000 --basket-repeat 1 4 8
+
+import argparse
+import os
+import re
+import time
+
+import duckdb
+import pandas as pd
+
+import fakes
+import synthetic
+from synthetic import profit_gen
+
+QUERY_TEMPLATE = os.path.join(fakes.REPO_ROOT, 'sql_query', 'profit_gen_query_template.sql')
+SP_TEMPLATE = os.path.join(fakes.REPO_ROOT, 'composer_flavor', 'sql', 'profit_gen_sp_template.sql')
+
+# flattened_conversions before the zipped UNNEST
+CROSS_JOIN_FLATTEN = '''
+    SELECT
+        advertiserId,
+        campaignId,
+        conversionId,
+        skuId,
+        pos1,
+        quantity,
+        pos2,
+        cost,
+        pos3
+    FROM expanded_conversions,
+    UNNEST(expanded_conversions.u9) AS skuId WITH OFFSET pos1,
+    UNNEST(expanded_conversions.u10) AS quantity WITH OFFSET pos2,
+    UNNEST(expanded_conversions.u11) AS cost WITH OFFSET pos3
+    WHERE pos1 = pos2 AND pos1 = pos3 AND skuId != ''
+    GROUP BY 1,2,3,4,5,6,7,8,9
+'''
+
+COLUMNS = 'advertiserId, campaignId, conversionId, skuId, pos1, quantity, pos2, cost, pos3'
+
+
+def fill(sql, params):
+    for name, value in params.items():
+        sql = sql.replace(f'<{name}>', value)
+    return sql
+
+
+def query_flatten(params):
+    """The flattened_conversions CTE of the query template."""
+    with open(QUERY_TEMPLATE) as template:
+        sql = fill(template.read(), params)
+    return re.search(r',flattened_conversions AS \((.*?)\n\)\n', sql, re.S).group(1)
+
+
+def sp_flatten(params):
+    """The temp_flattened_conversions statement of the stored procedure."""
+    with open(SP_TEMPLATE) as template:
+        sql = fill(template.read(), params)
+    body = re.search(r'temp_flattened_conversions` AS(.*?);', sql, re.S).group(1)
+    return body.replace('`<business_dataset_name>.temp_expanded_conversions` expanded_conversions',
+                        'expanded_conversions')
+
+
+def expanded_columns(params):
+    """The u-variable expressions of expanded_conversions."""
+    with open(QUERY_TEMPLATE) as template:
+        sql = fill(template.read(), params)
+    return re.findall(r'(SPLIT\(REGEXP_EXTRACT\([^\n]*?\) AS \w+)', sql)
+
+
+def to_duckdb(sql):
+    """Rewrites the BigQuery constructs of the flattening steps for DuckDB."""
+    # BigQuery REGEXP_EXTRACT returns the capture group, NULL without a match
+    sql = re.sub(r'SPLIT\(REGEXP_EXTRACT\((\w+), "([^"]*)"\),"([^"]*)"\)',
+                 r"CASE WHEN regexp_matches(\1, '\2') THEN string_split(regexp_extract(\1, '\2', 1), '\3') END", sql)
+    sql = re.sub(r'UNNEST\(([\w.]+)\) AS (\w+) WITH OFFSET (\w+)',
+                 r'(SELECT UNNEST(\1) AS \2, generate_subscripts(\1, 1) - 1 AS \3)', sql)
+    sql = re.sub(r'UNNEST\(GENERATE_ARRAY\(0, (.*?) - 1\)\) AS (\w+)',
+                 r'(SELECT UNNEST(range(0, \1)) AS \2)', sql, flags=re.S)
+    sql = re.sub(r'\[OFFSET\((\w+)\)\]', r'[\1 + 1]', sql)
+    # DuckDB LEAST skips NULLs, BigQuery returns NULL
+    return sql.replace('LEAST(', 'bq_least(').replace('ARRAY_LENGTH(', 'len(')
+
+
+def build_conversions(conversions, margins, num_rows, basket_repeat):
+    scaled = synthetic.scale_conversions(conversions, margins, num_rows)
+    requests = scaled['floodlightEventRequestString']
+    for var in ('u9', 'u10', 'u11'):
+        values = requests.str.extract(f'{var}=(.*?);', expand=False)
+        requests = requests.str.replace(f'{var}=(.*?);', '', regex=True) + f'{var}=' + (
+            (values + '|') * basket_repeat).str[:-1] + ';'
+    scaled['floodlightEventRequestString'] = ';mykey=myvalue;' + requests.str.replace(';mykey=myvalue;', '')
+    edge_cases = scaled.head(3).copy()
+    edge_cases['floodlightEventRequestString'] = [
+        ';u9=A|B|C;u10=1|2;u11=1.0|2.0|3.0|4.0;',  # uneven arrays, positions 0 and 1 only
+        ';u9=A||C;u10=1|2|3;u11=1.0|2.0|3.0;',  # empty sku
+        ';u9=A|B;u11=1.0|2.0;',  # no u10
+    ]
+    edge_cases['conversionId'] = ['1', '2', '3']
+    # conversions present twice flatten to the same rows
+    frame = pd.concat([scaled, scaled.head(100), edge_cases], ignore_index=True)
+    return frame[['advertiserId', 'campaignId', 'conversionId', 'floodlightEventRequestString']].astype(str)
+
+
+def run(connection, body):
+    start = time.perf_counter()
+    rows = connection.execute(f'SELECT {COLUMNS} FROM ({to_duckdb(body)}) ORDER BY ALL').fetchall()
+    return time.perf_counter() - start, rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--basket-repeat', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    params = profit_gen.DEFAULT_PARAMS
+    conversions, campaigns, margins = synthetic.load_fixtures()
+    variants = (('cross join', CROSS_JOIN_FLATTEN), ('query', query_flatten(params)),
+                ('procedure', sp_flatten(params)))
+
+    for basket_repeat in args.basket_repeat:
+        connection = duckdb.connect()
+        connection.execute('CREATE MACRO bq_least(a, b, c) AS '
+                           'CASE WHEN a IS NULL OR b IS NULL OR c IS NULL THEN NULL ELSE least(a, b, c) END')
+        connection.register('conversions', build_conversions(conversions, margins, args.rows, basket_repeat))
+        connection.execute(f'''CREATE TABLE expanded_conversions AS
+            SELECT *, {to_duckdb(', '.join(expanded_columns(params)))} FROM conversions''')
+        # rows the UNNESTs produce before the WHERE clause
+        items = connection.execute('''SELECT AVG(len(u9)), MAX(len(u9)),
+            SUM(len(u9) * len(u10) * len(u11)), SUM(bq_least(len(u9), len(u10), len(u11)))
+            FROM expanded_conversions''').fetchone()
+        results = {label: run(connection, body) for label, body in variants}
+        expected = results['cross join'][1]
+        for label, (elapsed, rows) in results.items():
+            assert rows == expected, f'{label} returned different rows than the cross join'
+        print(f'basket x{basket_repeat} ({items[0]:.1f} items on average, {items[1]} at most): '
+              f'{len(expected)} rows from {items[2]:,.0f} vs {items[3]:,.0f} unnested, ' + ', '.join(
+                  f'{label} {elapsed:.3f}s' for label, (elapsed, rows) in results.items()) +
+              f', {results["cross join"][0] / results["query"][0]:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the row-wise and the Arrow (columnar) get_data paths of the
+# delegator on a fake BigQuery client and checks both yield the same batches.
+#
+#   python benchmarks/bench_get_data.py --rows 200000
+
+import argparse
+import json
+import os
+import time
+
+import fakes
+
+TABLE = 'dataset.transformed'
+
+
+def run(get_data, cloud_client, batch_size):
+    start = time.perf_counter()
+    batches = list(get_data(TABLE, cloud_client, batch_size))
+    return time.perf_counter() - start, batches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--page-size', type=int, default=20000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'America/New_York')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    cloud_client = fakes.FakeBigQueryClient(
+        {TABLE: fakes.synthetic_transformed_rows(args.rows)}, page_size=args.page_size)
+
+    rows_time, rows_batches = run(delegator.get_data, cloud_client, args.batch_size)
+    arrow_time, arrow_batches = run(delegator.get_data_arrow, cloud_client, args.batch_size)
+
+    assert json.dumps(rows_batches) == json.dumps(arrow_batches), 'Arrow path output differs'
+    emitted = sum(len(batch) for batch in rows_batches)
+    print(f'{args.rows} rows, {emitted} emitted in {len(rows_batches)} batches')
+    print(f'rows : {rows_time:8.3f}s {emitted / rows_time:12.0f} rows/s')
+    print(f'arrow: {arrow_time:8.3f}s {emitted / arrow_time:12.0f} rows/s')
+    print(f'speedup: {rows_time / arrow_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
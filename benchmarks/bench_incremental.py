@@ -0,0 +1,109 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs the incremental delegator mode end to end: rows land in a fake
+# BigQuery table tick after tick (timestamps truncated, to the hour by
+# default, so many rows share one), every tick runs partition_and_distribute with a file
+# watermark store, and publishes can fail. Checks that every row is published
+# and reports duplicates and the per tick load against one daily run.
+#
+#   python benchmarks/bench_incremental.py --rows 50000 --ticks 288 --failure-rate 0.05
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import fakes
+
+TABLE = 'dataset.transformed'
+TOPIC = 'cm360_conversion_upload'
+
+
+def published_keys(shards, messages):
+    keys = []
+    for _, data, _ in messages:
+        for row in shards.message_conversions(json.loads(data)['data']):
+            keys.append((row['conversionVisitExternalClickId'], row['conversionId']))
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--ticks', type=int, default=288, help='runs per day, 288 is every 5 minutes')
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--timestamp-unit', default='hour', help='unit the timestamps are truncated to')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'America/New_York')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    import watermark
+
+    rows = fakes.synthetic_transformed_rows(args.rows, null_ratio=0.0)
+    seconds = pc.floor_temporal(rows.column('conversionTimestamp'), unit=args.timestamp_unit)
+    rows = rows.set_column(rows.schema.get_field_index('conversionTimestamp'), 'conversionTimestamp', seconds)
+    rows = rows.sort_by('conversionTimestamp')
+    # every tick receives the rows of its slice of the time range
+    micros = pc.cast(pc.cast(rows.column('conversionTimestamp'), pa.timestamp('us', 'UTC')), pa.int64())
+    first, last = pc.min(micros).as_py(), pc.max(micros).as_py() + 1
+    bounds = [first + (last - first) * tick // args.ticks for tick in range(args.ticks + 1)]
+
+    cloud_client = fakes.FakeBigQueryClient({TABLE: rows.slice(0, 0)})
+    publisher_client = fakes.FakePublisherClient(latency=0.001, failure_rate=args.failure_rate)
+    tick_messages = []
+    tick_seconds = []
+    with tempfile.TemporaryDirectory() as directory:
+        store = watermark.FileWatermarkStore(os.path.join(directory, 'watermark.json'))
+        # a few extra ticks without new rows drain what failed at the end
+        for tick in range(args.ticks + 5):
+            if tick < args.ticks:
+                arriving = pc.and_(pc.greater_equal(micros, bounds[tick]), pc.less(micros, bounds[tick + 1]))
+                cloud_client.append_rows(TABLE, rows.filter(arriving))
+            before = len(publisher_client.messages)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                delegator.partition_and_distribute(
+                    cloud_client, TABLE, TOPIC, None, publisher_client=publisher_client,
+                    watermark_store=store)
+            tick_seconds.append(time.perf_counter() - start)
+            tick_messages.append(len(publisher_client.messages) - before)
+
+    keys = published_keys(shards, publisher_client.messages)
+    expected = set(zip(rows.column('conversionVisitExternalClickId').to_pylist(),
+                       rows.column('conversionId').to_pylist()))
+    missing = expected - set(keys)
+    daily_client = fakes.FakePublisherClient(latency=0.001)
+    with contextlib.redirect_stdout(io.StringIO()):
+        delegator.partition_and_distribute(cloud_client, TABLE, TOPIC, None, publisher_client=daily_client)
+
+    print(f'{args.rows} rows over {args.ticks} ticks, publish failure rate {args.failure_rate}')
+    print(f'published {len(set(keys))} distinct rows, {len(missing)} missing, '
+          f'{len(keys) - len(set(keys))} duplicates (resent after a failed batch)')
+    print(f'messages per tick: max {max(tick_messages)}, daily run {len(daily_client.messages)}')
+    print(f'seconds per tick: max {max(tick_seconds):.3f}, mean {sum(tick_seconds) / len(tick_seconds):.3f}')
+    assert not missing, 'rows were lost'
+
+
+if __name__ == '__main__':
+    main()
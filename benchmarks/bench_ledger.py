@@ -0,0 +1,53 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Memory and lookup cost of the upload ledger membership index.
+#
+#   python benchmarks/bench_ledger.py --keys 10000000
+
+import argparse
+import random
+import sys
+import time
+
+import fakes
+
+sys.path.insert(0, f'{fakes.REPO_ROOT}/converion_upload_delegator')
+import upload_ledger
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=1000000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    start = time.perf_counter()
+    index = upload_ledger.MembershipIndex(
+        rng.getrandbits(64) - 2 ** 63 for _ in range(args.keys))
+    build_time = time.perf_counter() - start
+    probes = [rng.choice(index.keys) if i % 2 else rng.getrandbits(64) - 2 ** 63
+              for i in range(args.lookups)]
+    start = time.perf_counter()
+    hits = sum(1 for key in probes if key in index)
+    lookup_time = time.perf_counter() - start
+    print(f'{args.keys} keys: {index.keys.itemsize * len(index) / 2 ** 20:.1f} MB, built in {build_time:.2f}s')
+    print(f'{args.lookups} lookups ({hits} hits): {args.lookups / lookup_time:.0f} lookups/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Build time, open time, size and lookup rate of the memory mapped margin
+# index, against loading the margin table into a dict.
+#
+#   python benchmarks/bench_margin_index.py --skus 1000000 --lookups 1000000
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import fakes
+
+sys.path.insert(0, os.path.join(fakes.REPO_ROOT, 'profit_engine'))
+import margin_index
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--skus', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=1000000)
+    parser.add_argument('--distinct-lookups', type=int, default=50000,
+                        help='distinct SKUs among the lookups, baskets repeat SKUs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    skus = pd.Series(np.arange(args.skus)).map('GGOE{:010d}'.format)
+    margins = rng.integers(1, 100, args.skus) / 100.0
+    with tempfile.TemporaryDirectory() as directory:
+        table_path = os.path.join(directory, 'client_profit.csv')
+        pd.DataFrame({'sku': skus, 'profit': margins}).to_csv(table_path, index=False)
+
+        start = time.perf_counter()
+        version = margin_index.build_from_table(table_path, directory)
+        build_seconds = time.perf_counter() - start
+        size = os.path.getsize(margin_index.snapshot_path(directory, version))
+
+        start = time.perf_counter()
+        index = margin_index.open_snapshot(directory)
+        open_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        table = pd.read_csv(table_path, dtype={'sku': str})
+        margin_dict = dict(zip(table['sku'], table['profit']))
+        dict_load_seconds = time.perf_counter() - start
+
+        # a few unknown SKUs among the looked up ones
+        distinct = np.concatenate([
+            skus.sample(args.distinct_lookups, replace=True, random_state=args.seed).to_numpy(),
+            np.array(['UNKNOWN%d' % i for i in range(args.distinct_lookups // 20)], dtype=object)])
+        queries = rng.choice(distinct, args.lookups)
+
+        start = time.perf_counter()
+        found = index.lookup(queries, default=0.0)
+        index_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = np.array([margin_dict.get(sku, 0.0) for sku in queries])
+        dict_seconds = time.perf_counter() - start
+        assert np.array_equal(found, expected), 'index and dict lookups differ'
+
+    print(f'snapshot {version}: {args.skus} SKUs, {size / 2 ** 20:.1f} MiB, built in {build_seconds:.2f}s')
+    print(f'open: index {open_seconds * 1000:.2f} ms, dict from CSV {dict_load_seconds * 1000:.0f} ms')
+    print(f'{args.lookups} lookups: index {args.lookups / index_seconds:,.0f}/s, '
+          f'dict {args.lookups / dict_seconds:,.0f}/s')
+
+
+if __name__ == '__main__':
+    main()
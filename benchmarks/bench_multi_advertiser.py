@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# One delegator run for many advertisers: half of them have a table of
+# their own, the other half share a table and are selected by a filter, and
+# one job points at a missing table. The "jobs" payload is run with one
+# worker and with a pool, every row must be published and the broken job
+# must not stop the others.
+#
+#   python bench_multi_advertiser.py --advertisers 40 --rows 2000 --workers 8
+
+import argparse
+import contextlib
+import io
+import os
+import time
+
+from unittest import mock
+
+import pyarrow as pa
+
+import fakes
+
+DATASET = 'business_data'
+SHARED_TABLE = 'conversion_final_all'
+TOPIC = 'sa360_conversion_upload'
+
+
+def advertiser_rows(advertiser_id, num_rows, seed):
+    table = fakes.synthetic_transformed_rows(num_rows, seed=seed, null_ratio=0)
+    return table.set_column(table.schema.get_field_index('advertiserId'), 'advertiserId',
+                            pa.array([advertiser_id] * num_rows, pa.string()))
+
+
+def build(num_advertisers, num_rows):
+    tables = {}
+    shared = []
+    jobs = []
+    for index in range(num_advertisers):
+        advertiser_id = str(700000000 + index)
+        rows = advertiser_rows(advertiser_id, num_rows, seed=index)
+        if index % 2:
+            shared.append(rows)
+            jobs.append({'name': advertiser_id, 'table_name': SHARED_TABLE,
+                         'filter': f"advertiserId = '{advertiser_id}'"})
+        else:
+            tables[f'{DATASET}.conversion_final_{advertiser_id}'] = rows
+            jobs.append({'name': advertiser_id, 'table_name': f'conversion_final_{advertiser_id}'})
+    tables[f'{DATASET}.{SHARED_TABLE}'] = pa.concat_tables(shared)
+    jobs.append({'name': 'missing', 'table_name': 'conversion_final_missing'})
+    return tables, jobs
+
+
+def run(delegator, tables, jobs, workers, latency):
+    cloud_client = fakes.FakeBigQueryClient(tables)
+    publisher_client = fakes.FakePublisherClient(latency=latency)
+    delegator.DELEGATOR_MAX_WORKERS = workers
+    event = {'dataset_name': DATASET, 'topic': TOPIC, 'jobs': jobs}
+    summaries = []
+    run_jobs = delegator.run_jobs
+    start = time.perf_counter()
+    with mock.patch.object(delegator, 'bigquery_client', cloud_client), \
+            mock.patch.object(delegator, 'publisher', publisher_client), \
+            mock.patch.object(delegator, 'run_jobs', lambda *a, **k: summaries.extend(run_jobs(*a, **k))), \
+            contextlib.redirect_stdout(io.StringIO()):
+        delegator.main(event, None)
+    return time.perf_counter() - start, summaries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--advertisers', type=int, default=40)
+    parser.add_argument('--rows', type=int, default=2000, help='conversions per advertiser')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help='Pub/Sub publish latency')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    tables, jobs = build(args.advertisers, args.rows)
+    expected = args.advertisers * args.rows
+
+    for workers in (1, args.workers):
+        elapsed, summaries = run(delegator, tables, jobs, workers, args.latency)
+        published = sum(summary.get('rows_published', 0) for summary in summaries)
+        statuses = [summary['status'] for summary in summaries]
+        assert published == expected, f'{published} rows published, {expected} expected'
+        assert statuses.count('published') == args.advertisers and statuses[-1] == 'failed', statuses
+        rates = sorted(summary['rows_per_second'] for summary in summaries if 'rows_per_second' in summary)
+        print(f'{workers:>3} worker{"s" if workers > 1 else " "}: {elapsed:8.3f}s {published / elapsed:10.0f} rows/s, '
+              f'per advertiser {rates[0]:.0f} to {rates[-1]:.0f} rows/s, missing table job {statuses[-1]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Daily delegator runs over a backlog the CM360 quota cannot absorb: every
+# day yesterday's conversions land in the table (ordered by account, as the
+# transform query writes it), the delegator runs through main() and the API
+# accepts --quota-ratio of a day's volume, the conversions accepted being
+# recorded in a SQLite UPLOAD_LEDGER for the next run.
+#   table:     rows published in table order, the API takes the first ones
+#   priority:  "schedule": "priority" with "quota_rows" set to the quota
+# Conversions accepted after their lookback deadline count as lost. Reports
+# the conversions and the profit uploaded in time, the conversions that
+# expired on the way and the quota spent per priority tier.
+#
+#   python bench_priority.py --days 10 --daily-rows 5000 --quota-ratio 0.7
+
+import argparse
+import collections
+import contextlib
+import datetime
+import io
+import json
+import os
+import tempfile
+import time
+
+from unittest import mock
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import fakes
+
+DATASET = 'business_data'
+TABLE = 'conversion_final'
+TOPIC = 'cm360_conversion_upload'
+CM360_CONFIG = {'profile_id': '1000001', 'floodlight_activity_id': '3000003',
+                'floodlight_configuration_id': '2000002'}
+DAY_MICROS = 86400 * 1_000_000
+
+
+def conversions(days, daily_rows, start_micros):
+    """Yesterday's conversions of every day, day d landing on the morning of day d."""
+    arrow_table = fakes.synthetic_transformed_rows(days * daily_rows, null_ratio=0.0)
+    arrivals = [index // daily_rows for index in range(arrow_table.num_rows)]
+    micros = [start_micros + (day - 1) * DAY_MICROS + (index * 7919 % DAY_MICROS)
+              for index, day in enumerate(arrivals)]
+    timestamps = pa.array(micros, pa.timestamp('us', tz='UTC'))
+    for name, values in (('conversionTimestamp', timestamps),
+                         ('conversionTimestampMicros', pa.array(micros, pa.int64())),
+                         ('conversionTimestampMillis', pa.array([value // 1000 for value in micros], pa.int64()))):
+        arrow_table = arrow_table.set_column(arrow_table.schema.get_field_index(name), name, values)
+    return arrow_table.append_column('arrivalDay', pa.array(arrivals, pa.int64()))
+
+
+def run(delegator, shards, ledger_module, arrow_table, start_micros, schedule, args, directory):
+    """Runs every day, returns accepted conversions (key -> (value, in time)) and quota per tier."""
+    ledger_uri = f'sqlite://{directory}/{schedule}_ledger.db'
+    ledger = ledger_module.ledger_from_uri(ledger_uri)
+    quota = int(args.daily_rows * args.quota_ratio)
+    accepted = {}
+    tiers = collections.defaultdict(collections.Counter)
+    seconds = 0.0
+    for day in range(args.days):
+        now = (start_micros + day * DAY_MICROS) / 1_000_000 + 6 * 3600
+        landed = arrow_table.filter(pc.less_equal(arrow_table.column('arrivalDay'), day))
+        # the transform query writes the table ORDER BY account
+        landed = landed.sort_by([('account', 'ascending'), ('conversionTimestamp', 'ascending')])
+        cloud_client = fakes.FakeBigQueryClient({f'{DATASET}.{TABLE}': landed.drop(['arrivalDay'])})
+        publisher_client = fakes.FakePublisherClient()
+        schedulers = []
+        scheduler_class = delegator.PriorityScheduler
+
+        def scheduler_factory(*scheduler_args, **kwargs):
+            # the clock of the day
+            schedulers.append(scheduler_class(*scheduler_args, now=now, **kwargs))
+            return schedulers[-1]
+
+        payload = {'dataset_name': DATASET, 'table_name': TABLE, 'topic': TOPIC, 'cm360_config': CM360_CONFIG}
+        if schedule == 'priority':
+            payload.update(schedule='priority', quota_rows=quota)
+        start = time.perf_counter()
+        with mock.patch.object(delegator, 'bigquery_client', cloud_client), \
+                mock.patch.object(delegator, 'publisher', publisher_client), \
+                mock.patch.object(delegator, 'UPLOAD_LEDGER', ledger_uri), \
+                mock.patch.object(delegator, 'PRIORITY_LOOKBACK_DAYS', args.lookback_days), \
+                mock.patch.object(delegator, 'PriorityScheduler', scheduler_factory), \
+                contextlib.redirect_stdout(io.StringIO()):
+            delegator.main(payload, None)
+        seconds += time.perf_counter() - start
+        # the API takes the conversions in the order they are published until its quota is spent
+        taken = []
+        for _, data, _ in publisher_client.messages:
+            taken.extend(shards.message_conversions(json.loads(data)['data']))
+        taken = taken[:quota]
+        ledger.record([(row['conversionVisitExternalClickId'], row['conversionId'], 'cm360') for row in taken])
+        for row in taken:
+            in_time = row['conversionTimestampMicros'] + args.lookback_days * DAY_MICROS > now * 1_000_000
+            accepted[row['conversionId']] = (row['conversionRevenue'], in_time)
+        for scheduler in schedulers:
+            for name in scheduler.names:
+                tiers[name]['published'] += scheduler.scheduled[name]
+                tiers[name]['carried_over'] += scheduler.carried_over[name]
+    return accepted, tiers, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--daily-rows', type=int, default=5000)
+    parser.add_argument('--quota-ratio', type=float, default=0.7, help='share of a day of conversions the API takes')
+    parser.add_argument('--lookback-days', type=float, default=7, help='PRIORITY_LOOKBACK_DAYS')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    ledger_module = fakes.load_module('converion_upload_delegator/upload_ledger.py', 'upload_ledger')
+    # today's table, the stale check of main() compares its date with today
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    start_micros = int(today.timestamp() * 1_000_000) - args.days * DAY_MICROS
+    arrow_table = conversions(args.days, args.daily_rows, start_micros)
+    total_value = sum(arrow_table.column('conversionRevenue').to_pylist())
+
+    with tempfile.TemporaryDirectory() as directory:
+        for schedule in ('table', 'priority'):
+            accepted, tiers, seconds = run(delegator, shards, ledger_module, arrow_table, start_micros,
+                                           schedule, args, directory)
+            in_time = [value for value, on_time in accepted.values() if on_time]
+            late = len(accepted) - len(in_time)
+            # conversions already past their deadline at the last run that were never accepted in time
+            last_now = start_micros + (args.days - 1) * DAY_MICROS + 6 * 3600 * 1_000_000
+            deadlines = zip(arrow_table.column('conversionId').to_pylist(),
+                            arrow_table.column('conversionTimestampMicros').to_pylist())
+            expired = sum(1 for conversion_id, micros in deadlines
+                          if micros + args.lookback_days * DAY_MICROS <= last_now
+                          and not accepted.get(conversion_id, (0, False))[1])
+            print(f'{schedule:>8}: {len(in_time)} conversions uploaded in time, '
+                  f'{sum(in_time):.0f} of {total_value:.0f} profit, {late} quota spent on expired conversions, '
+                  f'{expired} conversions expired, delegator {seconds:.2f}s')
+            for name, counts in tiers.items():
+                if not counts['published'] and not counts['carried_over']:
+                    continue
+                print(f'{"":>10}{name}: {counts["published"]} published, '
+                      f'{counts["carried_over"]} carried over to the next run (summed over the days)')
+
+
+if __name__ == '__main__':
+    main()
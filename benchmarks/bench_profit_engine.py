@@ -0,0 +1,45 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Throughput of the local profit generation engine on synthetic conversions
+# scaled up from the solution_test fixtures.
+#
+#   python benchmarks/bench_profit_engine.py --rows 10000 100000 1000000
+
+import argparse
+import time
+
+import synthetic
+from synthetic import profit_gen
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    args = parser.parse_args()
+
+    conversions, campaigns, margins = synthetic.load_fixtures()
+    for num_rows in args.rows:
+        scaled = synthetic.scale_conversions(conversions, margins, num_rows)
+        start = time.perf_counter()
+        result = profit_gen.generate_profit(scaled, campaigns, margins)
+        elapsed = time.perf_counter() - start
+        print(f'{num_rows:>10} conversions -> {len(result):>10} rows in {elapsed:7.2f}s '
+              f'({num_rows / elapsed:,.0f} conversions/s)')
+
+
+if __name__ == '__main__':
+    main()
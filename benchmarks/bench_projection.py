@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Every column of the transformed table published as row objects vs the
+# columns each destination declares (DESTINATION_FIELDS) published as
+# compact records, for the CM360 and the SA360 topics, reading the whole
+# table (list_rows) and a filtered job (query). Reports the bytes read from
+# BigQuery, the bytes published and the memory held by the rows of
+# get_data, per 100k rows. The conversions the nodes build from the
+# messages must be the same.
+#
+#   python bench_projection.py --rows 50000
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+import tracemalloc
+
+from unittest import mock
+
+import fakes
+
+TABLE = 'business_data.conversion_final'
+ROW_FILTER = "advertiserId = '43939335402485897'"
+CM360_CONFIG = {'profile_id': '1000001', 'floodlight_configuration_id': '2000002',
+                'floodlight_activity_id': '3000003'}
+DESTINATIONS = (('cm360', 'cm360_conversion_upload', CM360_CONFIG),
+                ('sa360', 'sa360_conversion_upload', None))
+
+
+def built_conversions(node, destination, shards, messages):
+    conversions = []
+    for _, data, _ in messages:
+        for row in shards.message_conversions(json.loads(data)['data']):
+            if destination == 'cm360':
+                conversion = node.build_conversion(row, CM360_CONFIG['floodlight_configuration_id'],
+                                                   CM360_CONFIG['floodlight_activity_id'])
+            else:
+                conversion = node.build_conversion(row)
+            conversions.append(json.dumps(conversion, sort_keys=True))
+    return sorted(conversions)
+
+
+def held_bytes(delegator, cloud_client, destination):
+    """Memory held by the rows get_data returns for the whole table."""
+    table = cloud_client.get_table(TABLE)
+    tracemalloc.start()
+    batches = list(delegator.get_data(TABLE, cloud_client, 1000, destination=destination,
+                                      selected_fields=delegator.destination_fields(table, destination)))
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del batches
+    return held
+
+
+def run(delegator, arrow_table, destination, topic, config, row_filter):
+    cloud_client = fakes.FakeBigQueryClient({TABLE: arrow_table})
+    publisher_client = fakes.FakePublisherClient(latency=0.0)
+    start = time.perf_counter()
+    result = delegator.publish_table(cloud_client, TABLE, topic, config, publisher_client, row_filter=row_filter)
+    seconds = time.perf_counter() - start
+    bytes_read = cloud_client.bytes_read
+    return {
+        'seconds': seconds,
+        'rows': result['rows_published'],
+        'bytes_read': bytes_read,
+        'bytes_published': publisher_client.bytes_published,
+        'held': held_bytes(delegator, cloud_client, destination),
+        'messages': publisher_client.messages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    nodes = {'cm360': fakes.load_module('CM360_cloud_conversion_upload_node/main.py', 'cm360_main'),
+             'sa360': fakes.load_module('SA360_cloud_converion_upload_node/main.py', 'sa360_main')}
+    arrow_table = fakes.synthetic_transformed_rows(args.rows)
+    per_100k = 100000 / args.rows
+
+    for destination, topic, config in DESTINATIONS:
+        for read, row_filter in (('table', None), ('filtered', ROW_FILTER)):
+            results = {}
+            # the former behaviour: every column, one object per row
+            with mock.patch.object(delegator, 'destination_fields', lambda table, destination: None), \
+                    mock.patch.object(delegator, 'MESSAGE_FORMAT', 'dicts'), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                results['all columns'] = run(delegator, arrow_table, destination, topic, config, row_filter)
+            with mock.patch.object(delegator, 'MESSAGE_FORMAT', 'records'), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                results['projected'] = run(delegator, arrow_table, destination, topic, config, row_filter)
+            conversions = [built_conversions(nodes[destination], destination, shards, result['messages'])
+                           for result in results.values()]
+            assert conversions[0] == conversions[1], 'the nodes would upload different conversions'
+            for label, result in results.items():
+                print(f'{destination} {read:>8} {label:>11}: {result["seconds"]:6.2f}s, per 100k rows '
+                      f'{result["bytes_read"] * per_100k / 2 ** 20:7.1f} MB read, '
+                      f'{result["bytes_published"] * per_100k / 2 ** 20:7.1f} MB published, '
+                      f'{result["held"] * per_100k / 2 ** 20:7.1f} MB held, {result["rows"]} rows')
+
+
+if __name__ == '__main__':
+    main()
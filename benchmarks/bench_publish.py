@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares blocking publish() calls with the pipelined publisher of the
+# delegator against a fake PublisherClient that injects latency.
+#
+#   python benchmarks/bench_publish.py --rows 50000 --latency 0.05
+
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import fakes
+
+TABLE = 'dataset.transformed'
+TOPIC = 'cm360_conversion_upload'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'America/New_York')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    cloud_client = fakes.FakeBigQueryClient({TABLE: fakes.synthetic_transformed_rows(args.rows)})
+
+    blocking_client = fakes.FakePublisherClient(args.latency, args.failure_rate)
+    delegator.publisher = blocking_client
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for batch in delegator.get_data(TABLE, cloud_client, 1000):
+            delegator.publish(batch, TOPIC, None)
+    blocking_time = time.perf_counter() - start
+
+    pipelined_client = fakes.FakePublisherClient(args.latency, args.failure_rate)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        published, failed = delegator.partition_and_distribute(
+            cloud_client, TABLE, TOPIC, None, publisher_client=pipelined_client)
+    pipelined_time = time.perf_counter() - start
+
+    print(f'blocking : {blocking_time:8.3f}s {len(blocking_client.messages)} messages')
+    print(f'pipelined: {pipelined_time:8.3f}s {len(published)} published, {len(failed)} failed')
+    print(f'speedup: {blocking_time / pipelined_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Several instances of the CM360 and of the SA360 node, one process each,
+# uploading their own messages at the same time to the local emulator of
+# api_emulator.py and its per-second quota: without a limiter, and sharing a
+# SQLite token bucket set a little under the quota (RATE_LIMITER,
+# CM360_QPS_LIMIT/SA360_QPS_LIMIT). Reports the conversions accepted per
+# second, the 429 responses, the conversions lost to errors and the time
+# the instances waited for their tokens.
+#
+#   python bench_rate_limiter.py --instances 4 --rows 4000 --qps 20
+
+import argparse
+import contextlib
+import datetime
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+
+from unittest import mock
+
+import api_emulator
+import fakes
+
+TABLE = 'business_data.conversion_final'
+CM360_CONFIG = ('1000001', '2000002', '3000003')
+NODES = {
+    'cm360': ('CM360_cloud_conversion_upload_node/main.py', 'CM360_API_ENDPOINT', 'CM360_QPS_LIMIT'),
+    'sa360': ('SA360_cloud_converion_upload_node/main.py', 'SA360_API_ENDPOINT', 'SA360_QPS_LIMIT'),
+}
+
+
+def fake_credentials(*args, **kwargs):
+    from google.oauth2 import credentials
+    return credentials.Credentials(
+        token='emulator', expiry=datetime.datetime.utcnow() + datetime.timedelta(days=1))
+
+
+def instance(api, rows, endpoint, limiter_uri, limit, retry_base_delay):
+    """One node instance uploading one message, in its own process."""
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    path, endpoint_name, limit_name = NODES[api]
+    node = fakes.load_module(path, f'{api}_main')
+    setattr(node, endpoint_name, endpoint)
+    setattr(node, limit_name, limit)
+    node.RATE_LIMITER = limiter_uri
+    node.RETRY_BASE_DELAY = retry_base_delay
+    with mock.patch('google.auth.default', lambda *a, **k: (fake_credentials(), 'project')), \
+            mock.patch('google.auth.impersonated_credentials.Credentials', fake_credentials), \
+            contextlib.redirect_stdout(io.StringIO()):
+        if api == 'cm360':
+            result = node.upload_data(rows, *CM360_CONFIG)
+        else:
+            result = node.upload_data(rows)
+    return result
+
+
+def run(api, messages, qps, limiter_uri, limit, args):
+    emulator = api_emulator.ApiEmulator(qps=qps, latency=args.latency).start()
+    endpoint = emulator.cm360_endpoint if api == 'cm360' else emulator.sa360_endpoint
+    try:
+        start = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(len(messages)) as pool:
+            results = pool.starmap(instance, [(api, rows, endpoint, limiter_uri, limit, args.retry_base_delay)
+                                              for rows in messages])
+        seconds = time.perf_counter() - start
+    finally:
+        emulator.stop()
+    return seconds, results, emulator.stats()[api]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=4000, help='conversions over all the instances')
+    parser.add_argument('--qps', type=float, default=20, help='per-second quota of the emulator')
+    parser.add_argument('--limit-ratio', type=float, default=0.95, help='limit of the bucket, share of the quota')
+    parser.add_argument('--latency', default='lognormal:0.05:0.5')
+    parser.add_argument('--retry-base-delay', type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    cloud_client = fakes.FakeBigQueryClient({TABLE: fakes.synthetic_transformed_rows(args.rows)})
+    rows = [shards.normalize_row(row) for row in cloud_client.list_rows(TABLE)]
+    messages = [rows[index::args.instances] for index in range(args.instances)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for api in NODES:
+            for label, limiter_uri in (('no limiter', ''), ('sqlite', f'sqlite://{directory}/{api}_limiter.db')):
+                limit = args.qps * args.limit_ratio if limiter_uri else 0
+                seconds, results, stats = run(api, messages, args.qps, limiter_uri, limit, args)
+                uploaded = sum(result['uploaded'] for result in results)
+                assert uploaded == stats['rows_accepted'], (api, label, uploaded, stats)
+                line = (f'{api} {label:>10}: {seconds:6.2f}s {uploaded / seconds:7.0f} conversions/s, '
+                        f'{len(rows) - uploaded} lost, {stats["requests"]} requests, '
+                        f'{stats["statuses"].get("429", 0)} rejected with 429')
+                if limiter_uri:
+                    reports = [result['rate_limit'] for result in results]
+                    waits = sorted(report['p95_wait_seconds'] for report in reports)
+                    line += (f', {sum(report["acquired"] for report in reports)} tokens '
+                             f'({limit:.1f}/s), {sum(report["wait_seconds"] for report in reports):.1f}s waited, '
+                             f'p95 wait {waits[-1]:.3f}s, max wait '
+                             f'{max(report["max_wait_seconds"] for report in reports):.3f}s')
+                print(line)
+
+
+if __name__ == '__main__':
+    main()
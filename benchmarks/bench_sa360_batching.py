@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Fixed 100-conversion requests vs adaptive batches in the SA360 node
+# upload_data, against a fake service whose latency grows with the request
+# size, with a per request row limit and a few invalid conversions that
+# reject the whole request.
+#
+#   python bench_sa360_batching.py --rows 10000 --invalid-rate 0.001
+
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import fakes
+
+TABLE = 'dataset.transformed'
+
+
+def run(node, rows, service, batcher):
+    node.BATCHER = batcher
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = node.upload_data(rows, service=service)
+    return time.perf_counter() - start, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--per-row-latency', type=float, default=0.0005, help='seconds per conversion')
+    parser.add_argument('--max-request-rows', type=int, default=400)
+    parser.add_argument('--invalid-rate', type=float, default=0.0002)
+    parser.add_argument('--max-size', type=int, default=1000, help='SA360_MAX_BATCH_SIZE of the adaptive run')
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'America/New_York')
+    os.environ.setdefault('RETRY_BASE_DELAY', '0')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    node = fakes.load_module('SA360_cloud_converion_upload_node/main.py', 'sa360_main')
+    cloud_client = fakes.FakeBigQueryClient({TABLE: fakes.synthetic_transformed_rows(args.rows)})
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = [row for batch in delegator.get_data(TABLE, cloud_client, 1000) for row in batch]
+
+    batchers = (
+        # the former behaviour: fixed slices, a failed request loses all of them
+        ('fixed', node.AdaptiveBatcher(initial_size=100, max_size=100, min_size=100, split_ratio=0)),
+        ('adaptive', node.AdaptiveBatcher(initial_size=100, max_size=args.max_size, min_size=10)),
+    )
+    for label, batcher in batchers:
+        service = fakes.FakeConversionsService(
+            latency=args.latency, per_row_latency=args.per_row_latency,
+            max_request_rows=args.max_request_rows, invalid_rate=args.invalid_rate)
+        elapsed, stats = run(node, rows, service, batcher)
+        batching = stats['batching']
+        sizes = ', '.join(f'{size}x{count}' for size, count in sorted(
+            batching['batch_sizes'].items(), key=lambda item: -item[1])[:4])
+        print(f'{label:>9}: {elapsed:8.3f}s {service.accepted / elapsed:9.0f} conversions/s '
+              f'{service.accepted} accepted, {stats["dead_lettered"]} dropped, {service.calls} calls, '
+              f'{batching["splits"]} splits, final size {batching["final_batch_size"]}, most used {sizes}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Rows published through Pub/Sub vs shard descriptors (claim-check) read by
+# the SA360 node, for a whole table (row range shards) and for a filtered
+# job on a shared table (hash shards). The nodes must upload the same
+# conversions in both deliveries. Reports the delegator time, the Pub/Sub
+# bytes and the node time; nodes run one after the other here, the slowest
+# message is what a parallel deployment would wait for.
+#
+#   python bench_shards.py --rows 50000 --shard-rows 5000
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import time
+
+from unittest import mock
+
+import pyarrow as pa
+
+import fakes
+
+DATASET = 'business_data'
+TABLE = 'conversion_final'
+SHARED_TABLE = 'conversion_final_all'
+TOPIC = 'sa360_conversion_upload'
+ADVERTISER_ID = '700000001'
+
+
+def build_tables(num_rows):
+    table = fakes.synthetic_transformed_rows(num_rows)
+    # a shared table where a third of the rows belong to the advertiser
+    advertisers = pa.array([ADVERTISER_ID if index % 3 == 0 else '700000002' for index in range(num_rows)])
+    shared = table.set_column(table.schema.get_field_index('advertiserId'), 'advertiserId', advertisers)
+    return {f'{DATASET}.{TABLE}': table, f'{DATASET}.{SHARED_TABLE}': shared}
+
+
+def run(delegator, node, tables, job, delivery):
+    cloud_client = fakes.FakeBigQueryClient(tables)
+    publisher_client = fakes.FakePublisherClient(latency=0.0)
+    service = fakes.FakeConversionsService(latency=0.0)
+    node.SERVICE_CACHE[node.IMPERSONATED_SVC_ACCOUNT] = {
+        'credentials': fakes.FakeCredentials(), 'service': service}
+    uploaded = []
+    upload_data = node.upload_data
+
+    def record_upload(rows, **kwargs):
+        uploaded.extend(json.dumps(row, sort_keys=True) for row in rows)
+        return upload_data(rows, **kwargs)
+
+    event = dict(job, dataset_name=DATASET, topic=TOPIC, delivery=delivery, jobs=[{'name': 'bench'}])
+    with mock.patch.object(delegator, 'bigquery_client', cloud_client), \
+            mock.patch.object(delegator, 'publisher', publisher_client), \
+            mock.patch.object(node, 'bigquery_client', cloud_client), \
+            mock.patch.object(node, 'upload_data', record_upload), \
+            contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        delegator.main(event, None)
+        delegator_seconds = time.perf_counter() - start
+        node_seconds = []
+        for topic, data, attributes in publisher_client.messages:
+            start = time.perf_counter()
+            node.main({'data': base64.b64encode(data).decode('ascii')}, None)
+            node_seconds.append(time.perf_counter() - start)
+    node.SERVICE_CACHE.clear()
+    return {
+        'delegator_seconds': delegator_seconds,
+        'messages': len(publisher_client.messages),
+        'bytes': publisher_client.bytes_published,
+        'node_seconds': sum(node_seconds),
+        'slowest_node_seconds': max(node_seconds or [0.0]),
+        'accepted': service.accepted,
+        'uploaded': sorted(uploaded),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--shard-rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    os.environ.setdefault('SHARD_ROWS', str(args.shard_rows))
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    node = fakes.load_module('SA360_cloud_converion_upload_node/main.py', 'sa360_main')
+    node.PROJECT_TIMEZONE = os.environ['TIMEZONE']
+    tables = build_tables(args.rows)
+
+    for label, job in (('table', {'table_name': TABLE}),
+                       ('filtered', {'table_name': SHARED_TABLE, 'filter': f"advertiserId = '{ADVERTISER_ID}'"})):
+        results = {delivery: run(delegator, node, tables, job, delivery) for delivery in ('messages', 'shards')}
+        assert results['messages']['uploaded'] == results['shards']['uploaded'], 'the deliveries uploaded different rows'
+        for delivery, result in results.items():
+            print(f'{label:>8} {delivery:<8}: delegator {result["delegator_seconds"]:7.3f}s, '
+                  f'{result["messages"]:4} messages {result["bytes"]:>12,} bytes, '
+                  f'nodes {result["node_seconds"]:7.3f}s (slowest {result["slowest_node_seconds"]:.3f}s), '
+                  f'{result["accepted"]} conversions')
+        print(f'{label:>8} Pub/Sub bytes cut {results["messages"]["bytes"] / results["shards"]["bytes"]:,.0f}x, '
+              f'delegator {results["messages"]["delegator_seconds"] / results["shards"]["delegator_seconds"]:,.0f}x faster')
+
+
+if __name__ == '__main__':
+    main()
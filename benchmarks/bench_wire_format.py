@@ -0,0 +1,112 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Message encodings between the delegator and the upload nodes, for the
+# CM360 and the SA360 columns: JSON row objects, JSON compact records and
+# the columnar layout of wire_format.py uncompressed, with zlib and with
+# zstd (when zstandard is installed). Encoding is timed from the batches of
+# get_data to the message bytes, decoding from the base64 data of the
+# Pub/Sub event to the conversions of the node. Every encoding must give the
+# nodes the same conversions.
+#
+#   python bench_wire_format.py --rows 50000 --message-rows 1000
+
+import argparse
+import base64
+import contextlib
+import importlib.util
+import io
+import os
+import time
+
+import fakes
+
+TABLE = 'business_data.conversion_final'
+CM360_CONFIG = {'profile_id': '1000001', 'floodlight_configuration_id': '2000002',
+                'floodlight_activity_id': '3000003'}
+
+
+def encodings(delegator, wire_format):
+    """label -> (encode(batch, config, fields), Pub/Sub attributes)"""
+    def columnar(compression):
+        return lambda batch, config, fields: wire_format.encode_columnar(
+            fields, [[row.get(field) for field in fields] for row in batch], config, compression)
+
+    result = {
+        'json dicts': (lambda batch, config, fields: delegator.build_message(batch, config), {}),
+        'json records': (delegator.build_message, {}),
+        'columnar': (columnar('none'), {'encoding': 'columnar'}),
+        'columnar zlib': (columnar('zlib'), {'encoding': 'columnar'}),
+    }
+    if importlib.util.find_spec('zstandard'):
+        result['columnar zstd'] = (columnar('zstd'), {'encoding': 'columnar'})
+    return result
+
+
+def run(encode, attributes, batches, config, fields, wire_format, shards):
+    start = time.perf_counter()
+    messages = [encode(batch, config, fields) for batch in batches]
+    encode_seconds = time.perf_counter() - start
+    events = [{'data': base64.b64encode(message).decode('ascii'), 'attributes': attributes}
+              for message in messages]
+    start = time.perf_counter()
+    conversions = []
+    for event in events:
+        # what the node main does with the event
+        payload = wire_format.decode_message(base64.b64decode(event['data']), event.get('attributes'))
+        conversions.extend(shards.message_conversions(payload['data']))
+    decode_seconds = time.perf_counter() - start
+    return {
+        'encode_seconds': encode_seconds,
+        'decode_seconds': decode_seconds,
+        'bytes': sum(len(message) for message in messages),
+        'conversions': conversions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--message-rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('TIMEZONE', 'UTC')
+    delegator = fakes.load_module('converion_upload_delegator/main.py', 'delegator_main')
+    wire_format = fakes.load_module('converion_upload_delegator/wire_format.py', 'wire_format')
+    shards = fakes.load_module('converion_upload_delegator/shards.py', 'shards')
+    cloud_client = fakes.FakeBigQueryClient({TABLE: fakes.synthetic_transformed_rows(args.rows)})
+    table = cloud_client.get_table(TABLE)
+
+    for destination, config in (('cm360', CM360_CONFIG), ('sa360', None)):
+        selected_fields = delegator.destination_fields(table, destination)
+        fields = delegator.record_fields([field.name for field in selected_fields])
+        with contextlib.redirect_stdout(io.StringIO()):
+            batches = list(delegator.get_data(TABLE, cloud_client, args.message_rows, destination=destination,
+                                              selected_fields=selected_fields))
+        num_rows = sum(len(batch) for batch in batches)
+        results = {label: run(encode, attributes, batches, config, fields, wire_format, shards)
+                   for label, (encode, attributes) in encodings(delegator, wire_format).items()}
+        expected = results['json dicts']['conversions']
+        for label, result in results.items():
+            assert result['conversions'] == expected, f'{label} gives the nodes different conversions'
+            print(f'{destination} {label:>13}: encode {result["encode_seconds"] * 1e6 / num_rows:6.2f}us, '
+                  f'decode {result["decode_seconds"] * 1e6 / num_rows:6.2f}us, '
+                  f'{result["bytes"] / num_rows:7.1f} bytes per conversion '
+                  f'({results["json dicts"]["bytes"] / result["bytes"]:4.1f}x smaller)')
+
+
+if __name__ == '__main__':
+    main()
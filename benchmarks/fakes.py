@@ -0,0 +1,453 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In-process fakes of the Google Cloud clients used by the pipeline, plus a
+# synthetic generator for the transformed (profit) table. Only meant for the
+# benchmarks in this folder, nothing here talks to the network.
+
+import collections
+import datetime
+import decimal
+import importlib.util
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+
+from concurrent import futures
+
+import httplib2
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from googleapiclient import errors
+
+from google.cloud.bigquery.table import Row
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# columns of the table produced by sql_query/profit_gen_query_template.sql
+TRANSFORMED_SCHEMA = pa.schema([
+    ('account', pa.string()),
+    ('accountId', pa.string()),
+    ('accountType', pa.string()),
+    ('advertiser', pa.string()),
+    ('advertiserId', pa.string()),
+    ('agency', pa.string()),
+    ('agencyId', pa.string()),
+    ('campaignId', pa.string()),
+    ('campaign', pa.string()),
+    ('conversionId', pa.string()),
+    ('conversionAttributionType', pa.string()),
+    ('conversionDate', pa.date32()),
+    ('conversionTimestamp', pa.timestamp('us', 'UTC')),
+    ('conversionTimestampMillis', pa.int64()),
+    ('conversionTimestampMicros', pa.int64()),
+    ('conversionRevenue', pa.float64()),
+    ('conversionQuantity', pa.int64()),
+    ('floodlightActivity', pa.string()),
+    ('conversionSearchTerm', pa.string()),
+    ('conversionType', pa.string()),
+    ('conversionVisitExternalClickId', pa.string()),
+    ('conversionVisitId', pa.string()),
+    ('conversionVisitTimestamp', pa.timestamp('us', 'UTC')),
+    ('deviceSegment', pa.string()),
+    ('CALCULATED_PROFIT', pa.float64()),
+    ('CALCULATED_REVENUE', pa.float64()),
+    ('originalConversionRevenue', pa.decimal128(38, 9)),
+    ('originalFloodlightActivity', pa.string()),
+    ('originalFloodlightActivityId', pa.string()),
+    ('originalFloodlightActivityTag', pa.string()),
+    ('originalFloodlightRevenue', pa.float64()),
+    ('floodlightEventRequestString', pa.string()),
+    ('floodlightOrderId', pa.string()),
+])
+
+
+def load_module(relative_path, module_name):
+    '''Imports a Cloud Function main.py under a unique module name.'''
+    path = os.path.join(REPO_ROOT, relative_path)
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_transformed_rows(num_rows, seed=42, null_ratio=0.01):
+    '''Returns a pyarrow.Table shaped like the transformed profit table.'''
+    rng = random.Random(seed)
+    start = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    columns = {name: [] for name in TRANSFORMED_SCHEMA.names}
+    for i in range(num_rows):
+        timestamp = start + datetime.timedelta(microseconds=rng.randrange(86_400_000_000 * 60))
+        basket = rng.randint(1, 6)
+        skus = '|'.join(str(rng.randrange(100_000)) for _ in range(basket))
+        quantities = '|'.join(str(rng.randint(1, 4)) for _ in range(basket))
+        prices = '|'.join(f'{rng.uniform(1, 300):.2f}' for _ in range(basket))
+        profit = round(rng.uniform(0.5, 400), 2)
+        values = {
+            'account': f'account_{i % 7}',
+            'accountId': str(700000000000000 + i % 7),
+            'accountType': 'Google AdWords',
+            'advertiser': 'advertiser',
+            'advertiserId': '43939335402485897',
+            'agency': 'agency',
+            'agencyId': '20100000000000932',
+            'campaignId': str(71700000000000000 + i % 500),
+            'campaign': f'campaign_{i % 500}',
+            'conversionId': f'{4000000000000000 + i}00',
+            'conversionAttributionType': 'ATTRIBUTED',
+            'conversionDate': timestamp.date(),
+            'conversionTimestamp': timestamp,
+            'conversionTimestampMillis': int(timestamp.timestamp() * 1000),
+            'conversionTimestampMicros': int(timestamp.timestamp() * 1_000_000),
+            'conversionRevenue': profit,
+            'conversionQuantity': basket,
+            'floodlightActivity': 'profit_bid_floodlight',
+            'conversionSearchTerm': f'search term {i % 1000}',
+            'conversionType': 'TRANSACTION',
+            'conversionVisitExternalClickId': f'Cj0KCQ{rng.getrandbits(128):032x}',
+            'conversionVisitId': str(rng.getrandbits(62)),
+            'conversionVisitTimestamp': timestamp - datetime.timedelta(minutes=rng.randint(1, 600)),
+            'deviceSegment': rng.choice(['DESKTOP', 'MOBILE', 'TABLET']),
+            'CALCULATED_PROFIT': profit,
+            'CALCULATED_REVENUE': float(int(profit * 3)),
+            'originalConversionRevenue': decimal.Decimal(f'{rng.uniform(1, 900):.9f}'),
+            'originalFloodlightActivity': 'Sales',
+            'originalFloodlightActivityId': '8654321',
+            'originalFloodlightActivityTag': 'sales0',
+            'originalFloodlightRevenue': round(rng.uniform(1, 900), 2),
+            'floodlightEventRequestString': f'u9={skus};u10={quantities};u11={prices};ord={i}',
+            'floodlightOrderId': str(i),
+        }
+        if rng.random() < null_ratio:
+            values[rng.choice(['conversionId', 'conversionQuantity', 'conversionVisitExternalClickId'])] = None
+        for name in TRANSFORMED_SCHEMA.names:
+            columns[name].append(values[name])
+    return pa.table(columns, schema=TRANSFORMED_SCHEMA)
+
+
+FakeSchemaField = collections.namedtuple('FakeSchemaField', ['name', 'field_type'])
+
+
+class FakeTable(object):
+    '''Stands in for google.cloud.bigquery.table.Table.'''
+
+    def __init__(self, table_id, arrow_table, modified=None):
+        self.full_table_id = table_id.replace('.', ':', 1)
+        self.arrow_table = arrow_table
+        self.num_rows = arrow_table.num_rows
+        self.modified = modified or datetime.datetime.now(datetime.timezone.utc)
+        self.created = self.modified
+
+    @property
+    def schema(self):
+        return [FakeSchemaField(field.name, str(field.type)) for field in self.arrow_table.schema]
+
+
+class FakeRowIterator(object):
+    '''Pages over an Arrow table the way RowIterator pages over the REST API.'''
+
+    def __init__(self, arrow_table, page_size, job_id=None, location=None):
+        self.arrow_table = arrow_table
+        self.page_size = page_size
+        # set on query results, as on the RowIterator of a query job
+        self.job_id = job_id
+        self.location = location
+        self.field_to_index = {name: i for i, name in enumerate(arrow_table.schema.names)}
+
+    def to_arrow_iterable(self, **kwargs):
+        for record_batch in self.arrow_table.to_batches(max_chunksize=self.page_size):
+            yield record_batch
+
+    def __iter__(self):
+        for record_batch in self.to_arrow_iterable():
+            columns = [column.to_pylist() for column in record_batch.columns]
+            for values in zip(*columns):
+                yield Row(values, self.field_to_index)
+
+
+class FakeBigQueryClient(object):
+    '''Serves in-memory Arrow tables through get_table/list_rows.
+
+    bytes_read adds up the Arrow size of the columns read, the columns
+    returned by list_rows and the columns a query references over the
+    whole table, the way BigQuery bills a scan.'''
+
+    def __init__(self, tables, page_size=20000):
+        self.tables = {
+            name: FakeTable(name, arrow_table) for name, arrow_table in tables.items()
+        }
+        self.page_size = page_size
+        self.bytes_read = 0
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def _read(self, num_bytes):
+        with self._lock:
+            self.bytes_read += num_bytes
+
+    def get_table(self, table_ref_name):
+        name = table_ref_name if isinstance(table_ref_name, str) else table_ref_name.full_table_id
+        name = name.replace(':', '.')
+        for table_id, table in self.tables.items():
+            if name == table_id or name.endswith('.' + table_id):
+                return table
+        raise ValueError(f'Table {name} not found')
+
+    def list_rows(self, table_ref_name, start_index=0, max_results=None, selected_fields=None, **kwargs):
+        arrow_table = self.get_table(table_ref_name).arrow_table.slice(start_index, max_results)
+        if selected_fields is not None:
+            arrow_table = arrow_table.select([field.name for field in selected_fields])
+        self._read(arrow_table.nbytes)
+        return FakeRowIterator(arrow_table, kwargs.get('page_size') or self.page_size)
+
+    def append_rows(self, table_ref_name, arrow_table):
+        """Rows landing in a table, as a transfer or scheduled query would add them."""
+        table = self.get_table(table_ref_name)
+        table.arrow_table = pa.concat_tables([table.arrow_table, arrow_table])
+        table.num_rows = table.arrow_table.num_rows
+        table.modified = datetime.datetime.now(datetime.timezone.utc)
+
+    # the delegator and upload node queries: incremental reads, per job row
+    # filters, shard counts and hash shards (time travel is ignored)
+    QUERY = re.compile(
+        r'SELECT (?:(\*|\w+(?:, \w+)*)(?:, UNIX_MICROS\((\w+)\) AS (\w+))?|COUNT\(\*\) AS (\w+)) FROM `([^`]+)`'
+        r'(?: FOR SYSTEM_TIME AS OF TIMESTAMP_MILLIS\(@snapshot_millis\))?'
+        r'(?: WHERE (.+?))?(?: ORDER BY \w+)?$')
+    WATERMARK_CONDITION = re.compile(r'\w+ >= TIMESTAMP_MICROS\(@watermark\)$')
+    HASH_CONDITION = re.compile(
+        r'ABS\(MOD\(FARM_FINGERPRINT\(CAST\((\w+) AS STRING\)\), @shards\)\) = @shard$')
+    EQUALITY_CONDITION = re.compile(r"\((\w+) = '([^']*)'\)$")
+
+    def query(self, query, job_config=None):
+        match = self.QUERY.match(query)
+        if not match:
+            raise NotImplementedError(f'FakeBigQueryClient cannot run: {query}')
+        select, column, field, count_field, table_ref_name, where = match.groups()
+        parameters = {p.name: p.value for p in job_config.query_parameters} if job_config else {}
+        arrow_table = self.get_table(table_ref_name).arrow_table
+        if select == '*':
+            referenced = set(arrow_table.schema.names)
+        else:
+            referenced = set(re.findall(r'\w+', ' '.join(filter(None, [select, column, where]))))
+        self._read(sum(arrow_table.column(name).nbytes for name in arrow_table.schema.names if name in referenced))
+        micros = None
+        if column:
+            micros = pc.cast(pc.cast(arrow_table.column(column), pa.timestamp('us', 'UTC')), pa.int64())
+            arrow_table = arrow_table.append_column(field, micros)
+        for condition in (where.split(' AND ') if where else []):
+            if self.WATERMARK_CONDITION.match(condition):
+                arrow_table = arrow_table.filter(
+                    pc.greater_equal(arrow_table.column(field), parameters['watermark']))
+                continue
+            hashed = self.HASH_CONDITION.match(condition)
+            if hashed:
+                # crc32 stands in for FARM_FINGERPRINT
+                shards = [zlib.crc32(str(value).encode('utf-8')) % parameters['shards']
+                          for value in arrow_table.column(hashed.group(1)).to_pylist()]
+                arrow_table = arrow_table.filter(pc.equal(pa.array(shards, pa.int64()), parameters['shard']))
+                continue
+            equality = self.EQUALITY_CONDITION.match(condition)
+            if not equality:
+                raise NotImplementedError(f'FakeBigQueryClient cannot filter on: {condition}')
+            name, value = equality.groups()
+            arrow_table = arrow_table.filter(pc.equal(arrow_table.column(name), value))
+        if count_field:
+            arrow_table = pa.table({count_field: pa.array([arrow_table.num_rows], pa.int64())})
+        elif select != '*':
+            arrow_table = arrow_table.select(select.split(', ') + ([field] if column else []))
+        if column:
+            arrow_table = arrow_table.sort_by(field)
+        with self._lock:
+            job = FakeQueryJob(f'job_{len(self.jobs)}', arrow_table, self.page_size)
+            self.jobs[job.job_id] = job
+        return job
+
+    def get_job(self, job_id, location=None):
+        return self.jobs[job_id]
+
+
+class FakeQueryJob(object):
+    '''Keeps the results of a query, as the destination table of a job does.'''
+
+    def __init__(self, job_id, arrow_table, page_size):
+        self.job_id = job_id
+        self.arrow_table = arrow_table
+        self.page_size = page_size
+
+    def result(self, start_index=None, **kwargs):
+        return FakeRowIterator(self.arrow_table.slice(start_index or 0), self.page_size, self.job_id, 'US')
+
+
+class FakePublisherClient(object):
+    '''Pub/Sub publisher whose futures resolve after an injected latency.'''
+
+    def __init__(self, latency=0.05, failure_rate=0.0, seed=0, max_workers=64):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.messages = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def topic_path(self, project, topic):
+        return f'projects/{project}/topics/{topic}'
+
+    def publish(self, topic, data, **attributes):
+        with self._lock:
+            fail = self._random.random() < self.failure_rate
+
+        def send():
+            time.sleep(self.latency)
+            if fail:
+                raise RuntimeError('injected publish failure')
+            with self._lock:
+                self.messages.append((topic, data, attributes))
+                return str(len(self.messages))
+
+        return self._executor.submit(send)
+
+    @property
+    def bytes_published(self):
+        return sum(len(data) for _, data, _ in self.messages)
+
+
+class FakeCredentials(object):
+    '''Credentials that stay valid for a day and never call the token endpoint.'''
+
+    def __init__(self):
+        self.token = 'fake-token'
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        self.valid = True
+
+    def refresh(self, request):
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+
+    def before_request(self, request, method, url, headers):
+        headers['authorization'] = f'Bearer {self.token}'
+
+
+class FakeApiRequest(object):
+    '''A prepared API request, execute() runs the fake's handler.'''
+
+    def __init__(self, handler, body):
+        self.handler = handler
+        self.body = body
+
+    def execute(self, http=None, num_retries=0):
+        return self.handler(self.body)
+
+
+class FakeConversionsService(object):
+    '''Discovery style service for CM360 conversions().batchinsert and SA360
+    conversion().insert with latency, a QPS quota and per row failures.
+
+    For the SA360 batching benchmark the latency can grow with the rows of a
+    request (per_row_latency), requests over max_request_rows are rejected
+    with a 413, requests slower than request_timeout time out, and a share of
+    the conversions (invalid_rate, the same ones on every call) reject the
+    whole SA360 request with a 400.'''
+
+    def __init__(self, latency=0.05, qps=None, row_failure_rate=0.0, seed=0,
+                 row_error_code='INVALID_ARGUMENT', per_row_latency=0.0,
+                 max_request_rows=None, request_timeout=None, invalid_rate=0.0):
+        self.latency = latency
+        self.qps = qps
+        self.row_failure_rate = row_failure_rate
+        self.row_error_code = row_error_code
+        self.per_row_latency = per_row_latency
+        self.max_request_rows = max_request_rows
+        self.request_timeout = request_timeout
+        self.invalid_rate = invalid_rate
+        self.calls = 0
+        self.throttled = 0
+        self.accepted = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = []
+
+    def _admit(self):
+        with self._lock:
+            self.calls += 1
+            if self.qps is None:
+                return True
+            now = time.monotonic()
+            self._window = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.qps:
+                self.throttled += 1
+                return False
+            self._window.append(now)
+            return True
+
+    def is_invalid(self, conversion):
+        key = str(conversion.get('conversionId', conversion.get('ordinal', ''))).encode('utf-8')
+        return zlib.crc32(key) / 2 ** 32 < self.invalid_rate
+
+    def _handle(self, conversions, kind):
+        if not self._admit():
+            raise errors.HttpError(
+                httplib2.Response({'status': 429}),
+                b'{"error": {"code": 429, "errors": [{"reason": "rateLimitExceeded"}]}}')
+        if self.max_request_rows is not None and len(conversions) > self.max_request_rows:
+            raise errors.HttpError(
+                httplib2.Response({'status': 413}),
+                b'{"error": {"code": 413, "message": "Request payload size exceeds the limit"}}')
+        latency = self.latency + self.per_row_latency * len(conversions)
+        if self.request_timeout is not None and latency > self.request_timeout:
+            time.sleep(self.request_timeout)
+            raise TimeoutError('timed out')
+        time.sleep(latency)
+        if self.invalid_rate and any(self.is_invalid(conversion) for conversion in conversions):
+            raise errors.HttpError(
+                httplib2.Response({'status': 400}),
+                b'{"error": {"code": 400, "message": "The conversion is invalid"}}')
+        status = []
+        with self._lock:
+            for conversion in conversions:
+                failed = self._random.random() < self.row_failure_rate
+                line = {'conversion': conversion}
+                if failed:
+                    line['errors'] = [{'code': self.row_error_code, 'message': 'injected failure'}]
+                else:
+                    self.accepted += 1
+                status.append(line)
+        has_failures = any('errors' in line for line in status)
+        return {'kind': kind, 'hasFailures': has_failures, 'status': status}
+
+    # CM360 (dfareporting)
+    def conversions(self):
+        return self
+
+    def batchinsert(self, profileId, body):
+        return FakeApiRequest(
+            lambda b: self._handle(b['conversions'], 'dfareporting#conversionsBatchInsertResponse'), body)
+
+    # SA360 (doubleclicksearch)
+    def conversion(self):
+        return self
+
+    def insert(self, body):
+        def handler(b):
+            response = self._handle(b['conversion'], 'doubleclicksearch#conversionList')
+            if not response['hasFailures']:
+                del response['hasFailures']
+            return response
+        return FakeApiRequest(handler, body)
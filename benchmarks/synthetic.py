@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Scales the solution_test fixtures up to any number of conversions. Baskets
+# are resampled from the fixture: basket sizes, SKUs (mostly from the margin
+# table, some unknown ones), quantities and unit prices follow the fixture's
+# distributions, so u9/u10/u11 keep realistic cardinalities.
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import fakes
+
+sys.path.insert(0, os.path.join(fakes.REPO_ROOT, 'profit_engine'))
+import profit_gen
+
+FIXTURES = os.path.join(fakes.REPO_ROOT, 'solution_test')
+ADVERTISER_ID = '43939335402485897'
+
+
+def load_fixtures():
+    """Returns the (conversions, campaigns, margins) fixture DataFrames."""
+    conversions = profit_gen.read_table(
+        os.path.join(FIXTURES, f'p_Conversion_{ADVERTISER_ID}.csv'),
+        os.path.join(FIXTURES, 'p_Conversion_schema.json'))
+    campaigns = profit_gen.read_table(
+        os.path.join(FIXTURES, f'p_Campaign_{ADVERTISER_ID}.csv'),
+        os.path.join(FIXTURES, 'p_Campaign_schema.json'))
+    margins = profit_gen.read_table(os.path.join(FIXTURES, 'client_profit.csv'))
+    return conversions, campaigns, margins
+
+
+def fixture_items(conversions):
+    requests = conversions['floodlightEventRequestString']
+    baskets = requests.str.extract('u9=(.*?);', expand=False).str.split('|')
+    quantities = requests.str.extract('u10=(.*?);', expand=False).str.split('|').explode()
+    prices = requests.str.extract('u11=(.*?);', expand=False).str.split('|').explode()
+    return baskets.str.len().dropna().astype(int).to_numpy(), quantities.to_numpy(), prices.to_numpy()
+
+
+def scale_conversions(conversions, margins, num_rows, seed=0, unknown_sku_ratio=0.05):
+    """Returns num_rows conversions resampled from the fixture conversions."""
+    rng = np.random.default_rng(seed)
+    scaled = conversions.iloc[rng.integers(0, len(conversions), num_rows)].reset_index(drop=True)
+    scaled['conversionId'] = (10 ** 16 + np.arange(num_rows)).astype(str)
+    scaled['conversionVisitExternalClickId'] = pd.Series(
+        rng.integers(0, 2 ** 62, num_rows)).map('Cj0K{:016x}'.format)
+    basket_sizes, quantities, prices = fixture_items(conversions)
+    sizes = rng.choice(basket_sizes, num_rows)
+    total = int(sizes.sum())
+    skus = margins['sku'].astype(str).to_numpy()
+    item_skus = rng.choice(skus, total).astype(object)
+    unknown = rng.random(total) < unknown_sku_ratio
+    item_skus[unknown] = 'GGOEUNKNOWN' + rng.integers(0, 10 ** 6, int(unknown.sum())).astype(str).astype(object)
+    # items of a row are contiguous, join them with a string sum per row
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    def join(values):
+        joined = np.add.reduceat((values.astype(object) + '|').astype(object), starts)
+        return pd.Series(joined).str[:-1]
+
+    scaled['floodlightEventRequestString'] = (
+        ';mykey=myvalue;u9=' + join(item_skus) + ';u10=' + join(rng.choice(quantities, total)) +
+        ';u11=' + join(rng.choice(prices, total)) + ';').to_numpy()
+    return scaled
+
+
+def transformed_table(profit_rows):
+    """The profit engine output as the Arrow table BigQuery would serve."""
+    table = pa.Table.from_pandas(profit_rows, preserve_index=False)
+    for index, field in enumerate(table.schema):
+        # BigQuery TIMESTAMPs have microsecond precision
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(index, field.name, table.column(index).cast(pa.timestamp('us', 'UTC')))
+    return table
@@ -21,11 +21,22 @@ import datetime
 import decimal
 import logging
 import json
+import pyarrow as pa
+import pyarrow.compute as pc
 import google.auth
 import google.auth.impersonated_credentials
+import google.auth.transport.requests
 import google_auth_httplib2
+import time
 from googleapiclient import discovery
 from google.cloud import bigquery
+from instrumentation import export_metrics
+from instrumentation import increment
+from instrumentation import log
+from instrumentation import log_payload
+from instrumentation import observe
+from instrumentation import reset_metrics
+from instrumentation import timer
 
 PB_SA_EMAIL = '<sa_email>'
 PB_API_SCOPES = ['https://www.googleapis.com/auth/dfareporting',
@@ -34,6 +45,9 @@ PB_API_SCOPES = ['https://www.googleapis.com/auth/dfareporting',
               'https://www.googleapis.com/auth/devstorage.read_write']
 PB_CM360_API_NAME = 'dfareporting'
 PB_CM360_API_VERSION = 'v4'
+# base URL replacing the one of the discovery document, e.g. the local
+#   emulator of benchmarks/api_emulator.py (http://host:port/dfareporting/v4/)
+PB_CM360_API_ENDPOINT = None
 PB_REQUIRED_KEYS = [
     'conversionId',
     'conversionQuantity',
@@ -44,11 +58,24 @@ PB_REQUIRED_KEYS = [
 PB_GCP_PROJECT = '<project_id>'
 PB_DS_BUSINESS_DATA ='<business_dataset_name>'
 PB_CM360_TABLE = '<transformed_data_tbl>'
+# columns of the transformed table the upload reads, only these are downloaded
+PB_SELECTED_FIELDS = PB_REQUIRED_KEYS + ['conversionTimestampMicros']
 PB_BATCH_SIZE = 100
+# 'rows' iterates the table row by row, 'arrow' normalises whole pages
+#   as Arrow record batches (same output, far less per-cell Python work)
+PB_FETCH_MODE = 'rows'
+# rows uploaded by each mapped push_conversion_shard task of the DAG
+PB_SHARD_ROWS = 10000
 PB_TIMEZONE = '<timezone>'
 PB_CM360_PROFILE_ID = '<cm_profileid>'
 PB_CM360_FL_CONFIG_ID = '<fl_config_id>'
 PB_CM360_FL_ACTIVITY_ID = '<fl_activity_id>'
+# impersonated tokens live for an hour and are refreshed 5 minutes before expiry
+PB_TOKEN_LIFETIME = 3600
+PB_TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# credentials and API clients reused by every batch of the task
+PB_SERVICE_CACHE = {}
+PB_CLIENT_CACHE_STATS = {'hits': 0, 'misses': 0, 'refreshes': 0, 'auth_seconds': 0.0}
 
 def today_date(timezone):
     """Returns today's date using the timezone
@@ -82,21 +109,69 @@ def pluralize(count):
         return 's'
     return ''  
 
-def get_data(table_ref_name, cloud_client, batch_size):
+def log_skip_stats(table_ref_name, num_rows, skip_stats):
+    """Counts and logs the rows skipped for missing values
+    Args:
+        table_ref_name(:obj:`str`): Name of the table
+        num_rows(:obj:`int`): Rows of the table
+        skip_stats(:obj:`dict`): Skipped rows per missing key
+    """
+    increment('rows_skipped', sum(skip_stats.values()))
+    pretty_skip_stats = ', '.join([f'{val} row{pluralize(val)} missing key "{key}"' for key, val in skip_stats.items()])
+    log(f'Processed {num_rows} from table {table_ref_name} skipped {pretty_skip_stats}',
+        table=table_ref_name, rows_skipped=skip_stats)
+
+def shard_num_rows(table, start_index, max_results):
+    """Rows of a table read from start_index, max_results at most
+    Args:
+        table(:obj:`google.cloud.bigquery.table.Table`): The table
+        start_index(:obj:`int`): First row read, None for the first row of the table
+        max_results(:obj:`int`): Rows read at most, None for all of them
+    Returns:
+      int: number of rows
+    """
+    num_rows = table.num_rows - (start_index or 0)
+    if max_results is not None:
+        num_rows = min(num_rows, max_results)
+    return max(0, num_rows)
+
+def list_rows(cloud_client, table, start_index=None, max_results=None):
+    """Lists the PB_SELECTED_FIELDS columns of a table, or of a slice of it
+    Args:
+        cloud_client(:obj:`google.cloud.bigquery.client.Client`): BigQuery client
+        table(:obj:`google.cloud.bigquery.table.Table`): The table
+        start_index(:obj:`int`): First row read, None for the first row of the table
+        max_results(:obj:`int`): Rows read at most, None for all of them
+    Returns:
+      RowIterator: the rows
+    """
+    selected_fields = [field for field in table.schema if field.name in PB_SELECTED_FIELDS]
+    return cloud_client.list_rows(table, selected_fields=selected_fields,
+                                  start_index=start_index or 0, max_results=max_results)
+
+def get_data(table_ref_name, cloud_client, batch_size, start_index=None, max_results=None):
     """Returns the data from the transformed table.
     Args:
         table_ref_name(:obj:`google.cloud.bigquery.table.Table`): Reference to the table
         cloud_client(:obj:`google.cloud.bigquery.client.Client`): BigQuery client
         batch_size(:obj:`int`): Batch size
+        start_index(:obj:`int`): First row read, None for the first row of the table
+        max_results(:obj:`int`): Rows read at most, None for all of them
     Returns:
       Array[]: list/rows of data
     """
 
     current_batch = []
     table = cloud_client.get_table(table_ref_name)
-    print(f'Downloading {table.num_rows} rows from table {table_ref_name}')
+    num_rows = shard_num_rows(table, start_index, max_results)
+    log('Downloading rows', table=table_ref_name, num_rows=num_rows, start_index=start_index)
     skip_stats = {}
-    for row in cloud_client.list_rows(table_ref_name):
+    # per batch: fetch is the time spent reading and checking rows,
+    #   transform the time spent converting them
+    batch_start = time.perf_counter()
+    transform_seconds = 0.0
+    for row in list_rows(cloud_client, table, start_index, max_results):
+        increment('rows_read')
         missing_keys = []
         for key in PB_REQUIRED_KEYS:
             val = row.get(key)
@@ -109,6 +184,7 @@ def get_data(table_ref_name, cloud_client, batch_size):
             row_as_dict = dict(row.items())
             logging.debug(f'Skipped row: missing values for keys {missing_keys} in row {row_as_dict}')
             continue
+        transform_start = time.perf_counter()
         result = {}
         conversionTimestamp = row.get('conversionTimestamp')
         # convert floating point seconds to microseconds since the epoch
@@ -122,17 +198,137 @@ def get_data(table_ref_name, cloud_client, batch_size):
             else:
                 result[key] = value
         current_batch.append(result)
+        transform_seconds += time.perf_counter() - transform_start
         if len(current_batch) >= batch_size:
+            observe('fetch', time.perf_counter() - batch_start - transform_seconds)
+            observe('transform', transform_seconds)
             yield current_batch
             current_batch = []
+            batch_start = time.perf_counter()
+            transform_seconds = 0.0
     if len(current_batch) > 0:
+        observe('fetch', time.perf_counter() - batch_start - transform_seconds)
+        observe('transform', transform_seconds)
         yield current_batch
-    pretty_skip_stats = ', '.join([f'{val} row{pluralize(val)} missing key "{key}"' for key, val in skip_stats.items()])
-    logging.info(f'Processed {table.num_rows} from table {table_ref_name} skipped {pretty_skip_stats}')
+    log_skip_stats(table_ref_name, num_rows, skip_stats)
+
+def arrow_column_values(column):
+    """Converts an Arrow column to python values the way get_data does
+    Args:
+        column(:obj:`pyarrow.Array`): A column of a downloaded page
+    Returns:
+      list: python values, dates formatted and decimals as floats
+    """
+    if pa.types.is_timestamp(column.type) or pa.types.is_date(column.type):
+        return pc.strftime(column, format="%y-%m-%d ").to_pylist()
+    if pa.types.is_decimal(column.type):
+        # going through the exact decimal string keeps float(Decimal) rounding
+        return pc.cast(pc.cast(column, pa.string()), pa.float64()).to_pylist()
+    return column.to_pylist()
+
+def arrow_timestamp_micros(column):
+    """Derives conversionTimestampMicros for a whole timestamp column
+    Args:
+        column(:obj:`pyarrow.Array`): The conversionTimestamp column
+    Returns:
+      list: microseconds since the epoch, same float arithmetic as get_data
+    """
+    micros = pc.cast(pc.cast(column, pa.timestamp('us', column.type.tz)), pa.int64())
+    seconds = pc.divide(pc.cast(micros, pa.float64()), 1_000_000.0)
+    return pc.cast(pc.trunc(pc.multiply(seconds, 1_000_000.0)), pa.int64()).to_pylist()
+
+def arrow_batch_to_rows(record_batch, skip_stats):
+    """Filters and normalises one Arrow record batch column-wise
+    Args:
+        record_batch(:obj:`pyarrow.RecordBatch`): A downloaded page
+        skip_stats(:obj:`dict`): Skipped row counts per missing key, updated in place
+    Returns:
+      Array[]: row dicts identical to the ones built by get_data
+    """
+    names = record_batch.schema.names
+    valid = pa.array([True] * record_batch.num_rows, pa.bool_())
+    for key in PB_REQUIRED_KEYS:
+        if key in names:
+            column = record_batch.column(names.index(key))
+            null_count = column.null_count
+            if null_count:
+                valid = pc.and_(valid, pc.is_valid(column))
+        else:
+            null_count = record_batch.num_rows
+            valid = pa.array([False] * record_batch.num_rows, pa.bool_())
+        if null_count:
+            skip_stats[key] = skip_stats.get(key, 0) + null_count
+    if valid.false_count:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for row_as_dict in record_batch.filter(pc.invert(valid)).to_pylist():
+                missing_keys = [key for key in PB_REQUIRED_KEYS if row_as_dict.get(key) is None]
+                logging.debug(f'Skipped row: missing values for keys {missing_keys} in row {row_as_dict}')
+        record_batch = record_batch.filter(valid)
+    if record_batch.num_rows == 0:
+        return []
+    # conversionTimestampMicros always leads, a column of the same name wins
+    keys = ['conversionTimestampMicros']
+    if 'conversionTimestampMicros' in names:
+        columns = [arrow_column_values(record_batch.column(names.index('conversionTimestampMicros')))]
+    else:
+        columns = [arrow_timestamp_micros(record_batch.column(names.index('conversionTimestamp')))]
+    for index, name in enumerate(names):
+        if name == 'conversionTimestampMicros':
+            continue
+        keys.append(name)
+        columns.append(arrow_column_values(record_batch.column(index)))
+    return [dict(zip(keys, values)) for values in zip(*columns)]
+
+def get_data_arrow(table_ref_name, cloud_client, batch_size, start_index=None, max_results=None):
+    """Columnar twin of get_data, downloads pages as Arrow record batches.
+    Args:
+        table_ref_name(:obj:`google.cloud.bigquery.table.Table`): Reference to the table
+        cloud_client(:obj:`google.cloud.bigquery.client.Client`): BigQuery client
+        batch_size(:obj:`int`): Batch size
+        start_index(:obj:`int`): First row read, None for the first row of the table
+        max_results(:obj:`int`): Rows read at most, None for all of them
+    Returns:
+      Array[]: list/rows of data, identical to get_data
+    """
+    current_batch = []
+    table = cloud_client.get_table(table_ref_name)
+    num_rows = shard_num_rows(table, start_index, max_results)
+    log('Downloading rows', table=table_ref_name, num_rows=num_rows, start_index=start_index)
+    skip_stats = {}
+    record_batches = iter(list_rows(cloud_client, table, start_index, max_results).to_arrow_iterable())
+    while True:
+        with timer('fetch'):
+            record_batch = next(record_batches, None)
+        if record_batch is None:
+            break
+        increment('rows_read', record_batch.num_rows)
+        with timer('transform'):
+            current_batch.extend(arrow_batch_to_rows(record_batch, skip_stats))
+        full_rows = len(current_batch) - len(current_batch) % batch_size
+        for start in range(0, full_rows, batch_size):
+            yield current_batch[start:start + batch_size]
+        current_batch = current_batch[full_rows:]
+    if len(current_batch) > 0:
+        yield current_batch
+    log_skip_stats(table_ref_name, num_rows, skip_stats)
+
+def refresh_if_expiring(credentials):
+    """Refreshes the token when it is missing or about to expire
+    Args:
+        credentials(:obj:`google.auth.credentials.Credentials`): Credentials to check
+    """
+    if credentials.expiry and credentials.expiry - PB_TOKEN_REFRESH_MARGIN > datetime.datetime.utcnow():
+        return
+    start = time.perf_counter()
+    credentials.refresh(google.auth.transport.requests.Request())
+    PB_CLIENT_CACHE_STATS['refreshes'] += 1
+    PB_CLIENT_CACHE_STATS['auth_seconds'] += time.perf_counter() - start
+    observe('auth', time.perf_counter() - start)
 
 def setup(sa_email, api_scopes, api_name, api_version):
     """Impersonates a service account, authenticate with Google Service,
       and returns a discovery api for further communication with Google Services.
+      The service is cached, later calls only refresh the token when needed.
     Args:
         sa_email(:obj:`str`): Service Account to impersonate
         api_scopes(:obj:`Any`): An array of scope that the service account 
@@ -142,7 +338,15 @@ def setup(sa_email, api_scopes, api_name, api_version):
     Returns:
       module:discovery: to interact with Goolge Services.
     """
+    cache_key = (sa_email, tuple(api_scopes), api_name, api_version)
+    cached = PB_SERVICE_CACHE.get(cache_key)
+    if cached:
+        PB_CLIENT_CACHE_STATS['hits'] += 1
+        refresh_if_expiring(cached['credentials'])
+        return cached['service']
+    PB_CLIENT_CACHE_STATS['misses'] += 1
 
+    start = time.perf_counter()
     source_credentials, project_id = google.auth.default()
 
     target_credentials = google.auth.impersonated_credentials.Credentials(
@@ -150,18 +354,26 @@ def setup(sa_email, api_scopes, api_name, api_version):
         target_principal=sa_email,
         target_scopes=api_scopes,
         delegates=[],
-        lifetime=500)
+        lifetime=PB_TOKEN_LIFETIME)
+    PB_CLIENT_CACHE_STATS['auth_seconds'] += time.perf_counter() - start
+    observe('auth', time.perf_counter() - start)
 
     http = google_auth_httplib2.AuthorizedHttp(target_credentials)
-    # setup API service here
+    # setup API service here, from the bundled discovery document
     try: 
-      return discovery.build(
+      refresh_if_expiring(target_credentials)
+      service = discovery.build(
           api_name,
           api_version,
           cache_discovery=False,
-          http=http)
+          static_discovery=True,
+          http=http,
+          client_options={'api_endpoint': PB_CM360_API_ENDPOINT} if PB_CM360_API_ENDPOINT else None)
     except Exception as e:
-        print(f'Could not authenticate: {str(e)}')
+        log(f'Could not authenticate: {str(e)}', 'ERROR')
+        return None
+    PB_SERVICE_CACHE[cache_key] = {'credentials': target_credentials, 'service': service}
+    return service
 
 
 def upload_data(timezone, rows, profile_id, fl_configuration_id, fl_activity_id):
@@ -172,21 +384,27 @@ def upload_data(timezone, rows, profile_id, fl_configuration_id, fl_activity_id)
         profile_id(:obj:`str`): Profile id - should be gathered from the CM360
         fl_configuration_id(:obj:`str`): Floodlight config id - should be gathered from the CM360
         fl_activity_id(:obj:`str`): Floodlight activity id - should be gathered from the CM360
+    Returns:
+      dict: conversions uploaded, failed (rejected by CM360) and unsent
+        (not uploaded because of an error)
     """
   
-    print('Starting conversions for ' + time_now_str(timezone))
+    log('Starting conversions for ' + time_now_str(timezone))
+    counts = {'uploaded': 0, 'failed': 0, 'unsent': 0}
     if not fl_activity_id or not fl_configuration_id:
-        print('Please make sure to provide a value for both floodlightActivityId and floodlightConfigurationId!!')
-        return
+        log('Please make sure to provide a value for both floodlightActivityId and floodlightConfigurationId!!', 'ERROR')
+        counts['unsent'] = len(rows)
+        return counts
     # Build the API connection
+    currentrow = 0
     try:       
       service = setup(PB_SA_EMAIL, PB_API_SCOPES, 
                       PB_CM360_API_NAME,  PB_CM360_API_VERSION)
       # upload_log = ''
-      print('Authorization successful')
-      currentrow = 0
+      log('Authorization successful')
       all_conversions = """{"kind": "dfareporting#conversionsBatchInsertRequest", "conversions": ["""
       while currentrow < len(rows):
+          serialize_start = time.perf_counter()
           for row in rows[currentrow:min(currentrow+100, len(rows))]:
               conversion = json.dumps({
                   'kind': 'dfareporting#conversion',
@@ -202,28 +420,32 @@ def upload_data(timezone, rows, profile_id, fl_configuration_id, fl_activity_id)
               all_conversions = all_conversions + conversion + ','
           all_conversions = all_conversions[:-1] + ']}'
           payload = json.loads(all_conversions)
-          print(f'CM360 request payload: {payload}')
+          observe('serialize', time.perf_counter() - serialize_start)
+          log_payload('CM360 request payload', payload)
           request = service.conversions().batchinsert(profileId=profile_id, body=payload)
-          print('[{}] - CM360 API Request: '.format(time_now_str(timezone)), request)
-          response = request.execute()
-          print('[{}] - CM360 API Response: '.format(time_now_str(timezone)), response)
-          if not response['hasFailures']:
-              print('Successfully inserted batch of 100.')
-          else:
-              status = response['status']
-              for line in status:
-                  try:
-                      if line['errors']:
-                          for error in line['errors']:
-                              print('Error in line ' + json.dumps(line['conversion']))
-                              print('\t[%s]: %s' % (error['code'], error['message']))
-                  except:
-                      print('Conversion with gclid ' + line['gclid'] + ' inserted.')
-          print('Either finished or found errors.')
+          increment('api_calls')
+          with timer('api_call'):
+              response = request.execute()
+          log_payload('CM360 API response', response)
+          failed = 0
+          if response['hasFailures']:
+              # only the failed lines are logged, accepted ones are counted
+              for line in response['status']:
+                  if line.get('errors'):
+                      failed += 1
+                      for error in line['errors']:
+                          log('Error in line', 'WARNING', code=error['code'], error=error['message'],
+                              gclid=line['conversion']['gclid'], ordinal=line['conversion']['ordinal'])
+          increment('conversions_uploaded', len(payload['conversions']) - failed)
+          increment('conversions_failed', failed)
+          counts['uploaded'] += len(payload['conversions']) - failed
+          counts['failed'] += failed
           currentrow += 100
           all_conversions = """{"kind": "dfareporting#conversionsBatchInsertRequest", "conversions": ["""
     except Exception as e:
-        print(f'Error: {str(e)}')
+        log(f'Error: {str(e)}', 'ERROR')
+        counts['unsent'] = len(rows) - currentrow
+    return counts
 
 def partition_and_distribute(cloud_client, table_ref_name, batch_size, timezone, 
                              profile_id, fl_configuration_id, fl_activity_id):
@@ -238,32 +460,139 @@ def partition_and_distribute(cloud_client, table_ref_name, batch_size, timezone,
         fl_configuration_id(:obj:`str`): Floodlight config id - should be gathered from the CM360
         fl_activity_id(:obj:`str`): Floodlight activity id - should be gathered from the CM360
     """
-    for batch in get_data(table_ref_name, cloud_client, batch_size):
-        # print(f'Batch size: {len(batch)} batch: {batch}')
+    fetch_data = get_data_arrow if PB_FETCH_MODE == 'arrow' else get_data
+    for batch in fetch_data(table_ref_name, cloud_client, batch_size):
+        log_payload('Uploading batch', batch, rows=len(batch))
         upload_data(timezone, batch, profile_id, fl_configuration_id, 
                     fl_activity_id)
         # DEBUG BREAK!
         if batch_size == 1:
             break
+    log('Upload finished', client_cache=PB_CLIENT_CACHE_STATS)
 
-def push_conversion():
+def fresh_table(bq_client):
+    """Returns the transformed table when it was refreshed today
+    Args:
+        bq_client(:obj:`google.cloud.bigquery.client.Client`): BigQuery client
+    Returns:
+      Table: the table, None when it is missing or stale
+    """
     try: 
-        bq_client = bigquery.Client(project=PB_GCP_PROJECT)
         table = bq_client.get_table(f'{PB_DS_BUSINESS_DATA}.{PB_CM360_TABLE}')
     except:
-        print ('Could not find table with the provided table name: {}.'.format(f'{PB_DS_BUSINESS_DATA}.{PB_CM360_TABLE}'))    
-        table = None
+        log('Could not find table with the provided table name: {}.'.format(f'{PB_DS_BUSINESS_DATA}.{PB_CM360_TABLE}'), 'ERROR')
+        log('Table not found! Please double check your workflow for any errors.', 'ERROR')
+        return None
 
     todays_date = today_date(PB_TIMEZONE)
+    table_ref_name = table.full_table_id.replace(':', '.')
+    if table.modified.date() == todays_date or table.created.date() == todays_date:
+        log('[{}] is up-to-date. Continuing with upload...'.format(table_ref_name))
+        return table
+    log('[{}] data may be stale. Please check workflow to verfiy that it has run correctly. Upload is aborted!'.format(table_ref_name), 'WARNING')
+    return None
 
+def push_conversion():
+    reset_metrics()
+    bq_client = bigquery.Client(project=PB_GCP_PROJECT)
+    table = fresh_table(bq_client)
     if table is not None:
         table_ref_name = table.full_table_id.replace(':', '.')
-        if table.modified.date() == todays_date or table.created.date() == todays_date:
-            print('[{}] is up-to-date. Continuing with upload...'.format(table_ref_name))
-            partition_and_distribute(bq_client, table_ref_name, PB_BATCH_SIZE,
-                                    PB_TIMEZONE, PB_CM360_PROFILE_ID, 
-                                    PB_CM360_FL_CONFIG_ID, PB_CM360_FL_ACTIVITY_ID) 
-        else:
-            print('[{}] data may be stale. Please check workflow to verfiy that it has run correctly. Upload is aborted!'.format(table_ref_name))
-    else:
-        print('Table not found! Please double check your workflow for any errors.')
\ No newline at end of file
+        partition_and_distribute(bq_client, table_ref_name, PB_BATCH_SIZE,
+                                PB_TIMEZONE, PB_CM360_PROFILE_ID, 
+                                PB_CM360_FL_CONFIG_ID, PB_CM360_FL_ACTIVITY_ID) 
+    export_metrics('composer', table=f'{PB_DS_BUSINESS_DATA}.{PB_CM360_TABLE}')
+
+def plan_shards():
+    """Splits the transformed table into slices of PB_SHARD_ROWS rows, the
+      map step of the DAG. Nothing is planned when the table is missing or stale.
+    Returns:
+      list: one {'shard': descriptor} per slice, the keyword arguments of
+        push_conversion_shard
+    """
+    reset_metrics()
+    bq_client = bigquery.Client(project=PB_GCP_PROJECT)
+    table = fresh_table(bq_client)
+    if table is None:
+        return []
+    table_ref_name = table.full_table_id.replace(':', '.')
+    modified = table.modified.isoformat() if table.modified else None
+    shards = [{
+        'table': table_ref_name,
+        'start_index': start_index,
+        'max_results': PB_SHARD_ROWS,
+        'table_modified': modified,
+    } for start_index in range(0, table.num_rows, PB_SHARD_ROWS)]
+    log(f'Planned {len(shards)} shard{pluralize(len(shards))} of {table_ref_name}',
+        table=table_ref_name, num_rows=table.num_rows, shard_rows=PB_SHARD_ROWS)
+    return [{'shard': shard} for shard in shards]
+
+def push_conversion_shard(shard):
+    """Uploads the rows of one slice of the transformed table, one mapped
+      task of the DAG. Raises when a conversion could not be sent, so Airflow
+      retries this slice alone; CM360 deduplicates the conversions uploaded
+      again on their ordinal.
+    Args:
+        shard(:obj:`dict`): A slice planned by plan_shards
+    Returns:
+      dict: the slice start, rows read, conversions uploaded, failed and
+        unsent and the seconds spent
+    """
+    reset_metrics()
+    start = time.perf_counter()
+    bq_client = bigquery.Client(project=PB_GCP_PROJECT)
+    table = bq_client.get_table(shard['table'])
+    modified = table.modified.isoformat() if table.modified else None
+    if modified != shard['table_modified']:
+        # the row order may have changed, the planned slices no longer hold
+        raise ValueError(f"{shard['table']} was modified at {modified}, after the shards "
+                         f"were planned ({shard['table_modified']})")
+    result = {'start_index': shard['start_index'], 'rows': 0,
+              'uploaded': 0, 'failed': 0, 'unsent': 0}
+    fetch_data = get_data_arrow if PB_FETCH_MODE == 'arrow' else get_data
+    for batch in fetch_data(shard['table'], bq_client, PB_BATCH_SIZE,
+                            shard['start_index'], shard['max_results']):
+        log_payload('Uploading batch', batch, rows=len(batch))
+        counts = upload_data(PB_TIMEZONE, batch, PB_CM360_PROFILE_ID,
+                             PB_CM360_FL_CONFIG_ID, PB_CM360_FL_ACTIVITY_ID)
+        result['rows'] += len(batch)
+        for key, value in counts.items():
+            result[key] += value
+    result['seconds'] = time.perf_counter() - start
+    log('Shard upload finished', table=shard['table'], **result)
+    export_metrics('composer', table=shard['table'], start_index=shard['start_index'])
+    if result['unsent']:
+        raise RuntimeError(f"{result['unsent']} conversion{pluralize(result['unsent'])} of the shard "
+                           f"starting at row {shard['start_index']} could not be uploaded")
+    return result
+
+def summarize_shards(shards, results):
+    """Adds up the results of the mapped uploads, the reduce step of the DAG.
+      Runs once every shard is done, failed ones included, and fails when
+      one of them did not finish.
+    Args:
+        shards(:obj:`list`): The slices planned by plan_shards
+        results(:obj:`list`): The results of the push_conversion_shard tasks
+          which succeeded
+    Returns:
+      dict: shards planned and failed, rows, conversions uploaded and failed
+        and the seconds spent by the shards
+    """
+    results = [result for result in (results or []) if result]
+    finished = {result['start_index'] for result in results}
+    failed_shards = sorted(shard['shard']['start_index'] for shard in (shards or [])
+                           if shard['shard']['start_index'] not in finished)
+    summary = {
+        'shards': len(shards or []),
+        'failed_shards': len(failed_shards),
+        'rows': sum(result['rows'] for result in results),
+        'uploaded': sum(result['uploaded'] for result in results),
+        'failed': sum(result['failed'] for result in results),
+        'seconds': sum(result['seconds'] for result in results),
+    }
+    if failed_shards:
+        log(f'{len(failed_shards)} shard{pluralize(len(failed_shards))} failed, clear their push_conversion_shard tasks to retry them',
+            'ERROR', start_indexes=failed_shards, **summary)
+        raise RuntimeError(f'Shards starting at rows {failed_shards} failed')
+    log('Upload finished', **summary)
+    return summary
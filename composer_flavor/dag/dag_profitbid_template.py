@@ -17,12 +17,17 @@ from airflow import DAG
 from airflow.providers.google.cloud.operators.bigquery import BigQueryInsertJobOperator
 from airflow.operators.bash_operator import BashOperator
 from airflow.operators.python import PythonOperator
-from push_conversion import push_conversion
+from airflow.utils.trigger_rule import TriggerRule
+from push_conversion import plan_shards
+from push_conversion import push_conversion_shard
+from push_conversion import summarize_shards
 
 PB_GCP_PROJECT = '<project_id>'
 PB_DS_BUSINESS_DATA ='<business_dataset_name>'
 PB_SP_DATAWRANGLING = '<data_wrangling_sp>'
 PB_DAG_NAME = '<dag_name>'
+# shards of the transformed table uploaded at the same time
+PB_MAX_ACTIVE_SHARDS = 4
 
 dag_args = {
     'start_date': datetime.now(), 
@@ -56,9 +61,24 @@ t1 = BigQueryInsertJobOperator(
     dag=dag
 )
 
+# the table is split into shards of PB_SHARD_ROWS rows (push_conversion.py),
+#   each uploaded by a mapped task retried on its own
 t2 = PythonOperator(
-    task_id='push_conversion',
-    python_callable=push_conversion,
+    task_id='plan_shards',
+    python_callable=plan_shards,
     dag=dag)
 
-t1 >> t2
\ No newline at end of file
+t3 = PythonOperator.partial(
+    task_id='push_conversion_shard',
+    python_callable=push_conversion_shard,
+    max_active_tis_per_dag=PB_MAX_ACTIVE_SHARDS,
+    dag=dag).expand(op_kwargs=t2.output)
+
+t4 = PythonOperator(
+    task_id='summarize_shards',
+    python_callable=summarize_shards,
+    op_kwargs={'shards': t2.output, 'results': t3.output},
+    trigger_rule=TriggerRule.ALL_DONE,
+    dag=dag)
+
+t1 >> t2 >> t3 >> t4
\ No newline at end of file
@@ -139,7 +139,7 @@ CLIENT_MARGIN_DATA_FILE_NAME="client_profit.csv"
 CLIENT_MARGIN_DATA_FILE_WITH_PATH=`echo $HOME`/$CLIENT_MARGIN_DATA_FILE_NAME
 COMPOSER_LOCATION="us-central1"
 COMPOSER_NAME=$SOLUTION_PREFIX"composer"
-COMPOSER_VERSION="composer-2.0.18-airflow-2.2.5"
+COMPOSER_VERSION="composer-2.0.32-airflow-2.3.4"
 SA_ROLES="roles/bigquery.user roles/bigquery.jobUser roles/composer.worker roles/composer.ServiceAgentV2Ext roles/iam.serviceAccountTokenCreator"
 DAG_ID=$SOLUTION_PREFIX"pipeline"
 
@@ -303,6 +303,7 @@ CONVERSION_TABLE_NAME="p_Conversion_"$SQL_TRANSFORM_ADVERTISER_ID
 
 SA360_PUSH_CONVERSION_PY_TEMPLATE_FILE="SA360_push_conversion_template.py"
 SA360_PUSH_CONVERSION_PY_FILE="push_conversion.py"
+INSTRUMENTATION_PY_FILE="instrumentation.py"
 
 COMPOSER_DAG_TEMPLATE_FILE="dag_profitbid_template.py"
 COMPOSER_DAG_FILE="dag_profitbid.py"
@@ -586,6 +587,11 @@ function deploy_code_dag {
         --environment $COMPOSER_NAME \
         --location $COMPOSER_LOCATION \
         --source="${SA360_PUSH_CONVERSION_PY_FILE}"
+    # push_conversion.py imports the shared instrumentation helpers
+    maybe_run gcloud beta composer environments storage dags import \
+        --environment $COMPOSER_NAME \
+        --location $COMPOSER_LOCATION \
+        --source="${INSTRUMENTATION_PY_FILE}"
     # create the dag file from the tempalte
     pushd dag
     prepare_dag_py
@@ -723,7 +729,7 @@ function delete_composer_dag {
     if test -z "$RETVAL"; then
       echo "${composer_name} storage account doesn't exists."
     else
-      echo "Deleting ${SA360_PUSH_CONVERSION_PY_FILE} and ${COMPOSER_DAG_FILE}..."
+      echo "Deleting ${SA360_PUSH_CONVERSION_PY_FILE}, ${INSTRUMENTATION_PY_FILE} and ${COMPOSER_DAG_FILE}..."
       maybe_run gcloud composer environments storage \
         dags delete gs://${RETVAL}/dags/${SA360_PUSH_CONVERSION_PY_FILE} \
         --environment=${composer_name} \
@@ -731,6 +737,12 @@ function delete_composer_dag {
         --quiet
       #backup when composer takes a long time to delete; handy in development phase
       maybe_run gsutil rm gs://${RETVAL}/dags/${SA360_PUSH_CONVERSION_PY_FILE}
+      maybe_run gcloud composer environments storage \
+        dags delete gs://${RETVAL}/dags/${INSTRUMENTATION_PY_FILE} \
+        --environment=${composer_name} \
+        --location=${COMPOSER_LOCATION} \
+        --quiet
+      maybe_run gsutil rm gs://${RETVAL}/dags/${INSTRUMENTATION_PY_FILE}
       maybe_run gcloud composer environments storage \
         dags delete gs://${RETVAL}/dags/${COMPOSER_DAG_FILE} \
         --environment=${composer_name} \
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Checkpoints of the runs that do not fit in one invocation.
+#
+# Every source row carries its offset in the listing of the table (or in the
+# results of the query) the run reads. Once every batch up to a message is
+# published, the offset after the last row of that message and the id of the
+# next batch are saved: as soon as the first message is published, then at
+# most every CHECKPOINT_INTERVAL_SECONDS. A run stopping before the function
+# times out saves its last offset and is resumed from there, the listing
+# being read again from that offset, so no published row is sent twice. A
+# run killed by the timeout resumes from its last save instead: the messages
+# published since, up to CHECKPOINT_INTERVAL_SECONDS of them, are sent again.
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+
+from instrumentation import increment
+from watermark import state_key
+
+# extra key every source row of a checkpointed run carries, dropped before publish
+OFFSET_FIELD = 'sourceOffset'
+# BigQuery keeps the results of a query for about a day
+RESULTS_MAX_AGE = datetime.timedelta(hours=23)
+
+
+def new_checkpoint(rows, table_ref_name, table_modified, incremental=False):
+    """The checkpoint at the start of a run reading rows.
+
+    A run reading query results resumes from the results of its first
+    invocation, a run reading the table from the table itself.
+    """
+    job_id = getattr(rows, 'job_id', None)
+    if job_id:
+        source = {'job_id': job_id, 'location': getattr(rows, 'location', None)}
+    else:
+        source = {'table': table_ref_name}
+    return {
+        'source': source,
+        'offset': 0,
+        'batch_id': 0,
+        'incremental': incremental,
+        'table_modified': table_modified.isoformat(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+    }
+
+
+def is_resumable(checkpoint, table_modified, incremental=False):
+    """Whether the rows a checkpoint points into are still the rows of the run."""
+    if checkpoint['incremental'] != incremental:
+        return False
+    if 'job_id' in checkpoint['source']:
+        age = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(checkpoint['created_at'])
+        if age > RESULTS_MAX_AGE:
+            return False
+    # incremental runs read a snapshot of the rows after the watermark, rows
+    # landing since then are read by the next run; other runs restart when
+    # the table was rewritten
+    return incremental or checkpoint['table_modified'] == table_modified.isoformat()
+
+
+def resumed_rows(cloud_client, checkpoint, selected_fields=None):
+    """The rows of a run after its checkpoint."""
+    source = checkpoint['source']
+    if 'job_id' in source:
+        job = cloud_client.get_job(source['job_id'], location=source['location'])
+        return job.result(start_index=checkpoint['offset'])
+    return cloud_client.list_rows(source['table'], selected_fields=selected_fields,
+                                  start_index=checkpoint['offset'])
+
+
+class OffsetRow(object):
+    """A source row with its offset as an extra key.
+
+    Wraps the row instead of copying it, Row.items() deep copies every value.
+    """
+
+    __slots__ = ('row', 'offset')
+
+    def __init__(self, row, offset):
+        self.row = row
+        self.offset = offset
+
+    def get(self, key, default=None):
+        if key == OFFSET_FIELD:
+            return self.offset
+        return self.row.get(key, default)
+
+    def __getitem__(self, key):
+        if key == OFFSET_FIELD:
+            return self.offset
+        return self.row[key]
+
+    def keys(self):
+        return list(self.row.keys()) + [OFFSET_FIELD]
+
+    def items(self):
+        return [(key, self.get(key)) for key in self.keys()]
+
+
+class OffsetRows(object):
+    """Source rows, row by row or as Arrow record batches, with their offset."""
+
+    def __init__(self, rows, start):
+        self.rows = rows
+        self.start = start
+
+    def __iter__(self):
+        for offset, row in enumerate(self.rows, self.start):
+            yield OffsetRow(row, offset)
+
+    def to_arrow_iterable(self):
+        import pyarrow as pa
+        offset = self.start
+        for record_batch in self.rows.to_arrow_iterable():
+            offsets = pa.array(range(offset, offset + record_batch.num_rows), pa.int64())
+            offset += record_batch.num_rows
+            yield pa.RecordBatch.from_arrays(
+                record_batch.columns + [offsets], names=record_batch.schema.names + [OFFSET_FIELD])
+
+
+class FileCheckpointStore(object):
+    """Checkpoints of every table/topic in one JSON file, replaced atomically."""
+
+    def __init__(self, path):
+        self.path = path
+        # jobs running in parallel save through the same store
+        self._lock = threading.Lock()
+
+    def load_all(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def write_all(self, checkpoints):
+        with open(self.path + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoints, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self, table_ref_name, topic, scope=None):
+        with self._lock:
+            return self.load_all().get(state_key(table_ref_name, topic, scope))
+
+    def save(self, table_ref_name, topic, checkpoint, scope=None):
+        with self._lock:
+            checkpoints = self.load_all()
+            checkpoints[state_key(table_ref_name, topic, scope)] = dict(
+                checkpoint, updated_at=datetime.datetime.utcnow().isoformat())
+            self.write_all(checkpoints)
+
+    def delete(self, table_ref_name, topic, scope=None):
+        with self._lock:
+            checkpoints = self.load_all()
+            if checkpoints.pop(state_key(table_ref_name, topic, scope), None) is not None:
+                self.write_all(checkpoints)
+
+
+class GcsCheckpointStore(object):
+    """One object per table/topic, under a prefix of a Cloud Storage bucket.
+
+    Invocations run on different instances, so the checkpoints of the
+    deployed function have to live outside of the instance.
+    """
+
+    def __init__(self, bucket_name, prefix='', storage_client=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip('/')
+        self.storage_client = storage_client
+
+    def blob(self, table_ref_name, topic, scope=None):
+        if self.storage_client is None:
+            from google.cloud import storage
+            self.storage_client = storage.Client()
+        # filters are SQL, the object name is a hash of the key
+        name = hashlib.sha1(state_key(table_ref_name, topic, scope).encode('utf-8')).hexdigest() + '.json'
+        return self.storage_client.bucket(self.bucket_name).blob(f'{self.prefix}/{name}' if self.prefix else name)
+
+    def load(self, table_ref_name, topic, scope=None):
+        blob = self.blob(table_ref_name, topic, scope)
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_bytes())
+
+    def save(self, table_ref_name, topic, checkpoint, scope=None):
+        checkpoint = dict(checkpoint, key=state_key(table_ref_name, topic, scope),
+                          updated_at=datetime.datetime.utcnow().isoformat())
+        self.blob(table_ref_name, topic, scope).upload_from_string(
+            json.dumps(checkpoint), content_type='application/json')
+
+    def delete(self, table_ref_name, topic, scope=None):
+        blob = self.blob(table_ref_name, topic, scope)
+        if blob.exists():
+            blob.delete()
+
+
+def checkpoint_store_from_uri(uri):
+    """file:///path.json, gs://bucket/prefix or empty for runs without checkpoints."""
+    if not uri:
+        return None
+    if uri.startswith('file://'):
+        return FileCheckpointStore(uri[len('file://'):])
+    if uri.startswith('gs://'):
+        bucket_name, _, prefix = uri[len('gs://'):].partition('/')
+        return GcsCheckpointStore(bucket_name, prefix)
+    raise ValueError(f'Unsupported checkpoint store: {uri}')
+
+
+class CheckpointTracker(object):
+    """Follows the offset up to which every batch of a run is published.
+
+    Batches are acknowledged in any order; the checkpoint only moves over the
+    longest run of batches that were all published, the way the watermark
+    does. Acknowledgements come from the publisher threads, the checkpoint is
+    saved from the thread reading the table.
+
+    Args:
+        store: The checkpoint store.
+        key(:obj:`tuple`): table_ref_name, topic and scope of the run.
+        checkpoint(:obj:`dict`): The checkpoint the run starts from.
+        interval(:obj:`float`): Min seconds between two saves, 0 saves as
+          soon as the checkpoint moves. The first save is not delayed.
+        watermark_tracker: The WatermarkTracker of an incremental run, its
+          state is saved with the checkpoint.
+    """
+
+    def __init__(self, store, key, checkpoint, interval=0.0, watermark_tracker=None):
+        self.store = store
+        self.key = key
+        self.checkpoint = checkpoint
+        self.interval = interval
+        self.watermark_tracker = watermark_tracker
+        self.offset = checkpoint['offset']
+        self.batch_id = checkpoint['batch_id']
+        self.row_offsets = {}
+        self.batch_ends = {}
+        self.published = set()
+        self.saved_offset = self.offset
+        # None until the first save, which is made as soon as the offset moves
+        self.saved_at = None
+        self._lock = threading.Lock()
+
+    def strip(self, batches):
+        # moves the offset column out of the rows
+        for batch in batches:
+            for row in batch:
+                self.row_offsets[id(row)] = row.pop(OFFSET_FIELD)
+            yield batch
+
+    def track(self, rows, offsets):
+        """Offsets of rows whose offset column was moved out by the caller."""
+        for row, offset in zip(rows, offsets):
+            self.row_offsets[id(row)] = offset
+
+    def add_batch(self, batch_id, rows):
+        """Called before the batch is published."""
+        end = self.row_offsets[id(rows[-1])] + 1
+        for row in rows:
+            self.row_offsets.pop(id(row), None)
+        with self._lock:
+            self.batch_ends[batch_id] = end
+
+    def acknowledge(self, batch_id):
+        """Called by the publisher once a batch is published."""
+        with self._lock:
+            self.published.add(batch_id)
+            while self.batch_id in self.published:
+                self.published.discard(self.batch_id)
+                self.offset = self.batch_ends.pop(self.batch_id)
+                self.batch_id += 1
+
+    def state(self):
+        with self._lock:
+            state = dict(self.checkpoint, offset=self.offset, batch_id=self.batch_id)
+            published = set(range(self.checkpoint['batch_id'], self.batch_id)) | self.published
+        if self.watermark_tracker is not None:
+            state['watermark'] = self.watermark_tracker.advance(published)
+        return state
+
+    def save(self, force=False):
+        """Saves the checkpoint if it moved, at most every interval seconds.
+
+        Returns:
+          dict: the checkpoint saved, None if it was not due
+        """
+        if not force and (self.offset == self.saved_offset or (
+                self.saved_at is not None and time.monotonic() - self.saved_at < self.interval)):
+            return None
+        state = self.state()
+        table_ref_name, topic, scope = self.key
+        self.store.save(table_ref_name, topic, state, scope=scope)
+        self.saved_offset = state['offset']
+        self.saved_at = time.monotonic()
+        increment('checkpoints_saved')
+        return state
+
+    def delete(self):
+        table_ref_name, topic, scope = self.key
+        self.store.delete(table_ref_name, topic, scope=scope)
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Timers, counters and structured logs shared by the pipeline functions.
+#
+# Metrics stay in memory during an invocation and are exported once at the
+# end: as one JSON line on stdout, which Cloud Logging and Airflow keep as a
+# structured entry, or appended to a local NDJSON file. Log lines are JSON
+# too. Payload logging (whole batches, requests, responses) is sampled and
+# off by default; the payload is only formatted when the sample is taken.
+#
+# The same file is copied next to every function that uses it.
+
+import contextlib
+import datetime
+import json
+import math
+import os
+import random
+import threading
+import time
+
+# log (default), file:///path/metrics.ndjson or off
+METRICS_EXPORT = os.getenv('METRICS_EXPORT', 'log')
+# share of the payloads logged, 0 (default) to 1
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0'))
+# durations kept per timer for the percentiles, a uniform sample past that
+MAX_TIMER_SAMPLES = 10000
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+
+class Metrics(object):
+    """Counters and timers of one invocation, safe to update from threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+            self.started = time.perf_counter()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'samples': []}
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            if len(timer['samples']) < MAX_TIMER_SAMPLES:
+                timer['samples'].append(seconds)
+            else:
+                # reservoir sampling keeps every duration equally likely
+                slot = self._random.randrange(timer['count'])
+                if slot < MAX_TIMER_SAMPLES:
+                    timer['samples'][slot] = seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        with self._lock:
+            timers = {}
+            for name, timer in self.timers.items():
+                samples = sorted(timer['samples'])
+                timers[name] = {
+                    'count': timer['count'],
+                    'total_seconds': round(timer['total'], 6),
+                    'p50_seconds': round(percentile(samples, 0.50), 6),
+                    'p95_seconds': round(percentile(samples, 0.95), 6),
+                    'p99_seconds': round(percentile(samples, 0.99), 6),
+                    'max_seconds': round(timer['max'], 6),
+                }
+            return {
+                'elapsed_seconds': round(time.perf_counter() - self.started, 6),
+                'counters': dict(self.counters),
+                'timers': timers,
+            }
+
+
+METRICS = Metrics()
+
+
+def reset_metrics():
+    """Starts the metrics of a new invocation, warm instances reuse the module."""
+    METRICS.reset()
+
+
+def increment(name, value=1):
+    METRICS.increment(name, value)
+
+
+def observe(name, seconds):
+    METRICS.observe(name, seconds)
+
+
+def timer(name):
+    return METRICS.timer(name)
+
+
+def log(message, severity='INFO', **fields):
+    entry = {'severity': severity, 'message': message}
+    entry.update(fields)
+    print(json.dumps(entry, default=str))
+
+
+def payload_sampled():
+    return PAYLOAD_LOG_SAMPLE_RATE > 0 and random.random() < PAYLOAD_LOG_SAMPLE_RATE
+
+
+def log_payload(message, payload, severity='DEBUG', **fields):
+    """Logs a payload for a sample of the calls. payload may be a callable
+    building it, so nothing is formatted when the sample is skipped."""
+    if not payload_sampled():
+        return
+    log(message, severity, payload=payload() if callable(payload) else payload, **fields)
+
+
+def export_metrics(component, **labels):
+    """Writes the metrics of the invocation and returns them."""
+    summary = METRICS.summary()
+    summary.update(labels)
+    summary['component'] = component
+    if METRICS_EXPORT == 'off':
+        return summary
+    if METRICS_EXPORT.startswith('file://'):
+        summary['exported_at'] = datetime.datetime.utcnow().isoformat()
+        with open(METRICS_EXPORT[len('file://'):], 'a') as metrics_file:
+            metrics_file.write(json.dumps(summary, default=str) + '\n')
+    else:
+        log(f'{component} metrics', metrics=summary)
+    return summary
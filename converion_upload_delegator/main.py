@@ -15,27 +15,146 @@
 # limitations under the License.
 
 import base64
+import collections
 import datetime
-import decimal
 import json
 import logging
 import os
+import threading
+import time
 import pytz
 
+from concurrent import futures
 from io import StringIO
 
-from googleapiclient import errors
+from checkpoint import CheckpointTracker
+from checkpoint import OFFSET_FIELD
+from checkpoint import OffsetRows
+from checkpoint import checkpoint_store_from_uri
+from checkpoint import is_resumable
+from checkpoint import new_checkpoint
+from checkpoint import resumed_rows
+from instrumentation import export_metrics
+from instrumentation import increment
+from instrumentation import log
+from instrumentation import log_payload
+from instrumentation import observe
+from instrumentation import reset_metrics
+from instrumentation import timer
+from partitioner import MessagePartitioner
+from pipelined_publisher import PipelinedPublisher
+from scheduler import PriorityScheduler
+from scheduler import parse_tiers
+from shards import REQUIRED_KEYS
+from shards import count_query
+from shards import destination_fields
+from shards import normalize_row
+from shards import plan_hash_shards
+from shards import plan_range_shards
+from shards import record_fields
+from upload_ledger import ledger_from_uri
+from upload_ledger import row_ledger_key
+from watermark import WATERMARK_FIELD
+from watermark import WatermarkTracker
+from watermark import watermark_store_from_uri
+from wire_format import COLUMNAR
+from wire_format import ENCODING_ATTRIBUTE
+from wire_format import encode_columnar
 
-from google.cloud import bigquery
-from google.cloud import pubsub
 
+# Client side batching of the Pub/Sub library
+PUBLISH_MAX_MESSAGES = int(os.getenv('PUBLISH_MAX_MESSAGES', '100'))
+PUBLISH_MAX_BYTES = int(os.getenv('PUBLISH_MAX_BYTES', str(9 * 1024 * 1024)))
+PUBLISH_MAX_LATENCY = float(os.getenv('PUBLISH_MAX_LATENCY', '0.05'))
+# Caps on messages published but not yet acknowledged by Pub/Sub
+PUBLISH_MAX_IN_FLIGHT_MESSAGES = int(os.getenv('PUBLISH_MAX_IN_FLIGHT_MESSAGES', '100'))
+PUBLISH_MAX_IN_FLIGHT_BYTES = int(os.getenv('PUBLISH_MAX_IN_FLIGHT_BYTES', str(200 * 1024 * 1024)))
 
-# Instantiates a Pub/Sub client
-publisher = pubsub.PublisherClient()
+# Clients are created on first use and kept by warm instances; their
+# libraries (and pyarrow) are only imported by the functions using them, so
+# a cold start does not pay for them up front
+publisher = None
+bigquery_client = None
+CLIENT_LOCK = threading.Lock()
 PROJECT_ID = os.getenv('GCP_PROJECT')
 # Defaults to America/New_York, please update to 
 # your respective timezone if needed.
 PROJECT_TIMEZONE = os.getenv('TIMEZONE')
+# 'rows' (default) iterates the table row by row, 'arrow' downloads
+# pages as Arrow record batches and normalises them column-wise.
+FETCH_MODE = os.getenv('FETCH_MODE', 'rows')
+# Messages are cut by serialized size: close to the target, never above the
+# max (Pub/Sub allows 10MB) and with at most MESSAGE_MAX_ROWS conversions.
+MESSAGE_TARGET_BYTES = int(os.getenv('MESSAGE_TARGET_BYTES', str(1024 * 1024)))
+MESSAGE_MAX_BYTES = int(os.getenv('MESSAGE_MAX_BYTES', str(9 * 1024 * 1024)))
+MESSAGE_MAX_ROWS = int(os.getenv('MESSAGE_MAX_ROWS', '1000'))
+# 'dicts' (default) publishes the conversions as one object per row, which
+# every upload node reads; 'records' as a field list and one value list per
+# row, once the upload nodes reading the records are deployed
+MESSAGE_FORMAT = os.getenv('MESSAGE_FORMAT', 'dicts')
+# 'columnar' publishes the compact records column by column in the binary
+# layout of wire_format.py, compressed with MESSAGE_COMPRESSION (zlib, zstd
+# or none); 'json' (default) for upload nodes without wire_format.py
+MESSAGE_ENCODING = os.getenv('MESSAGE_ENCODING', 'json')
+MESSAGE_COMPRESSION = os.getenv('MESSAGE_COMPRESSION', 'zlib')
+# Conversions accepted by CM360/SA360 are recorded by the upload nodes in
+# this ledger (sqlite:///path or bq://project.dataset.table) and skipped here
+UPLOAD_LEDGER = os.getenv('UPLOAD_LEDGER', '')
+# Incremental mode ("mode": "incremental" in the payload) only reads rows at
+# or after the high-water mark kept in WATERMARK_STORE (file:///path.json or
+# bq://project.dataset.table) and moves it once they are published.
+WATERMARK_STORE = os.getenv('WATERMARK_STORE', '')
+WATERMARK_COLUMN = os.getenv('WATERMARK_COLUMN', 'conversionTimestamp')
+# Also re-reads rows this far behind the mark, for rows landing late; pair
+# it with UPLOAD_LEDGER so the overlap is not uploaded twice
+WATERMARK_LOOKBACK_SECONDS = int(os.getenv('WATERMARK_LOOKBACK_SECONDS', '0'))
+# Advertiser jobs of a "jobs" payload processed in parallel
+DELEGATOR_MAX_WORKERS = int(os.getenv('DELEGATOR_MAX_WORKERS', '4'))
+# With "delivery": "shards" only descriptors of table slices of about
+# SHARD_ROWS rows are published, the upload nodes read the rows themselves
+SHARD_ROWS = int(os.getenv('SHARD_ROWS', '5000'))
+# With CHECKPOINT_STORE (file:///path.json or gs://bucket/prefix) a run saves
+# how far it got once its messages are published, stops publishing
+# CHECKPOINT_MARGIN_SECONDS before the FUNCTION_TIMEOUT_SECONDS of the
+# deployment and publishes its payload again to DELEGATOR_TOPIC, the topic
+# triggering the delegator, so the next invocation resumes the run
+CHECKPOINT_STORE = os.getenv('CHECKPOINT_STORE', '')
+CHECKPOINT_INTERVAL_SECONDS = float(os.getenv('CHECKPOINT_INTERVAL_SECONDS', '1'))
+CHECKPOINT_MARGIN_SECONDS = int(os.getenv('CHECKPOINT_MARGIN_SECONDS', '60'))
+CHECKPOINT_MAX_RESUMES = int(os.getenv('CHECKPOINT_MAX_RESUMES', '20'))
+FUNCTION_TIMEOUT_SECONDS = int(os.getenv('FUNCTION_TIMEOUT_SECONDS', '540'))
+DELEGATOR_TOPIC = os.getenv('DELEGATOR_TOPIC', '')
+# With "schedule": "priority" the rows are published by the tiers of
+# PRIORITY_TIERS (JSON, see scheduler.py), by hours left in the
+# PRIORITY_LOOKBACK_DAYS attribution window and PRIORITY_VALUE_COLUMN, and
+# a run stops after PRIORITY_QUOTA_ROWS conversions ("quota_rows" in the
+# payload, 0 for no limit), leaving the rest to the next run
+PRIORITY_TIERS = os.getenv('PRIORITY_TIERS', '')
+PRIORITY_QUOTA_ROWS = int(os.getenv('PRIORITY_QUOTA_ROWS', '0'))
+PRIORITY_LOOKBACK_DAYS = float(os.getenv('PRIORITY_LOOKBACK_DAYS', '30'))
+PRIORITY_VALUE_COLUMN = os.getenv('PRIORITY_VALUE_COLUMN', 'conversionRevenue')
+
+def get_publisher():
+    global publisher
+    with CLIENT_LOCK:
+        if publisher is None:
+            from google.cloud import pubsub
+            publisher = pubsub.PublisherClient(
+                batch_settings=pubsub.types.BatchSettings(
+                    max_messages=PUBLISH_MAX_MESSAGES,
+                    max_bytes=PUBLISH_MAX_BYTES,
+                    max_latency=PUBLISH_MAX_LATENCY))
+    return publisher
+
+
+def get_bigquery_client():
+    global bigquery_client
+    with CLIENT_LOCK:
+        if bigquery_client is None:
+            from google.cloud import bigquery
+            bigquery_client = bigquery.Client(project=PROJECT_ID)
+    return bigquery_client
+
 
 def today_date():
     tz = pytz.timezone(PROJECT_TIMEZONE)
@@ -54,55 +173,66 @@ def get_dataset(dataset_name, table_name, cloud_client):
     except:
         raise ValueError('Could not find table with the provided table name: {}.'.format(f'{dataset_name}.{table_name}'))    
 
-# Publishes a message to a Cloud Pub/Sub topic.
-def publish(data, topic_name, config):
-    if not topic_name or not data:
-        print('Missing "topic" and/or "data" parameter.')
-        return
-
-    print('Publishing message to topic {}'.format(topic_name))
-
-    # References an existing topic
-    topic_path = publisher.topic_path(PROJECT_ID, topic_name)
-
-    conversion_data = data
-
+def build_message(data, config, fields=None):
     message = {'data': None}
     # setup message data appropriately
-    if config:
+    if fields is not None:
+        # compact records, the values of every row in the order of fields
         message['data'] = {
-            'conversions': conversion_data,
-            'config': config
+            'fields': fields,
+            'rows': [[row.get(field) for field in fields] for row in data]
         }
     else:
         message['data'] = {
-            'conversions': conversion_data
+            'conversions': data
         }
+    if config:
+        message['data']['config'] = config
+    return json.dumps(message).encode('utf-8')
+
 
-    message_json = json.dumps(message)
-    message_bytes = message_json.encode('utf-8')
+# Publishes a message to a Cloud Pub/Sub topic. With a pipeline the message
+# is only queued, its outcome is reported by pipeline.flush().
+def publish(data, topic_name, config, pipeline=None, batch_id=None):
+    if not topic_name or not data:
+        log('Missing "topic" and/or "data" parameter.', 'WARNING')
+        return
+
+    message_bytes = build_message(data, config)
+    if pipeline is not None:
+        pipeline.publish(message_bytes, batch_id)
+        return
+
+    log('Publishing message', topic=topic_name)
+
+    # References an existing topic
+    publisher = get_publisher()
+    topic_path = publisher.topic_path(PROJECT_ID, topic_name)
     # Publishes a message
     try:
-        publish_future = publisher.publish(topic_path, data=message_bytes)
-        res = publish_future.result()  # Verify the publish succeeded
-        print('Message published to: {}'.format(res))
+        with timer('publish'):
+            publish_future = publisher.publish(topic_path, data=message_bytes)
+            res = publish_future.result()  # Verify the publish succeeded
+        log('Message published', message_id=res)
     except Exception as e:
-        print('Exception found: {}'.format(e))
+        log(f'Exception found: {e}', 'ERROR')
 
 
-REQUIRED_KEYS = [
-    'conversionId',
-    'conversionQuantity',
-    'conversionRevenue',
-    'conversionTimestamp',
-    'conversionVisitExternalClickId',
-]
-def get_data(table_ref_name, cloud_client, batch_size):
+def get_data(table_ref_name, cloud_client, batch_size, uploaded_keys=None, destination=None, rows=None,
+             selected_fields=None):
     current_batch = []
     table = cloud_client.get_table(table_ref_name)
-    print(f'Downloading {table.num_rows} rows from table {table_ref_name}')
+    log('Downloading rows', table=table_ref_name, num_rows=table.num_rows)
     skip_stats = {}
-    for row in cloud_client.list_rows(table_ref_name):
+    already_uploaded = 0
+    if rows is None:
+        rows = cloud_client.list_rows(table_ref_name, selected_fields=selected_fields)
+    # per batch: fetch is the time spent reading and checking rows, transform
+    # the time spent converting them
+    batch_start = time.perf_counter()
+    transform_seconds = 0.0
+    for row in rows:
+        increment('rows_read')
         missing_keys = []
         for key in REQUIRED_KEYS:
             val = row.get(key)
@@ -115,26 +245,128 @@ def get_data(table_ref_name, cloud_client, batch_size):
             row_as_dict = dict(row.items())
             logging.debug(f'Skipped row: missing values for keys {missing_keys} in row {row_as_dict}')
             continue
-        result = {}
-        conversionTimestamp = row.get('conversionTimestamp')
-        # convert floating point seconds to microseconds since the epoch
-        result['conversionTimestampMicros'] = int(conversionTimestamp.timestamp() * 1_000_000)
-        for key in row.keys():
-            value = row.get(key)
-            if type(value) == datetime.datetime or type(value) == datetime.date:
-                result[key] = value.strftime("%y-%m-%d ")
-            elif type(value) == decimal.Decimal:
-                result[key] = float(value)
-            else:
-                result[key] = value
-        current_batch.append(result)
+        if uploaded_keys is not None and row_ledger_key(row, destination) in uploaded_keys:
+            already_uploaded += 1
+            continue
+        transform_start = time.perf_counter()
+        current_batch.append(normalize_row(row))
+        transform_seconds += time.perf_counter() - transform_start
         if len(current_batch) >= batch_size:
+            observe('fetch', time.perf_counter() - batch_start - transform_seconds)
+            observe('transform', transform_seconds)
             yield current_batch
             current_batch = []
+            batch_start = time.perf_counter()
+            transform_seconds = 0.0
+    if len(current_batch) > 0:
+        observe('fetch', time.perf_counter() - batch_start - transform_seconds)
+        observe('transform', transform_seconds)
+        yield current_batch
+    log_fetch_stats(table_ref_name, table.num_rows, skip_stats, already_uploaded, uploaded_keys, destination)
+
+
+def arrow_column_values(column):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    # mirrors the per-cell normalisation of normalize_row
+    if pa.types.is_timestamp(column.type) or pa.types.is_date(column.type):
+        return pc.strftime(column, format="%y-%m-%d ").to_pylist()
+    if pa.types.is_decimal(column.type):
+        # going through the exact decimal string keeps float(Decimal) rounding
+        return pc.cast(pc.cast(column, pa.string()), pa.float64()).to_pylist()
+    return column.to_pylist()
+
+
+def arrow_timestamp_micros(column):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    # same float arithmetic as int(conversionTimestamp.timestamp() * 1_000_000)
+    micros = pc.cast(pc.cast(column, pa.timestamp('us', column.type.tz)), pa.int64())
+    seconds = pc.divide(pc.cast(micros, pa.float64()), 1_000_000.0)
+    return pc.cast(pc.trunc(pc.multiply(seconds, 1_000_000.0)), pa.int64()).to_pylist()
+
+
+def arrow_batch_to_rows(record_batch, skip_stats):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    names = record_batch.schema.names
+    valid = pa.array([True] * record_batch.num_rows, pa.bool_())
+    for key in REQUIRED_KEYS:
+        if key in names:
+            column = record_batch.column(names.index(key))
+            null_count = column.null_count
+            if null_count:
+                valid = pc.and_(valid, pc.is_valid(column))
+        else:
+            null_count = record_batch.num_rows
+            valid = pa.array([False] * record_batch.num_rows, pa.bool_())
+        if null_count:
+            skip_stats[key] = skip_stats.get(key, 0) + null_count
+    if valid.false_count:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for row_as_dict in record_batch.filter(pc.invert(valid)).to_pylist():
+                missing_keys = [key for key in REQUIRED_KEYS if row_as_dict.get(key) is None]
+                logging.debug(f'Skipped row: missing values for keys {missing_keys} in row {row_as_dict}')
+        record_batch = record_batch.filter(valid)
+    if record_batch.num_rows == 0:
+        return []
+    # conversionTimestampMicros always leads, a column of the same name wins
+    keys = ['conversionTimestampMicros']
+    if 'conversionTimestampMicros' in names:
+        columns = [arrow_column_values(record_batch.column(names.index('conversionTimestampMicros')))]
+    else:
+        columns = [arrow_timestamp_micros(record_batch.column(names.index('conversionTimestamp')))]
+    for index, name in enumerate(names):
+        if name == 'conversionTimestampMicros':
+            continue
+        keys.append(name)
+        columns.append(arrow_column_values(record_batch.column(index)))
+    return [dict(zip(keys, values)) for values in zip(*columns)]
+
+
+def get_data_arrow(table_ref_name, cloud_client, batch_size, uploaded_keys=None, destination=None, rows=None,
+                   selected_fields=None):
+    # Columnar twin of get_data: yields identical batches, but filters and
+    # converts each downloaded page as Arrow columns instead of cell by cell.
+    current_batch = []
+    table = cloud_client.get_table(table_ref_name)
+    log('Downloading rows', table=table_ref_name, num_rows=table.num_rows)
+    skip_stats = {}
+    already_uploaded = 0
+    if rows is None:
+        rows = cloud_client.list_rows(table_ref_name, selected_fields=selected_fields)
+    record_batches = iter(rows.to_arrow_iterable())
+    while True:
+        with timer('fetch'):
+            record_batch = next(record_batches, None)
+        if record_batch is None:
+            break
+        increment('rows_read', record_batch.num_rows)
+        with timer('transform'):
+            rows = arrow_batch_to_rows(record_batch, skip_stats)
+            if uploaded_keys is not None:
+                new_rows = [row for row in rows if row_ledger_key(row, destination) not in uploaded_keys]
+                already_uploaded += len(rows) - len(new_rows)
+                rows = new_rows
+        current_batch.extend(rows)
+        full_rows = len(current_batch) - len(current_batch) % batch_size
+        for start in range(0, full_rows, batch_size):
+            yield current_batch[start:start + batch_size]
+        current_batch = current_batch[full_rows:]
     if len(current_batch) > 0:
         yield current_batch
+    log_fetch_stats(table_ref_name, table.num_rows, skip_stats, already_uploaded, uploaded_keys, destination)
+
+
+def log_fetch_stats(table_ref_name, num_rows, skip_stats, already_uploaded, uploaded_keys, destination):
+    skipped = sum(skip_stats.values())
+    increment('rows_skipped', skipped)
     pretty_skip_stats = ', '.join([f'{val} row{pluralize(val)} missing key "{key}"' for key, val in skip_stats.items()])
-    logging.info(f'Processed {table.num_rows} from table {table_ref_name} skipped {pretty_skip_stats}')
+    log(f'Processed {num_rows} from table {table_ref_name} skipped {pretty_skip_stats}',
+        table=table_ref_name, rows_skipped=skip_stats)
+    if uploaded_keys is not None:
+        increment('rows_already_uploaded', already_uploaded)
+        log(f'Skipped {already_uploaded} row{pluralize(already_uploaded)} already uploaded to {destination}')
 
 
 def pluralize(count):
@@ -143,14 +375,708 @@ def pluralize(count):
     return ''
 
 
-def partition_and_distribute(cloud_client, table_ref_name, topic, config):
+def select_list(columns):
+    return ', '.join(columns) if columns else '*'
+
+
+def incremental_rows(cloud_client, table_ref_name, watermark_micros, row_filter=None, columns=None):
+    from google.cloud import bigquery
+    # rows at or after the watermark, oldest first, with the watermark column
+    # in microseconds as an extra column
+    query = (f'SELECT {select_list(columns)}, UNIX_MICROS({WATERMARK_COLUMN}) AS {WATERMARK_FIELD} '
+             f'FROM `{table_ref_name}`')
+    conditions = []
+    query_parameters = []
+    if watermark_micros is not None:
+        conditions.append(f'{WATERMARK_COLUMN} >= TIMESTAMP_MICROS(@watermark)')
+        query_parameters.append(bigquery.ScalarQueryParameter(
+            'watermark', 'INT64', watermark_micros - WATERMARK_LOOKBACK_SECONDS * 1_000_000))
+    if row_filter:
+        conditions.append(f'({row_filter})')
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += f' ORDER BY {WATERMARK_COLUMN}'
+    log('Reading rows after the watermark', table=table_ref_name, column=WATERMARK_COLUMN,
+        watermark_micros=watermark_micros, filter=row_filter)
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+    return cloud_client.query(query, job_config=job_config).result()
+
+
+def filtered_rows(cloud_client, table_ref_name, row_filter, columns=None):
+    # rows of one advertiser or partition of a table shared by several jobs
+    log('Reading filtered rows', table=table_ref_name, filter=row_filter)
+    return cloud_client.query(
+        f'SELECT {select_list(columns)} FROM `{table_ref_name}` WHERE ({row_filter})').result()
+
+
+def partition_and_distribute(cloud_client, table_ref_name, topic, config, publisher_client=None,
+                             watermark_store=None, delivery='messages', checkpoint_store=None, deadline=None,
+                             payload=None, scheduler=None, destinations=None):
+    reset_metrics()
+    if destinations:
+        if watermark_store is not None or delivery == 'shards' or scheduler is not None:
+            raise ValueError('Several destinations cannot be combined with the incremental mode, '
+                             'the shard delivery or the priority schedule')
+        result = publish_destinations(cloud_client, table_ref_name, destinations, publisher_client,
+                                      checkpoint_store=checkpoint_store, deadline=deadline)
+        topic = ','.join(destination['topic'] for destination in destinations)
+    else:
+        result = publish_table(cloud_client, table_ref_name, topic, config, publisher_client, watermark_store,
+                               delivery=delivery, checkpoint_store=checkpoint_store, deadline=deadline,
+                               scheduler=scheduler)
+    if result.get('interrupted') and payload is not None:
+        retrigger(payload, publisher_client)
+    export_metrics('delegator', table=table_ref_name, topic=topic, delivery=delivery,
+                   mode='full' if watermark_store is None else 'incremental')
+    return result['published'], result['failed']
+
+
+def retrigger(payload, publisher_client=None):
+    """Publishes the payload of a run stopped at its deadline to DELEGATOR_TOPIC.
+
+    The next invocation resumes the run from its checkpoints. "resumes"
+    counts the invocations of the run, a run which still has not finished
+    after CHECKPOINT_MAX_RESUMES of them is left for an operator.
+    """
+    resumes = payload.get('resumes', 0) + 1
+    if not DELEGATOR_TOPIC:
+        log('Run stopped at its deadline, DELEGATOR_TOPIC is not set: publish the payload again to resume it',
+            'WARNING', payload=payload)
+        return
+    if resumes > CHECKPOINT_MAX_RESUMES:
+        log(f'Run stopped at its deadline after {CHECKPOINT_MAX_RESUMES} resumes, not triggered again', 'ERROR',
+            payload=payload)
+        return
+    publisher_client = publisher_client or get_publisher()
+    message_bytes = json.dumps(dict(payload, resumes=resumes)).encode('utf-8')
+    message_id = publisher_client.publish(
+        publisher_client.topic_path(PROJECT_ID, DELEGATOR_TOPIC), data=message_bytes).result()
+    increment('retriggers')
+    log(f'Run stopped at its deadline, triggered again (resume {resumes})', topic=DELEGATOR_TOPIC,
+        message_id=message_id)
+
+
+def priority_scheduler(options):
+    """The PriorityScheduler of a payload or job, None unless its "schedule" is "priority"."""
+    schedule = options.get('schedule', 'table')
+    if schedule == 'table':
+        return None
+    if schedule != 'priority':
+        raise ValueError(f'Unsupported schedule: {schedule}')
+    return PriorityScheduler(parse_tiers(PRIORITY_TIERS), PRIORITY_LOOKBACK_DAYS,
+                             options.get('quota_rows', PRIORITY_QUOTA_ROWS), PRIORITY_VALUE_COLUMN)
+
+
+def build_shard_message(descriptor, config):
+    data = {'shard': descriptor}
+    if config:
+        data['config'] = config
+    return json.dumps({'data': data}).encode('utf-8')
+
+
+def plan_shards(cloud_client, table_ref_name, row_filter=None):
+    from google.cloud import bigquery
+    table = cloud_client.get_table(table_ref_name)
+    if not row_filter:
+        return plan_range_shards(table, table_ref_name, SHARD_ROWS), table.num_rows
+    # the shards of a filtered table are read as of now, rows landing later
+    # do not move rows between shards
+    snapshot_millis = int(time.time() * 1000)
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('snapshot_millis', 'INT64', snapshot_millis)])
+    num_rows = next(iter(cloud_client.query(
+        count_query(table_ref_name, row_filter), job_config=job_config).result()))['num_rows']
+    return plan_hash_shards(table_ref_name, row_filter, num_rows, SHARD_ROWS, snapshot_millis), num_rows
+
+
+def publish_shards(cloud_client, table_ref_name, topic, config, publisher_client=None, row_filter=None):
+    """Publishes shard descriptors of a table instead of its rows.
+    Returns:
+      dict: same as publish_table, the rows being the rows of the shards
+    """
+    start = time.perf_counter()
+    publisher_client = publisher_client or get_publisher()
+    pipeline = PipelinedPublisher(
+        publisher_client,
+        publisher_client.topic_path(PROJECT_ID, topic),
+        max_in_flight_messages=PUBLISH_MAX_IN_FLIGHT_MESSAGES,
+        max_in_flight_bytes=PUBLISH_MAX_IN_FLIGHT_BYTES)
+    with timer('fetch'):
+        descriptors, num_rows = plan_shards(cloud_client, table_ref_name, row_filter)
+    log(f'Publishing {len(descriptors)} shard{pluralize(len(descriptors))} of {num_rows} rows',
+        table=table_ref_name, topic=topic, filter=row_filter)
+    shard_rows = {}
+    for batch_id, descriptor in enumerate(descriptors):
+        log_payload('Publishing shard', descriptor, batch_id=batch_id)
+        if descriptor['kind'] == 'range':
+            shard_rows[batch_id] = min(descriptor['max_results'], num_rows - descriptor['start_index'])
+        else:
+            # spread evenly by the hash, close enough for the summary
+            shard_rows[batch_id] = num_rows / descriptor['shards']
+        pipeline.publish(build_shard_message(descriptor, config), batch_id)
+    published, failed = pipeline.flush()
+    rows_published = round(sum(shard_rows[batch_id] for batch_id in published))
+    rows_failed = round(sum(shard_rows[batch_id] for batch_id in failed))
+    increment('shards_published', len(published))
+    increment('rows_published', rows_published)
+    increment('rows_failed', rows_failed)
+    log(f'Published {len(published)} shards, {len(failed)} failed')
+    return {
+        'published': published,
+        'failed': failed,
+        'rows_published': rows_published,
+        'rows_failed': rows_failed,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def publish_table(cloud_client, table_ref_name, topic, config, publisher_client=None,
+                  watermark_store=None, row_filter=None, uploaded_keys=None, delivery='messages',
+                  checkpoint_store=None, deadline=None, scheduler=None):
+    """Publishes the rows of a table, or the ones matching row_filter, to a topic.
+    Args:
+        uploaded_keys(:obj:`set`): ledger index of the destination, loaded
+          from UPLOAD_LEDGER when not given
+        delivery(:obj:`str`): 'messages' publishes the rows, 'shards' only
+          descriptors of slices of the table
+        checkpoint_store: where the run saves how far it got, and resumes
+          from; None for runs without checkpoints
+        deadline(:obj:`float`): time.time() at which a checkpointed run
+          stops publishing
+        scheduler: the PriorityScheduler of a "schedule": "priority" run,
+          None publishes the rows in table order
+    Returns:
+      dict: published and failed batch ids, rows and messages counts, seconds,
+        whether the run stopped at its deadline and the rows per priority tier
+    """
+    if scheduler is not None:
+        if delivery == 'shards' or watermark_store is not None:
+            raise ValueError('The priority schedule cannot be combined with the shard delivery '
+                             'or the incremental mode')
+        if checkpoint_store is not None:
+            # offsets only follow the rows in table order
+            log('Priority runs are not checkpointed', 'WARNING', table=table_ref_name, topic=topic)
+            checkpoint_store = None
+            deadline = None
+    if delivery == 'shards':
+        if watermark_store is not None:
+            raise ValueError('The shard delivery cannot be combined with the incremental mode')
+        return publish_shards(cloud_client, table_ref_name, topic, config, publisher_client, row_filter)
+    start = time.perf_counter()
     batch_size = 1000
-    for batch in get_data(table_ref_name, cloud_client, batch_size):
-        print(f'Batch size: {len(batch)} batch: {batch}')
-        publish(batch, topic, config)
+    publisher_client = publisher_client or get_publisher()
+    pipeline = PipelinedPublisher(
+        publisher_client,
+        publisher_client.topic_path(PROJECT_ID, topic),
+        max_in_flight_messages=PUBLISH_MAX_IN_FLIGHT_MESSAGES,
+        max_in_flight_bytes=PUBLISH_MAX_IN_FLIGHT_BYTES)
+    # only the CM360 flavour carries a config
+    destination = 'cm360' if config else 'sa360'
+    # only the columns the destination reads are requested and published
+    table = cloud_client.get_table(table_ref_name)
+    selected_fields = destination_fields(table, destination)
+    columns = [field.name for field in selected_fields] if selected_fields is not None else None
+    if scheduler is not None and columns is not None and scheduler.value_field not in columns:
+        raise ValueError(f'The priority value column {scheduler.value_field} is not read for {destination}')
+    fields = None
+    attributes = {}
+    if MESSAGE_FORMAT == 'records' or MESSAGE_ENCODING == COLUMNAR:
+        fields = record_fields(columns or [field.name for field in table.schema])
+    if MESSAGE_ENCODING == COLUMNAR:
+        attributes[ENCODING_ATTRIBUTE] = COLUMNAR
+    partitioner = MessagePartitioner(
+        build_message([], config, fields),
+        target_bytes=MESSAGE_TARGET_BYTES,
+        max_bytes=MESSAGE_MAX_BYTES,
+        max_rows=MESSAGE_MAX_ROWS,
+        fields=fields)
+    if uploaded_keys is None:
+        uploaded_keys = load_uploaded_keys(destination)
+    if scheduler is not None and scheduler.quota_rows and uploaded_keys is None:
+        log('Without UPLOAD_LEDGER the next run publishes the rows of this one again', 'WARNING',
+            table=table_ref_name, topic=topic)
+    rows = None
+    tracker = None
+    checkpoint = None
+    incremental = watermark_store is not None
+    if checkpoint_store is not None:
+        checkpoint = checkpoint_store.load(table_ref_name, topic, scope=row_filter)
+        if checkpoint is not None and not is_resumable(checkpoint, table.modified, incremental):
+            log('Discarding the checkpoint of an earlier run', table=table_ref_name, topic=topic,
+                checkpoint=checkpoint)
+            checkpoint = None
+    if watermark_store is not None:
+        watermark = watermark_store.load(table_ref_name, topic, scope=row_filter)
+        # the watermark of the rows published by the previous invocations
+        tracker = WatermarkTracker(checkpoint.get('watermark', watermark) if checkpoint else watermark,
+                                   destination)
+    if checkpoint is not None:
+        log(f'Resuming from row {checkpoint["offset"]}, batch {checkpoint["batch_id"]}', table=table_ref_name,
+            topic=topic, source=checkpoint['source'])
+        rows = resumed_rows(cloud_client, checkpoint, selected_fields)
+    elif watermark_store is not None:
+        rows = incremental_rows(cloud_client, table_ref_name, watermark['watermark_micros'], row_filter, columns)
+    elif row_filter:
+        rows = filtered_rows(cloud_client, table_ref_name, row_filter, columns)
+    elif checkpoint_store is not None:
+        # checkpoint offsets are offsets in this listing
+        rows = cloud_client.list_rows(table_ref_name, selected_fields=selected_fields)
+    progress = None
+    if checkpoint_store is not None:
+        if checkpoint is None:
+            checkpoint = new_checkpoint(rows, table_ref_name, table.modified, incremental)
+        progress = CheckpointTracker(checkpoint_store, (table_ref_name, topic, row_filter), checkpoint,
+                                     CHECKPOINT_INTERVAL_SECONDS, tracker)
+        rows = OffsetRows(rows, checkpoint['offset'])
+        pipeline.on_published = progress.acknowledge
+    log('Publishing messages', topic=topic, columns=columns or 'all', message_format=MESSAGE_FORMAT,
+        message_encoding=MESSAGE_ENCODING)
+    fetch_data = get_data_arrow if FETCH_MODE == 'arrow' else get_data
+    batches = fetch_data(table_ref_name, cloud_client, batch_size, uploaded_keys, destination, rows,
+                         selected_fields)
+    if tracker is not None:
+        batches = tracker.strip(batches)
+    if progress is not None:
+        batches = progress.strip(batches)
+    if scheduler is not None:
+        batches = scheduler.schedule(batches, batch_size)
+    batch_rows = {}
+    batch_tiers = {}
+    interrupted = False
+    first_batch_id = progress.batch_id if progress is not None else 0
+    for batch_id, (batch, message_bytes) in enumerate(partitioner.partition(batches), first_batch_id):
+        if MESSAGE_ENCODING == COLUMNAR:
+            # cut by the size of the JSON message, the columnar one is smaller
+            with timer('encode_columnar'):
+                message_bytes = encode_columnar(fields, [[row.get(field) for field in fields] for row in batch],
+                                                config, MESSAGE_COMPRESSION)
+            increment('bytes_encoded', len(message_bytes))
+        log_payload('Publishing batch', batch, batch_id=batch_id, rows=len(batch), bytes=len(message_bytes))
+        batch_rows[batch_id] = len(batch)
+        if scheduler is not None:
+            batch_tiers[batch_id] = scheduler.tiers_of(batch)
+        if progress is not None:
+            # before publishing, the message may be acknowledged right away
+            progress.add_batch(batch_id, batch)
+        pipeline.publish(message_bytes, batch_id, **attributes)
+        if tracker is not None:
+            tracker.add_batch(batch_id, batch)
+        if progress is not None:
+            progress.save()
+            if deadline is not None and time.time() >= deadline:
+                interrupted = True
+                break
         # DEBUG BREAK!
         if batch_size == 1:
             break
+    published, failed = pipeline.flush()
+    partitioner.report()
+    rows_published = sum(batch_rows[batch_id] for batch_id in published)
+    rows_failed = sum(batch_rows[batch_id] for batch_id in failed)
+    increment('rows_published', rows_published)
+    increment('rows_failed', rows_failed)
+    log(f'Published {len(published)} batches, {len(failed)} failed, '
+        f'{pipeline.blocked_seconds:.2f}s waiting on in-flight caps')
+    if progress is not None:
+        if interrupted:
+            state = progress.save(force=True)
+            log(f'Stopped at the deadline, the next invocation resumes from row {state["offset"]}, '
+                f'batch {state["batch_id"]}', table=table_ref_name, topic=topic)
+        else:
+            progress.delete()
+    if tracker is not None:
+        # only moved once the batches up to the new mark are published
+        state = tracker.advance(published)
+        if state['watermark_micros'] != watermark['watermark_micros'] or \
+                set(state['boundary_keys']) != set(watermark['boundary_keys']):
+            watermark_store.save(table_ref_name, topic, state, scope=row_filter)
+        log(f'Watermark {tracker.watermark_micros} -> {state["watermark_micros"]} '
+            f'({tracker.skipped} row{pluralize(tracker.skipped)} on the previous mark skipped)')
+    tiers = None
+    if scheduler is not None:
+        tiers = scheduler.report(sum((batch_tiers[batch_id] for batch_id in published), collections.Counter()))
+    return {
+        'published': published,
+        'failed': failed,
+        'rows_published': rows_published,
+        'rows_failed': rows_failed,
+        'seconds': time.perf_counter() - start,
+        'interrupted': interrupted,
+        'tiers': tiers,
+    }
+
+
+def destination_kind(spec):
+    """'cm360' or 'sa360', the destination of a payload, job or destination."""
+    # only the CM360 flavour carries a config
+    return spec.get('destination') or ('cm360' if spec.get('cm360_config') else 'sa360')
+
+
+def decode_destinations(specs):
+    '''
+    The destinations a table is published to in one read:
+    [
+      {"name": "cm360", "topic": "CM360_conversion_upload",
+       "cm360_config": {...}},
+      {"name": "sa360", "topic": "SA360_conversion_upload",
+       "fields": ["conversionType", "floodlightActivity"]}
+    ]
+    "fields" adds columns to the ones DESTINATION_FIELDS lists for the
+    destination ("destination": "cm360" or "sa360", by default "cm360"
+    when there is a "cm360_config").
+    '''
+    destinations = []
+    for spec in specs:
+        if not spec.get('topic'):
+            raise ValueError(f'Destination without a topic: {spec}')
+        kind = destination_kind(spec)
+        destinations.append({
+            'name': spec.get('name') or kind,
+            'destination': kind,
+            'topic': spec['topic'],
+            'config': spec.get('cm360_config'),
+            'fields': spec.get('fields'),
+        })
+    names = [destination['name'] for destination in destinations]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Destinations need distinct names: {names}')
+    return destinations
+
+
+def publish_destinations(cloud_client, table_ref_name, destinations, publisher_client=None, row_filter=None,
+                         uploaded_keys=None, checkpoint_store=None, deadline=None):
+    """Publishes the rows of a table to several destinations from one read.
+
+    The columns of every destination are read at once and every row is
+    normalised once; each destination then skips its own uploaded rows and
+    cuts its own messages, with its config and its columns, from the same
+    batches. The table is scanned once instead of once per destination, the
+    bytes read only drop by the columns the destinations do not share.
+    Args:
+        destinations(:obj:`list`): decode_destinations() of the payload.
+        uploaded_keys(:obj:`dict`): ledger index per destination kind,
+          loaded from UPLOAD_LEDGER for the kinds missing
+        checkpoint_store: where every destination saves how far it got, the
+          run resumes from the destination furthest behind; None for runs
+          without checkpoints
+        deadline(:obj:`float`): time.time() at which a checkpointed run
+          stops publishing
+    Returns:
+      dict: same as publish_table, the batch ids being (name, batch_id),
+        and the counts of every destination under 'destinations'
+    """
+    start = time.perf_counter()
+    batch_size = 1000
+    publisher_client = publisher_client or get_publisher()
+    table = cloud_client.get_table(table_ref_name)
+    uploaded_keys = dict(uploaded_keys or {})
+    attributes = {ENCODING_ATTRIBUTE: COLUMNAR} if MESSAGE_ENCODING == COLUMNAR else {}
+    outputs = []
+    read_columns = set()
+    read_all = False
+    for destination in destinations:
+        kind = destination['destination']
+        if destination['fields']:
+            selected_fields = destination_fields(table, kind)
+            names = set(field.name for field in selected_fields or table.schema) | set(destination['fields'])
+            selected_fields = [field for field in table.schema if field.name in names]
+        else:
+            selected_fields = destination_fields(table, kind)
+        if selected_fields is None:
+            read_all = True
+            columns = [field.name for field in table.schema]
+        else:
+            columns = [field.name for field in selected_fields]
+        read_columns.update(columns)
+        fields = record_fields(columns)
+        if kind not in uploaded_keys:
+            uploaded_keys[kind] = load_uploaded_keys(kind)
+        record = MESSAGE_FORMAT == 'records' or MESSAGE_ENCODING == COLUMNAR
+        outputs.append(dict(
+            destination,
+            fields=fields,
+            record=record,
+            uploaded_keys=uploaded_keys[kind],
+            partitioner=MessagePartitioner(
+                build_message([], destination['config'], fields if record else None),
+                target_bytes=MESSAGE_TARGET_BYTES,
+                max_bytes=MESSAGE_MAX_BYTES,
+                max_rows=MESSAGE_MAX_ROWS,
+                fields=fields if record else None),
+            pipeline=PipelinedPublisher(
+                publisher_client,
+                publisher_client.topic_path(PROJECT_ID, destination['topic']),
+                max_in_flight_messages=PUBLISH_MAX_IN_FLIGHT_MESSAGES,
+                max_in_flight_bytes=PUBLISH_MAX_IN_FLIGHT_BYTES),
+            batch_rows={},
+            next_batch_id=0,
+            progress=None,
+            already_uploaded=0))
+    selected_fields = None if read_all else [field for field in table.schema if field.name in read_columns]
+    columns = [field.name for field in selected_fields] if selected_fields is not None else None
+    checkpoints = {}
+    if checkpoint_store is not None:
+        for output in outputs:
+            checkpoint = checkpoint_store.load(table_ref_name, output['topic'], scope=row_filter)
+            if checkpoint is not None and is_resumable(checkpoint, table.modified):
+                checkpoints[output['name']] = checkpoint
+        # the destinations resume in the same listing or query results
+        if len(set(json.dumps(checkpoint['source'], sort_keys=True) for checkpoint in checkpoints.values())) > 1:
+            log('Discarding the checkpoints of an earlier run', table=table_ref_name, checkpoints=checkpoints)
+            checkpoints = {}
+    start_offset = 0
+    if checkpoints:
+        # a destination without a checkpoint starts from the first row
+        start_offset = min(checkpoints[output['name']]['offset'] if output['name'] in checkpoints else 0
+                           for output in outputs)
+        first_checkpoint = dict(next(iter(checkpoints.values())), offset=start_offset)
+        log(f'Resuming from row {start_offset}', table=table_ref_name, source=first_checkpoint['source'],
+            offsets={name: checkpoint['offset'] for name, checkpoint in checkpoints.items()})
+        rows = resumed_rows(cloud_client, first_checkpoint, selected_fields)
+    elif row_filter:
+        rows = filtered_rows(cloud_client, table_ref_name, row_filter, columns)
+    elif checkpoint_store is not None:
+        # checkpoint offsets are offsets in this listing
+        rows = cloud_client.list_rows(table_ref_name, selected_fields=selected_fields)
+    else:
+        rows = None
+    if checkpoint_store is not None:
+        fresh = dict(first_checkpoint, offset=0, batch_id=0) if checkpoints else \
+            new_checkpoint(rows, table_ref_name, table.modified)
+        for output in outputs:
+            checkpoint = checkpoints.get(output['name'], fresh)
+            output['progress'] = CheckpointTracker(checkpoint_store, (table_ref_name, output['topic'], row_filter),
+                                                   checkpoint, CHECKPOINT_INTERVAL_SECONDS)
+            output['next_batch_id'] = checkpoint['batch_id']
+            output['pipeline'].on_published = output['progress'].acknowledge
+        rows = OffsetRows(rows, start_offset)
+    log('Publishing messages', topics=[output['topic'] for output in outputs], columns=columns or 'all',
+        message_format=MESSAGE_FORMAT, message_encoding=MESSAGE_ENCODING)
+
+    def send(output, batch, message_bytes):
+        if MESSAGE_ENCODING == COLUMNAR:
+            with timer('encode_columnar'):
+                message_bytes = encode_columnar(output['fields'],
+                                                [[row.get(field) for field in output['fields']] for row in batch],
+                                                output['config'], MESSAGE_COMPRESSION)
+            increment('bytes_encoded', len(message_bytes))
+        batch_id = output['next_batch_id']
+        output['next_batch_id'] += 1
+        log_payload('Publishing batch', batch, destination=output['name'], batch_id=batch_id, rows=len(batch),
+                    bytes=len(message_bytes))
+        output['batch_rows'][batch_id] = len(batch)
+        if output['progress'] is not None:
+            # before publishing, the message may be acknowledged right away
+            output['progress'].add_batch(batch_id, batch)
+        output['pipeline'].publish(message_bytes, batch_id, **attributes)
+
+    interrupted = False
+    fetch_data = get_data_arrow if FETCH_MODE == 'arrow' else get_data
+    for batch in fetch_data(table_ref_name, cloud_client, batch_size, rows=rows, selected_fields=selected_fields):
+        row_offsets = None
+        if checkpoint_store is not None:
+            row_offsets = {id(row): row.pop(OFFSET_FIELD) for row in batch}
+        for output in outputs:
+            destination_rows = batch
+            progress = output['progress']
+            if progress is not None and progress.checkpoint['offset'] > start_offset:
+                # rows this destination published before the resume
+                destination_rows = [row for row in destination_rows
+                                    if row_offsets[id(row)] >= progress.checkpoint['offset']]
+            if output['uploaded_keys'] is not None:
+                kept_rows = [row for row in destination_rows
+                             if row_ledger_key(row, output['destination']) not in output['uploaded_keys']]
+                output['already_uploaded'] += len(destination_rows) - len(kept_rows)
+                destination_rows = kept_rows
+            offsets = [row_offsets[id(row)] for row in destination_rows] if progress is not None else None
+            if not output['record']:
+                # row objects carry the columns of their destination only
+                destination_rows = [{field: row[field] for field in output['fields'] if field in row}
+                                    for row in destination_rows]
+            if progress is not None:
+                progress.track(destination_rows, offsets)
+            for message_rows, message_bytes in output['partitioner'].add(destination_rows):
+                send(output, message_rows, message_bytes)
+        if checkpoint_store is not None:
+            for output in outputs:
+                output['progress'].save()
+            if deadline is not None and time.time() >= deadline:
+                # the rows held by the partitioners are read again on resume
+                interrupted = True
+                break
+    if not interrupted:
+        for output in outputs:
+            for message_rows, message_bytes in output['partitioner'].finish():
+                send(output, message_rows, message_bytes)
+
+    result = {'published': {}, 'failed': {}, 'rows_published': 0, 'rows_failed': 0, 'destinations': {}}
+    for output in outputs:
+        published, failed = output['pipeline'].flush()
+        output['partitioner'].report()
+        rows_published = sum(output['batch_rows'][batch_id] for batch_id in published)
+        rows_failed = sum(output['batch_rows'][batch_id] for batch_id in failed)
+        name = output['name']
+        increment(f'rows_published_{name}', rows_published)
+        increment(f'rows_failed_{name}', rows_failed)
+        increment(f'messages_published_{name}', len(published))
+        increment(f'messages_failed_{name}', len(failed))
+        if output['uploaded_keys'] is not None:
+            increment('rows_already_uploaded', output['already_uploaded'])
+        result['destinations'][name] = {
+            'topic': output['topic'],
+            'messages_published': len(published),
+            'messages_failed': len(failed),
+            'rows_published': rows_published,
+            'rows_failed': rows_failed,
+            'rows_already_uploaded': output['already_uploaded'],
+        }
+        result['published'].update(((name, batch_id), message_id) for batch_id, message_id in published.items())
+        result['failed'].update(((name, batch_id), error) for batch_id, error in failed.items())
+        result['rows_published'] += rows_published
+        result['rows_failed'] += rows_failed
+        progress = output['progress']
+        if progress is not None:
+            if interrupted:
+                state = progress.save(force=True)
+                log(f'Stopped at the deadline, {name} resumes from row {state["offset"]}, batch {state["batch_id"]}',
+                    table=table_ref_name, topic=output['topic'])
+            else:
+                progress.delete()
+    increment('rows_published', result['rows_published'])
+    increment('rows_failed', result['rows_failed'])
+    log(f'Published to {len(outputs)} destinations', destinations=result['destinations'])
+    result['seconds'] = time.perf_counter() - start
+    result['interrupted'] = interrupted
+    return result
+
+
+def load_uploaded_keys(destination):
+    # None without a ledger: nothing is skipped
+    ledger = ledger_from_uri(UPLOAD_LEDGER)
+    if ledger is None:
+        return None
+    with timer('ledger_load'):
+        uploaded_keys = ledger.load_index(destination)
+    log(f'Loaded {len(uploaded_keys)} already uploaded {destination} conversions')
+    return uploaded_keys
+
+
+def run_job(cloud_client, job, todays_date, publisher_client=None, watermark_store=None,
+            uploaded_keys=None, checkpoint_store=None, deadline=None, destination_keys=None):
+    """Checks and publishes the table of one advertiser job.
+
+    A failure is logged and reported in the returned summary, it does not
+    stop the other jobs of the run. A job stopped at the deadline is
+    'interrupted', one not started before it 'deferred'.
+    A job with "destinations" publishes its table to all of them, with
+    the ledger index of every destination kind in destination_keys.
+    Returns:
+      dict: name, table, topic, status and, once published, the rows
+        published and failed and the rows per second
+    """
+    name = job.get('name') or f"{job.get('dataset_name')}.{job.get('table_name')}"
+    summary = {'name': name, 'table': f"{job.get('dataset_name')}.{job.get('table_name')}",
+               'topic': job.get('topic'), 'status': 'aborted'}
+    if deadline is not None and time.time() >= deadline:
+        summary['status'] = 'deferred'
+        return summary
+    try:
+        table = get_dataset(job.get('dataset_name'), job.get('table_name'), cloud_client)
+        table_ref_name = table.full_table_id.replace(':', '.')
+        summary['table'] = table_ref_name
+        if not job.get('topic') and not job.get('destinations'):
+            log('No target pub/sub topic name provided. Please update and retry....upload aborted!', 'ERROR',
+                job=name)
+            return summary
+        if job.get('mode') == 'incremental':
+            # new rows are found through the watermark, the table age does not matter
+            if watermark_store is None:
+                log('Incremental mode needs WATERMARK_STORE to be set....upload aborted!', 'ERROR', job=name)
+                return summary
+        elif table.modified.date() == todays_date or table.created.date() == todays_date:
+            log('[{}] is up-to-date. Continuing with upload...'.format(table_ref_name), job=name)
+            watermark_store = None
+        else:
+            log('[{}] data may be stale. Please check workflow to verfiy that it has run correctly. Upload is aborted!'.format(table_ref_name), 'WARNING', job=name)
+            summary['status'] = 'stale'
+            return summary
+        if job.get('destinations'):
+            if watermark_store is not None or job.get('delivery') == 'shards' or priority_scheduler(job):
+                raise ValueError('Several destinations cannot be combined with the incremental mode, '
+                                 'the shard delivery or the priority schedule')
+            destinations = decode_destinations(job['destinations'])
+            summary['topic'] = [destination['topic'] for destination in destinations]
+            result = publish_destinations(cloud_client, table_ref_name, destinations, publisher_client,
+                                          job.get('filter'), destination_keys, checkpoint_store, deadline)
+        else:
+            result = publish_table(cloud_client, table_ref_name, job['topic'], job.get('cm360_config'),
+                                   publisher_client, watermark_store, job.get('filter'), uploaded_keys,
+                                   job.get('delivery', 'messages'), checkpoint_store, deadline,
+                                   priority_scheduler(job))
+    except Exception as e:
+        log(f'Job {name} failed: {e}', 'ERROR', job=name)
+        summary.update(status='failed', error=str(e))
+        return summary
+    if result.get('interrupted'):
+        status = 'interrupted'
+    else:
+        status = 'partially_published' if result['failed'] else 'published'
+    summary.update({
+        'status': status,
+        'rows_published': result['rows_published'],
+        'rows_failed': result['rows_failed'],
+        'messages_failed': len(result['failed']),
+        'seconds': round(result['seconds'], 3),
+        'rows_per_second': round(result['rows_published'] / result['seconds'], 1) if result['seconds'] else None,
+    })
+    if result.get('tiers'):
+        summary['tiers'] = result['tiers']
+    if result.get('destinations'):
+        summary['destinations'] = result['destinations']
+    return summary
+
+
+def run_jobs(cloud_client, jobs, todays_date, publisher_client=None, checkpoint_store=None, deadline=None,
+             payload=None):
+    """Runs the advertiser jobs on a pool of DELEGATOR_MAX_WORKERS threads.
+
+    When jobs are interrupted or deferred at the deadline, the payload is
+    published again with only these jobs.
+    Returns:
+      list: the summary of every job, in payload order
+    """
+    reset_metrics()
+    start = time.perf_counter()
+    watermark_store = None
+    if any(job.get('mode') == 'incremental' for job in jobs):
+        # one store for all the jobs, saves are serialised by the store
+        watermark_store = watermark_store_from_uri(WATERMARK_STORE)
+    # the ledger index of a destination is loaded once for all its jobs
+    uploaded_keys = {}
+    for job in jobs:
+        kinds = [destination_kind(spec) for spec in job.get('destinations') or [job]]
+        for destination in kinds:
+            # with shards the upload nodes skip the uploaded rows themselves
+            if destination not in uploaded_keys and job.get('delivery') != 'shards':
+                uploaded_keys[destination] = load_uploaded_keys(destination)
+    with futures.ThreadPoolExecutor(max_workers=max(1, min(DELEGATOR_MAX_WORKERS, len(jobs)))) as executor:
+        summaries = list(executor.map(
+            lambda job: run_job(cloud_client, job, todays_date, publisher_client, watermark_store,
+                                uploaded_keys.get(destination_kind(job)), checkpoint_store, deadline,
+                                uploaded_keys),
+            jobs))
+    seconds = time.perf_counter() - start
+    rows_published = sum(summary.get('rows_published', 0) for summary in summaries)
+    statuses = {}
+    for summary in summaries:
+        statuses[summary['status']] = statuses.get(summary['status'], 0) + 1
+    log(f'Delegated {len(jobs)} job{pluralize(len(jobs))} in {seconds:.2f}s', jobs=summaries, statuses=statuses,
+        rows_published=rows_published, rows_per_second=round(rows_published / seconds, 1) if seconds else None)
+    unfinished = [job for job, summary in zip(jobs, summaries) if summary['status'] in ('interrupted', 'deferred')]
+    if unfinished and payload is not None:
+        retrigger(dict(payload, jobs=unfinished), publisher_client)
+    export_metrics('delegator', mode='jobs', jobs=summaries, statuses=statuses)
+    return summaries
 
 
 def decode_json(payload):
@@ -160,6 +1086,10 @@ def decode_json(payload):
       "dataset_name": "dataset",
       "table_name": "table",
       "topic": "topic",
+      "mode": "incremental",
+      "delivery": "shards",
+      "schedule": "priority",
+      "quota_rows": 500000,
       "cm360_config": {
         "profile_id": "",
         "floodlight_activity_id": "",
@@ -170,22 +1100,60 @@ def decode_json(payload):
     try:
         json_payload = json.loads(payload)
     except:
-        print(f'Unable to parse json payload: {payload}')
+        log(f'Unable to parse json payload: {payload}', 'ERROR')
         raise
     dataset_name = json_payload['dataset_name'] if 'dataset_name' in json_payload else None
     table_name = json_payload['table_name'] if 'table_name' in json_payload else None
     topic = json_payload['topic'] if 'topic' in json_payload else None
     config = json_payload['cm360_config'] if 'cm360_config' in json_payload else None
-    return dataset_name, table_name, topic, config
+    mode = json_payload['mode'] if 'mode' in json_payload else 'full'
+    delivery = json_payload['delivery'] if 'delivery' in json_payload else 'messages'
+    return dataset_name, table_name, topic, config, mode, delivery
+
+
+JOB_KEYS = ['name', 'dataset_name', 'table_name', 'topic', 'mode', 'delivery', 'cm360_config', 'filter',
+            'schedule', 'quota_rows', 'destinations']
+def decode_jobs(payload):
+    '''
+    A payload with a "jobs" list delegates several advertisers in one run.
+    The keys set next to "jobs" are the defaults of every job:
+    {
+      "dataset_name": "business_data",
+      "topic": "topic",
+      "jobs": [
+        {"name": "advertiser_1", "table_name": "conversion_final_1",
+         "cm360_config": {...}},
+        {"name": "advertiser_2", "table_name": "conversion_final_all",
+         "filter": "advertiserId = '2'", "mode": "incremental"}
+      ]
+    }
+    "filter" is a BigQuery condition selecting the rows of the job, for
+    tables or partitions shared by several advertisers. Returns None for
+    the single table payload of decode_json.
+    '''
+    try:
+        json_payload = json.loads(payload)
+    except:
+        log(f'Unable to parse json payload: {payload}', 'ERROR')
+        raise
+    if 'jobs' not in json_payload:
+        return None
+    defaults = {key: json_payload[key] for key in JOB_KEYS if key in json_payload}
+    return [dict(defaults, **job) for job in json_payload['jobs']]
 
 def main(event, context):
-    print('[{}] - Start Conversion upload delegator'.format(time_now_str()))
-    print(f'EVENT: {event}')
+    log('[{}] - Start Conversion upload delegator'.format(time_now_str()), event=event)
     # set correct timezone for datetime check
     todays_date = today_date()
+    # runs saving checkpoints stop in time to save the last one and trigger
+    # the next invocation
+    checkpoint_store = checkpoint_store_from_uri(CHECKPOINT_STORE)
+    deadline = None
+    if checkpoint_store is not None:
+        deadline = time.time() + FUNCTION_TIMEOUT_SECONDS - CHECKPOINT_MARGIN_SECONDS
 
-    # Instansiate BQ client
-    cloud_client = bigquery.Client(project=PROJECT_ID)
+    # Instansiate BQ client, or reuse the one of a warm instance
+    cloud_client = get_bigquery_client()
 
     payload = ''
     if 'type.googleapis.com/google.pubsub.v1.PubsubMessage' == event.get('@type', ''):
@@ -198,20 +1166,48 @@ def main(event, context):
     else:
         # the CF is inovked from the Testing functionalities of the console
         payload = json.dumps(event)
-    dataset_name, table_name, topic, config = decode_json(payload)
-    print(f'dataset: {dataset_name}, table: {table_name} topic: {topic} config: {config}')
+    jobs = decode_jobs(payload)
+    if jobs is not None:
+        log('Upload request', jobs=len(jobs))
+        run_jobs(cloud_client, jobs, todays_date, checkpoint_store=checkpoint_store, deadline=deadline,
+                 payload=json.loads(payload))
+        return
+
+    dataset_name, table_name, topic, config, mode, delivery = decode_json(payload)
+    log('Upload request', dataset=dataset_name, table=table_name, topic=topic, config=config, mode=mode,
+        delivery=delivery)
+    scheduler = priority_scheduler(json.loads(payload))
+    destinations = json.loads(payload).get('destinations')
+    if destinations:
+        destinations = decode_destinations(destinations)
 
     table = get_dataset(dataset_name, table_name, cloud_client)
     
     if table is not None:
         table_ref_name = table.full_table_id.replace(':', '.')
-        if table.modified.date() == todays_date or table.created.date() == todays_date:
-            print('[{}] is up-to-date. Continuing with upload...'.format(table_ref_name))
-            if topic:
-                partition_and_distribute(cloud_client, table_ref_name, topic, config)
+        if mode == 'incremental':
+            # new rows are found through the watermark, the table age does not matter
+            watermark_store = watermark_store_from_uri(WATERMARK_STORE)
+            if watermark_store is None:
+                log('Incremental mode needs WATERMARK_STORE to be set....upload aborted!', 'ERROR')
+            elif topic or destinations:
+                partition_and_distribute(cloud_client, table_ref_name, topic, config,
+                                         watermark_store=watermark_store, delivery=delivery,
+                                         checkpoint_store=checkpoint_store, deadline=deadline,
+                                         payload=json.loads(payload), scheduler=scheduler,
+                                         destinations=destinations)
+            else:
+                log('No target pub/sub topic name provided. Please update and retry....upload aborted!', 'ERROR')
+        elif table.modified.date() == todays_date or table.created.date() == todays_date:
+            log('[{}] is up-to-date. Continuing with upload...'.format(table_ref_name))
+            if topic or destinations:
+                partition_and_distribute(cloud_client, table_ref_name, topic, config, delivery=delivery,
+                                         checkpoint_store=checkpoint_store, deadline=deadline,
+                                         payload=json.loads(payload), scheduler=scheduler,
+                                         destinations=destinations)
             else:
-                print('No target pub/sub topic name provided. Please update and retry....upload aborted!')
+                log('No target pub/sub topic name provided. Please update and retry....upload aborted!', 'ERROR')
         else:
-            print('[{}] data may be stale. Please check workflow to verfiy that it has run correctly. Upload is aborted!'.format(table_ref_name))
+            log('[{}] data may be stale. Please check workflow to verfiy that it has run correctly. Upload is aborted!'.format(table_ref_name), 'WARNING')
     else:
-        print('Table not found! Please double check your workflow for any errors.')
\ No newline at end of file
+        log('Table not found! Please double check your workflow for any errors.', 'ERROR')
\ No newline at end of file
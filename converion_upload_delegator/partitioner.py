@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cuts conversion rows into Pub/Sub messages by serialized size instead of a
+# fixed row count. Every row is serialized exactly once, the message is then
+# assembled from the already encoded rows, so the size used for the cut is the
+# real message size.
+
+import json
+import time
+
+from instrumentation import increment
+from instrumentation import log
+from instrumentation import observe
+
+# Pub/Sub rejects messages above 10MB, attributes included
+PUBSUB_MAX_MESSAGE_BYTES = 10 * 1000 * 1000
+# upper bounds of the message size histogram buckets
+MESSAGE_SIZE_BUCKETS = [16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024,
+                        4 * 1024 * 1024, PUBSUB_MAX_MESSAGE_BYTES]
+ROW_SEPARATOR = b', '
+
+
+class MessagePartitioner(object):
+    """Groups rows into messages close to a target byte size.
+
+    Args:
+        envelope(:obj:`bytes`): The message without conversions, i.e.
+          build_message([], config, fields); rows are spliced into its empty list.
+        target_bytes(:obj:`int`): A message is cut once the next row would
+          take it past this size.
+        max_bytes(:obj:`int`): Hard cap, rows that do not fit in a message
+          of their own are skipped and counted as oversized.
+        max_rows(:obj:`int`): Row count ceiling per message.
+        fields(:obj:`list`): Field order of compact records, rows are then
+          encoded as lists of values. None encodes them as objects.
+    """
+
+    def __init__(self, envelope, target_bytes, max_bytes=PUBSUB_MAX_MESSAGE_BYTES, max_rows=1000, fields=None):
+        rows_key = b'"conversions": [' if fields is None else b'"rows": ['
+        split_at = envelope.index(rows_key + b']') + len(rows_key)
+        self.prefix = envelope[:split_at]
+        self.suffix = envelope[split_at:]
+        self.max_bytes = min(max_bytes, PUBSUB_MAX_MESSAGE_BYTES)
+        self.target_bytes = min(target_bytes, self.max_bytes)
+        self.max_rows = max_rows
+        self.fields = fields
+        self.messages = 0
+        self.rows = 0
+        self.bytes = 0
+        self.oversized_rows = []
+        self.histogram = [0] * len(MESSAGE_SIZE_BUCKETS)
+        # serialization time of the message being filled
+        self.serialize_seconds = 0.0
+        # rows of the message being filled
+        self.pending_rows = []
+        self.pending_encoded_rows = []
+        self.pending_size = len(self.prefix) + len(self.suffix)
+
+    def _message(self, encoded_rows):
+        start = time.perf_counter()
+        message_bytes = self.prefix + ROW_SEPARATOR.join(encoded_rows) + self.suffix
+        observe('serialize', self.serialize_seconds + time.perf_counter() - start)
+        self.serialize_seconds = 0.0
+        self.messages += 1
+        self.rows += len(encoded_rows)
+        self.bytes += len(message_bytes)
+        for bucket, upper_bound in enumerate(MESSAGE_SIZE_BUCKETS):
+            if len(message_bytes) <= upper_bound:
+                self.histogram[bucket] += 1
+                break
+        return message_bytes
+
+    def partition(self, batches):
+        """Re-chunks the row batches of get_data.
+
+        Yields:
+          tuple: (rows, message_bytes) where message_bytes == build_message(rows, config, fields)
+        """
+        for batch in batches:
+            yield from self.add(batch)
+        yield from self.finish()
+
+    def add(self, batch):
+        """Adds the rows of a batch, yields the messages they complete.
+
+        For callers pushing the same batches into several partitioners.
+        """
+        envelope_bytes = len(self.prefix) + len(self.suffix)
+        for row in batch:
+            # json.dumps escapes non ASCII, the str length is the byte length
+            start = time.perf_counter()
+            if self.fields is None:
+                encoded_row = json.dumps(row).encode('utf-8')
+            else:
+                encoded_row = json.dumps([row.get(field) for field in self.fields]).encode('utf-8')
+            self.serialize_seconds += time.perf_counter() - start
+            if envelope_bytes + len(encoded_row) > self.max_bytes:
+                self.oversized_rows.append(row.get('conversionId'))
+                increment('rows_oversized')
+                log(f'Skipped row {row.get("conversionId")}: {len(encoded_row)} bytes '
+                    f'do not fit in a {self.max_bytes} bytes message', 'WARNING')
+                continue
+            row_size = len(encoded_row) + (len(ROW_SEPARATOR) if self.pending_rows else 0)
+            if self.pending_rows and (self.pending_size + row_size > self.target_bytes or
+                                      len(self.pending_rows) >= self.max_rows):
+                yield self.pending_rows, self._message(self.pending_encoded_rows)
+                self.pending_rows = []
+                self.pending_encoded_rows = []
+                self.pending_size = envelope_bytes
+                row_size = len(encoded_row)
+            self.pending_rows.append(row)
+            self.pending_encoded_rows.append(encoded_row)
+            self.pending_size += row_size
+
+    def finish(self):
+        """Yields the last message, if rows are left."""
+        if self.pending_rows:
+            yield self.pending_rows, self._message(self.pending_encoded_rows)
+        self.pending_rows = []
+        self.pending_encoded_rows = []
+        self.pending_size = len(self.prefix) + len(self.suffix)
+
+    def report(self):
+        histogram = {}
+        lower_bound = 0
+        for upper_bound, count in zip(MESSAGE_SIZE_BUCKETS, self.histogram):
+            histogram[f'{lower_bound}-{upper_bound}'] = count
+            lower_bound = upper_bound
+        log(f'Produced {self.messages} messages with {self.rows} rows and {self.bytes} bytes, '
+            f'{len(self.oversized_rows)} oversized rows skipped', message_size_histogram=histogram)
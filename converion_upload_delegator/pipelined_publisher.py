@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Non-blocking Pub/Sub publishing. Messages are handed to the client library
+# without waiting on their futures, so the delegator keeps reading BigQuery
+# pages while earlier batches are still on the wire. The number and the size
+# of unacknowledged messages are capped to bound the function's memory.
+
+import threading
+import time
+
+from instrumentation import increment
+from instrumentation import log
+from instrumentation import observe
+
+
+class PipelinedPublisher(object):
+    """Publishes messages with a bounded number of in-flight futures.
+
+    Args:
+        publisher_client: A google.cloud.pubsub.PublisherClient (or a fake
+          exposing publish() returning futures with add_done_callback()).
+        topic_path(:obj:`str`): Fully qualified topic path.
+        max_in_flight_messages(:obj:`int`): Max unacknowledged messages.
+        max_in_flight_bytes(:obj:`int`): Max unacknowledged payload bytes.
+        on_published: Called with the batch id of every message published,
+          from the thread of the future's callback.
+    """
+
+    def __init__(self, publisher_client, topic_path,
+                 max_in_flight_messages=100, max_in_flight_bytes=100 * 1024 * 1024, on_published=None):
+        self.publisher_client = publisher_client
+        self.topic_path = topic_path
+        self.max_in_flight_messages = max_in_flight_messages
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.on_published = on_published
+        self.in_flight_messages = 0
+        self.in_flight_bytes = 0
+        self.results = {}
+        self.failures = {}
+        self.blocked_seconds = 0.0
+        self._condition = threading.Condition()
+
+    def _has_capacity(self, size):
+        if self.in_flight_messages == 0:
+            # always let one message through, even if it exceeds the byte cap
+            return True
+        return (self.in_flight_messages < self.max_in_flight_messages and
+                self.in_flight_bytes + size <= self.max_in_flight_bytes)
+
+    def publish(self, message_bytes, batch_id, **attributes):
+        """Queues a message, blocking only while the in-flight caps are hit."""
+        size = len(message_bytes)
+        with self._condition:
+            if not self._has_capacity(size):
+                start = time.perf_counter()
+                self._condition.wait_for(lambda: self._has_capacity(size))
+                self.blocked_seconds += time.perf_counter() - start
+            self.in_flight_messages += 1
+            self.in_flight_bytes += size
+        start = time.perf_counter()
+        try:
+            future = self.publisher_client.publish(self.topic_path, data=message_bytes, **attributes)
+        except Exception as e:
+            self._done(batch_id, size, None, e, start)
+            return
+        future.add_done_callback(
+            lambda completed: self._on_done(batch_id, size, completed, start))
+
+    def _on_done(self, batch_id, size, future, start):
+        try:
+            message_id = future.result()
+        except Exception as e:
+            self._done(batch_id, size, None, e, start)
+        else:
+            self._done(batch_id, size, message_id, None, start)
+
+    def _done(self, batch_id, size, message_id, error, start):
+        # time from the hand-over to the client until Pub/Sub acknowledged
+        observe('publish', time.perf_counter() - start)
+        if error is None:
+            increment('messages_published')
+            increment('bytes_published', size)
+            if self.on_published is not None:
+                self.on_published(batch_id)
+        else:
+            increment('messages_failed')
+        with self._condition:
+            if error is None:
+                self.results[batch_id] = message_id
+            else:
+                self.failures[batch_id] = error
+            self.in_flight_messages -= 1
+            self.in_flight_bytes -= size
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits for every queued message and logs the batches that failed.
+
+        Returns:
+          tuple: ({batch_id: message_id}, {batch_id: exception})
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight_messages == 0, timeout=timeout)
+            if self.in_flight_messages:
+                log(f'{self.in_flight_messages} message(s) still in flight after {timeout}s', 'WARNING')
+            for batch_id in sorted(self.failures):
+                log(f'Batch {batch_id} failed: {self.failures[batch_id]}', 'ERROR')
+            observe('publish_blocked', self.blocked_seconds)
+            return dict(self.results), dict(self.failures)
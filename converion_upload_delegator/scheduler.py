@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Priority schedule of the runs whose conversions do not all fit in the
+# quota of the destination ("schedule": "priority" in the payload).
+#
+# Every conversion of the run is put in the first tier it matches, by the
+# hours left before it falls out of the attribution lookback window and by
+# its value (CALCULATED_PROFIT, published as conversionRevenue). Tiers are
+# published in order, each sorted by deadline or value, until the run has
+# published its quota of conversions. The rest is left for the next run:
+# it reads them again, skips what UPLOAD_LEDGER holds as uploaded, and the
+# leftovers come back a day closer to their deadline.
+
+import collections
+import json
+import time
+
+from instrumentation import increment
+from instrumentation import log
+from instrumentation import timer
+
+# a tier takes the rows matching all its bounds; 'order' sorts the tier by
+# 'deadline' (closest first) or 'value' (highest first)
+DEFAULT_TIERS = [
+    {'name': 'expiring', 'max_hours_left': 48, 'order': 'deadline'},
+    {'name': 'high_value', 'min_value': 100.0, 'order': 'value'},
+    {'name': 'standard', 'order': 'value'},
+]
+# rows past their deadline, published last if quota remains
+EXPIRED_TIER = 'expired'
+
+
+def parse_tiers(spec):
+    """The tiers of a JSON list, DEFAULT_TIERS when empty."""
+    if not spec:
+        return DEFAULT_TIERS
+    tiers = json.loads(spec) if isinstance(spec, str) else spec
+    for tier in tiers:
+        if 'name' not in tier:
+            raise ValueError(f'Priority tier without a name: {tier}')
+        if tier.get('order', 'value') not in ('deadline', 'value'):
+            raise ValueError(f'Unsupported order of priority tier {tier["name"]}: {tier["order"]}')
+    return tiers
+
+
+class PriorityScheduler(object):
+    """Reorders the row batches of a run by tier and stops at its quota.
+
+    Args:
+        tiers(:obj:`list`): The tiers, highest priority first.
+        lookback_days(:obj:`float`): Attribution window, a conversion's
+          deadline is its timestamp plus this.
+        quota_rows(:obj:`int`): Conversions the run publishes, None or 0
+          for no limit (the rows are only reordered).
+        value_field(:obj:`str`): Field of the row holding its value.
+        at_risk_hours(:obj:`float`): Rows left over with less than this
+          before their deadline are reported as at risk, they will likely
+          be past it by the next run.
+    """
+
+    def __init__(self, tiers, lookback_days, quota_rows=None, value_field='conversionRevenue',
+                 at_risk_hours=24, now=None):
+        self.tiers = tiers
+        self.names = [tier['name'] for tier in tiers] + [EXPIRED_TIER]
+        self.lookback_micros = int(lookback_days * 86400 * 1_000_000)
+        self.quota_rows = quota_rows or None
+        self.value_field = value_field
+        self.at_risk_micros = int(at_risk_hours * 3600 * 1_000_000)
+        self.now_micros = int((time.time() if now is None else now) * 1_000_000)
+        self.row_tiers = {}
+        self.binned = collections.Counter()
+        self.scheduled = collections.Counter()
+        self.carried_over = collections.Counter()
+        self.at_risk = collections.Counter()
+
+    def tier_of(self, micros_left, value):
+        if micros_left < 0:
+            return len(self.tiers)
+        for index, tier in enumerate(self.tiers):
+            if 'max_hours_left' in tier and micros_left > tier['max_hours_left'] * 3600 * 1_000_000:
+                continue
+            if 'min_value' in tier and value < tier['min_value']:
+                continue
+            return index
+        # rows matching no tier come last before the expired ones
+        return len(self.tiers) - 1
+
+    def schedule(self, batches, batch_size):
+        """Bins every row of batches, then yields them by tier up to the quota."""
+        bins = [[] for _ in self.names]
+        with timer('schedule'):
+            for batch in batches:
+                for row in batch:
+                    micros_left = row['conversionTimestampMicros'] + self.lookback_micros - self.now_micros
+                    value = row.get(self.value_field) or 0.0
+                    index = self.tier_of(micros_left, value)
+                    order = self.tiers[index].get('order', 'value') if index < len(self.tiers) else 'value'
+                    key = (micros_left, -value) if order == 'deadline' else (-value, micros_left)
+                    bins[index].append((key, micros_left, row))
+            for index, rows in enumerate(bins):
+                rows.sort(key=lambda entry: entry[0])
+                self.binned[self.names[index]] = len(rows)
+        remaining = self.quota_rows
+        for index, rows in enumerate(bins):
+            name = self.names[index]
+            count = len(rows) if remaining is None else min(len(rows), remaining)
+            for _, micros_left, row in rows[count:]:
+                if micros_left < self.at_risk_micros:
+                    self.at_risk[name] += 1
+            self.carried_over[name] = len(rows) - count
+            self.scheduled[name] = count
+            if remaining is not None:
+                remaining -= count
+            for start in range(0, count, batch_size):
+                batch = [row for _, _, row in rows[start:min(start + batch_size, count)]]
+                for row in batch:
+                    self.row_tiers[id(row)] = name
+                yield batch
+            # the rows of the tier are no longer needed once queued
+            bins[index] = None
+
+    def tiers_of(self, rows):
+        """Rows per tier of a message."""
+        return collections.Counter(self.row_tiers.pop(id(row)) for row in rows)
+
+    def report(self, published):
+        """Rows per tier: read, published, failed and left for the next run.
+
+        Args:
+            published(:obj:`collections.Counter`): Rows published per tier.
+        """
+        tiers = {}
+        for name in self.names:
+            if not self.binned[name]:
+                continue
+            tiers[name] = {
+                'rows': self.binned[name],
+                'published': published[name],
+                'failed': self.scheduled[name] - published[name],
+                'carried_over': self.carried_over[name],
+                'at_risk': self.at_risk[name],
+                'quota_share': round(published[name] / self.quota_rows, 4) if self.quota_rows else None,
+            }
+            increment(f'priority_{name}_published', published[name])
+            increment(f'priority_{name}_carried_over', self.carried_over[name])
+        carried_over = sum(self.carried_over.values())
+        log(f'Priority schedule: {sum(published.values())} rows published of a quota of '
+            f'{self.quota_rows or "unlimited"}, {carried_over} left for the next run', tiers=tiers)
+        return tiers
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shard descriptors of the claim-check delivery, the columns every
+# destination reads and the row normalisation they share with the delegator;
+# copied next to the delegator and both upload nodes (keep the copies
+# identical).
+#
+# Instead of the conversions, the delegator publishes descriptors of slices
+# of the table and every upload node reads its own slice:
+#   {"kind": "range", "table": ..., "start_index": 0, "max_results": 5000,
+#    "table_modified": "..."}
+#       rows start_index to start_index + max_results of the table, read with
+#       tabledata.list (no query cost). Refused when the table was modified
+#       after the shards were planned, the row order may have changed.
+#   {"kind": "hash", "table": ..., "filter": "...", "shard": 3, "shards": 8,
+#    "snapshot_millis": ...}
+#       rows of a filtered table whose conversionId hashes to the shard, as
+#       of the planning time (time travel). Every shard is a query scanning
+#       the filtered columns of the table.
+
+import datetime
+import decimal
+
+REQUIRED_KEYS = [
+    'conversionId',
+    'conversionQuantity',
+    'conversionRevenue',
+    'conversionTimestamp',
+    'conversionVisitExternalClickId',
+]
+# column hashed to spread the rows of a filtered table over the shards
+SHARD_KEY_COLUMN = 'conversionId'
+# columns of the transformed table each upload node reads, only these are
+# requested from BigQuery and published. Add a column here (in every copy)
+# when a node starts reading it; a destination missing here gets them all.
+DESTINATION_FIELDS = {
+    'cm360': REQUIRED_KEYS + ['conversionTimestampMicros'],
+    'sa360': REQUIRED_KEYS + ['conversionTimestampMillis', 'conversionType', 'floodlightActivity'],
+}
+
+
+def missing_keys(row):
+    return [key for key in REQUIRED_KEYS if row.get(key) is None]
+
+
+def normalize_row(row):
+    """The conversion published for a table row, JSON serializable."""
+    result = {}
+    conversionTimestamp = row.get('conversionTimestamp')
+    # convert floating point seconds to microseconds since the epoch
+    result['conversionTimestampMicros'] = int(conversionTimestamp.timestamp() * 1_000_000)
+    for key in row.keys():
+        value = row.get(key)
+        if type(value) == datetime.datetime or type(value) == datetime.date:
+            result[key] = value.strftime("%y-%m-%d ")
+        elif type(value) == decimal.Decimal:
+            result[key] = float(value)
+        else:
+            result[key] = value
+    return result
+
+
+def destination_fields(table, destination):
+    """The schema fields of a table a destination reads, None for all."""
+    names = DESTINATION_FIELDS.get(destination)
+    if names is None:
+        return None
+    return [field for field in table.schema if field.name in names]
+
+
+def record_fields(columns):
+    """Field order of the conversions normalize_row builds from rows with
+    these columns, the schema of the compact records of a message."""
+    return ['conversionTimestampMicros'] + [name for name in columns if name != 'conversionTimestampMicros']
+
+
+def message_conversions(data):
+    """The conversions of a message: compact records ("fields" and "rows")
+    or the former list of row dicts ("conversions")."""
+    if 'rows' in data:
+        fields = data['fields']
+        return [dict(zip(fields, values)) for values in data['rows']]
+    return data.get('conversions')
+
+
+def plan_range_shards(table, table_ref_name, shard_rows):
+    """Descriptors covering every row of a table, shard_rows at a time."""
+    modified = table.modified.isoformat() if table.modified else None
+    return [{
+        'kind': 'range',
+        'table': table_ref_name,
+        'start_index': start_index,
+        'max_results': shard_rows,
+        'table_modified': modified,
+    } for start_index in range(0, table.num_rows, shard_rows)]
+
+
+def plan_hash_shards(table_ref_name, row_filter, num_rows, shard_rows, snapshot_millis):
+    """Descriptors of the rows of a table matching row_filter, about
+    shard_rows each, read as of snapshot_millis."""
+    shards = max(1, -(-num_rows // shard_rows))
+    return [{
+        'kind': 'hash',
+        'table': table_ref_name,
+        'filter': row_filter,
+        'shard': shard,
+        'shards': shards,
+        'snapshot_millis': snapshot_millis,
+    } for shard in range(shards)]
+
+
+def hash_shard_query(descriptor, columns=None):
+    select = ', '.join(columns) if columns else '*'
+    query = (f"SELECT {select} FROM `{descriptor['table']}` "
+             'FOR SYSTEM_TIME AS OF TIMESTAMP_MILLIS(@snapshot_millis) '
+             f'WHERE ABS(MOD(FARM_FINGERPRINT(CAST({SHARD_KEY_COLUMN} AS STRING)), @shards)) = @shard')
+    if descriptor.get('filter'):
+        query += f" AND ({descriptor['filter']})"
+    return query
+
+
+def count_query(table_ref_name, row_filter):
+    return (f'SELECT COUNT(*) AS num_rows FROM `{table_ref_name}` '
+            'FOR SYSTEM_TIME AS OF TIMESTAMP_MILLIS(@snapshot_millis) '
+            f'WHERE ({row_filter})')
+
+
+def read_shard(cloud_client, descriptor, destination=None):
+    """Rows of the table slice a descriptor stands for, with the columns
+    the destination reads."""
+    from google.cloud import bigquery
+    table = cloud_client.get_table(descriptor['table'])
+    selected_fields = destination_fields(table, destination)
+    if descriptor['kind'] == 'range':
+        modified = table.modified.isoformat() if table.modified else None
+        if modified != descriptor['table_modified']:
+            raise ValueError(f"{descriptor['table']} was modified at {modified}, after the shards "
+                             f"were planned ({descriptor['table_modified']})")
+        return cloud_client.list_rows(
+            table, start_index=descriptor['start_index'], max_results=descriptor['max_results'],
+            selected_fields=selected_fields)
+    if descriptor['kind'] == 'hash':
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('snapshot_millis', 'INT64', descriptor['snapshot_millis']),
+            bigquery.ScalarQueryParameter('shards', 'INT64', descriptor['shards']),
+            bigquery.ScalarQueryParameter('shard', 'INT64', descriptor['shard'])])
+        columns = [field.name for field in selected_fields] if selected_fields is not None else None
+        return cloud_client.query(hash_shard_query(descriptor, columns), job_config=job_config).result()
+    raise ValueError(f"Unknown shard kind: {descriptor['kind']}")
+
+
+def load_shard(cloud_client, descriptor, uploaded_keys=None, row_key=None, destination=None):
+    """Reads and normalises the rows of a shard.
+
+    Args:
+        destination(:obj:`str`): 'cm360' or 'sa360', only the columns it
+          reads are requested.
+        uploaded_keys(:obj:`set`): ledger keys of the rows already uploaded.
+        row_key(:obj:`callable`): row_key(row) -> ledger key of a row.
+    Returns:
+      tuple: the conversions and a dict of rows read, skipped for missing
+        keys and already uploaded
+    """
+    conversions = []
+    stats = {'rows_read': 0, 'rows_skipped': 0, 'rows_already_uploaded': 0}
+    for row in read_shard(cloud_client, descriptor, destination):
+        stats['rows_read'] += 1
+        if missing_keys(row):
+            stats['rows_skipped'] += 1
+            continue
+        if uploaded_keys is not None and row_key(row) in uploaded_keys:
+            stats['rows_already_uploaded'] += 1
+            continue
+        conversions.append(normalize_row(row))
+    return conversions, stats
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# High-water mark of the incremental delegator mode.
+#
+# A run reads the rows whose watermark column is at or after the saved mark,
+# oldest first, publishes them and only then moves the mark forward, to the
+# newest row of the longest run of batches that were all published. The keys
+# of the rows sitting exactly on the mark are kept with it, so rows sharing
+# that timestamp are neither lost nor sent twice by the next run.
+
+import datetime
+import json
+import os
+import threading
+
+from upload_ledger import row_ledger_key
+
+# extra column the incremental query adds to every row, dropped before publish
+WATERMARK_FIELD = 'watermarkMicros'
+
+
+def state_key(table_ref_name, topic, scope=None):
+    # jobs reading part of a table (a row filter) keep a watermark each
+    key = f'{table_ref_name}:{topic}'
+    return f'{key}:{scope}' if scope else key
+
+
+def empty_state():
+    return {'watermark_micros': None, 'boundary_keys': []}
+
+
+class FileWatermarkStore(object):
+    """Watermarks of every table/topic in one JSON file, replaced atomically."""
+
+    def __init__(self, path):
+        self.path = path
+        # jobs running in parallel save through the same store
+        self._lock = threading.Lock()
+
+    def load_all(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as state_file:
+            return json.load(state_file)
+
+    def load(self, table_ref_name, topic, scope=None):
+        with self._lock:
+            return self.load_all().get(state_key(table_ref_name, topic, scope), empty_state())
+
+    def save(self, table_ref_name, topic, state, scope=None):
+        with self._lock:
+            states = self.load_all()
+            states[state_key(table_ref_name, topic, scope)] = dict(
+                state, updated_at=datetime.datetime.utcnow().isoformat())
+            with open(self.path + '.tmp', 'w') as state_file:
+                json.dump(states, state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.replace(self.path + '.tmp', self.path)
+
+
+class BigQueryWatermarkStore(object):
+    """Append-only history of watermarks, the latest row of a key wins.
+
+    Every advance is a single streamed row, so it either lands whole or not
+    at all, and the history shows how the watermark moved.
+    """
+
+    SCHEMA = [
+        ('state_key', 'STRING'),
+        ('watermark_micros', 'INT64'),
+        ('boundary_keys', 'INT64 REPEATED'),
+        ('updated_at', 'TIMESTAMP'),
+    ]
+
+    def __init__(self, table_id, cloud_client=None):
+        self.table_id = table_id
+        self.cloud_client = cloud_client
+
+    def client(self):
+        if self.cloud_client is None:
+            from google.cloud import bigquery
+            self.cloud_client = bigquery.Client()
+        return self.cloud_client
+
+    def load(self, table_ref_name, topic, scope=None):
+        from google.cloud import bigquery
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('state_key', 'STRING', state_key(table_ref_name, topic, scope))])
+        query = (f'SELECT watermark_micros, boundary_keys FROM `{self.table_id}` '
+                 'WHERE state_key = @state_key ORDER BY updated_at DESC LIMIT 1')
+        for row in self.client().query(query, job_config=job_config).result():
+            return {'watermark_micros': row['watermark_micros'], 'boundary_keys': list(row['boundary_keys'])}
+        return empty_state()
+
+    def save(self, table_ref_name, topic, state, scope=None):
+        insert_errors = self.client().insert_rows_json(self.table_id, [{
+            'state_key': state_key(table_ref_name, topic, scope),
+            'watermark_micros': state['watermark_micros'],
+            'boundary_keys': state['boundary_keys'],
+            'updated_at': datetime.datetime.utcnow().isoformat(),
+        }])
+        if insert_errors:
+            raise RuntimeError(f'Could not save the watermark in {self.table_id}: {insert_errors}')
+
+
+def watermark_store_from_uri(uri):
+    """file:///path.json, bq://project.dataset.table or empty for full runs."""
+    if not uri:
+        return None
+    if uri.startswith('file://'):
+        return FileWatermarkStore(uri[len('file://'):])
+    if uri.startswith('bq://'):
+        return BigQueryWatermarkStore(uri[len('bq://'):])
+    raise ValueError(f'Unsupported watermark store: {uri}')
+
+
+class WatermarkTracker(object):
+    """Follows the watermark of the rows of one incremental run."""
+
+    def __init__(self, state, destination):
+        self.watermark_micros = state['watermark_micros']
+        self.boundary_keys = set(state['boundary_keys'])
+        self.destination = destination
+        self.row_marks = {}
+        self.batch_marks = {}
+        self.skipped = 0
+
+    def strip(self, batches):
+        # drops the rows already published on the watermark itself and moves
+        # the watermark column out of the rows
+        for batch in batches:
+            rows = []
+            for row in batch:
+                mark = row.pop(WATERMARK_FIELD)
+                key = row_ledger_key(row, self.destination)
+                if mark == self.watermark_micros and key in self.boundary_keys:
+                    self.skipped += 1
+                    continue
+                self.row_marks[key] = mark
+                rows.append(row)
+            if rows:
+                yield rows
+
+    def add_batch(self, batch_id, rows):
+        marks = [(self.row_marks[row_ledger_key(row, self.destination)], row) for row in rows]
+        newest = max(mark for mark, row in marks)
+        self.batch_marks[batch_id] = (
+            newest, {row_ledger_key(row, self.destination) for mark, row in marks if mark == newest})
+
+    def advance(self, published):
+        """Returns the state after the run, given the batch ids published."""
+        watermark_micros, boundary_keys = self.watermark_micros, set(self.boundary_keys)
+        for batch_id in sorted(self.batch_marks):
+            if batch_id not in published:
+                break
+            newest, keys = self.batch_marks[batch_id]
+            if watermark_micros is None or newest > watermark_micros:
+                watermark_micros, boundary_keys = newest, keys
+            elif newest == watermark_micros:
+                boundary_keys |= keys
+        return {'watermark_micros': watermark_micros, 'boundary_keys': sorted(boundary_keys)}
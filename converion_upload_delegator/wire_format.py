@@ -0,0 +1,228 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Columnar encoding of the conversion messages; copied next to the delegator
+# and both upload nodes (keep the copies identical).
+#
+# The delegator publishes it with the Pub/Sub attribute encoding=columnar,
+# messages without the attribute are the JSON of build_message. Layout:
+#   b'PBC', version (1 byte), compression (1 byte: 0 none, 1 zlib, 2 zstd)
+#   then the compressed body:
+#     header length (uint32), header JSON
+#       {"rows": n, "config": {...},
+#        "columns": [{"name": ..., "type": "i8|f8|str|json", "nulls": k,
+#                     "text_bytes": b (str/json only)}]}
+#     one block per column, in the order of the header:
+#       null bitmap (ceil(n / 8) bytes, bit set for None) when nulls > 0
+#       i8/f8: n little-endian int64/float64 values (0 for None)
+#       str/json: n + 1 uint32 character offsets, then the UTF-8 text of
+#         the values (json: the JSON of values of mixed or other types)
+#
+# A node decodes the message to {"data": {"fields": ..., "rows": ...,
+# "config": ...}}, the compact records of the JSON messages.
+
+import array
+import json
+import struct
+import sys
+import zlib
+
+MAGIC = b'PBC'
+VERSION = 1
+ENCODING_ATTRIBUTE = 'encoding'
+COLUMNAR = 'columnar'
+COMPRESSIONS = {'none': 0, 'zlib': 1, 'zstd': 2}
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+HEADER_LENGTH = struct.Struct('<I')
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def zstandard_module():
+    # optional dependency, only needed when zstd is used
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstd compression needs the zstandard package, '
+                         'add it to the requirements of the delegator and of the upload nodes')
+    return zstandard
+
+
+def compress(body, compression):
+    if compression == 'zlib':
+        return zlib.compress(body, ZLIB_LEVEL)
+    if compression == 'zstd':
+        return zstandard_module().ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return body
+
+
+def decompress(body, compression_code):
+    if compression_code == COMPRESSIONS['zlib']:
+        return zlib.decompress(body)
+    if compression_code == COMPRESSIONS['zstd']:
+        return zstandard_module().ZstdDecompressor().decompress(body)
+    if compression_code == COMPRESSIONS['none']:
+        return body
+    raise ValueError(f'Unknown compression {compression_code} in a columnar message')
+
+
+def column_type(values):
+    """The narrowest block type holding every non null value."""
+    types = {type(value) for value in values if value is not None}
+    if not types or types == {str}:
+        return 'str'
+    if types == {int} and all(-2 ** 63 <= value < 2 ** 63 for value in values if value is not None):
+        return 'i8'
+    if types == {float}:
+        return 'f8'
+    return 'json'
+
+
+def little_endian(values):
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_column(values, kind):
+    """The header entry and the blocks of a column."""
+    column = {'type': kind, 'nulls': 0}
+    blocks = []
+    if any(value is None for value in values):
+        bitmap = bytearray((len(values) + 7) // 8)
+        for index, value in enumerate(values):
+            if value is None:
+                bitmap[index >> 3] |= 1 << (index & 7)
+                column['nulls'] += 1
+        blocks.append(bytes(bitmap))
+    if kind in ('i8', 'f8'):
+        default = 0 if kind == 'i8' else 0.0
+        typecode = 'q' if kind == 'i8' else 'd'
+        blocks.append(little_endian(array.array(
+            typecode, [default if value is None else value for value in values])))
+    else:
+        if kind == 'json':
+            values = [None if value is None else json.dumps(value) for value in values]
+        offsets = array.array('I', [0])
+        position = 0
+        for value in values:
+            if value is not None:
+                position += len(value)
+            offsets.append(position)
+        text = ''.join(value for value in values if value is not None).encode('utf-8')
+        column['text_bytes'] = len(text)
+        blocks.append(little_endian(offsets))
+        blocks.append(text)
+    return column, blocks
+
+
+def encode_columnar(fields, rows, config=None, compression='zlib'):
+    """Encodes compact records (one list of values per row, in the order of
+    fields) as a columnar message.
+
+    Args:
+        fields(:obj:`list`): Field names.
+        rows(:obj:`list`): Lists of values, JSON serializable.
+        config(:obj:`dict`): The config of the message, if any.
+        compression(:obj:`str`): 'zlib', 'zstd' or 'none'.
+    Returns:
+      bytes: the message
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression}, expected one of {", ".join(COMPRESSIONS)}')
+    columns = list(zip(*rows)) if rows else [() for _ in fields]
+    header = {'rows': len(rows), 'config': config, 'columns': []}
+    body = []
+    for name, values in zip(fields, columns):
+        kind = column_type(values)
+        column, blocks = encode_column(values, kind)
+        header['columns'].append(dict(name=name, **column))
+        body.extend(blocks)
+    header_bytes = json.dumps(header).encode('utf-8')
+    body = HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + b''.join(body)
+    return MAGIC + bytes([VERSION, COMPRESSIONS[compression]]) + compress(body, compression)
+
+
+def read_array(body, offset, typecode, count):
+    values = array.array(typecode)
+    end = offset + values.itemsize * count
+    values.frombytes(body[offset:end])
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values, end
+
+
+def decode_column(body, offset, column, num_rows):
+    nulls = None
+    if column['nulls']:
+        end = offset + (num_rows + 7) // 8
+        bitmap = body[offset:end]
+        nulls = [index for index in range(num_rows) if bitmap[index >> 3] & (1 << (index & 7))]
+        offset = end
+    kind = column['type']
+    if kind in ('i8', 'f8'):
+        values, offset = read_array(body, offset, 'q' if kind == 'i8' else 'd', num_rows)
+        values = values.tolist()
+    elif kind in ('str', 'json'):
+        offsets, offset = read_array(body, offset, 'I', num_rows + 1)
+        text = body[offset:offset + column['text_bytes']].decode('utf-8')
+        offset += column['text_bytes']
+        values = [text[start:end] for start, end in zip(offsets, offsets[1:])]
+        if kind == 'json':
+            values = [json.loads(value) if value else None for value in values]
+    else:
+        raise ValueError(f'Unknown column type {kind} in a columnar message')
+    if nulls:
+        for index in nulls:
+            values[index] = None
+    return values, offset
+
+
+def decode_columnar(message_bytes):
+    """The {"data": {"fields", "rows", "config"}} payload of a columnar message."""
+    if message_bytes[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a columnar message')
+    version, compression_code = message_bytes[len(MAGIC)], message_bytes[len(MAGIC) + 1]
+    if version != VERSION:
+        raise ValueError(f'Columnar message version {version} is not supported, this node reads version {VERSION}')
+    body = decompress(message_bytes[len(MAGIC) + 2:], compression_code)
+    (header_length,) = HEADER_LENGTH.unpack_from(body)
+    offset = HEADER_LENGTH.size + header_length
+    header = json.loads(body[HEADER_LENGTH.size:offset].decode('utf-8'))
+    num_rows = header['rows']
+    columns = []
+    for column in header['columns']:
+        values, offset = decode_column(body, offset, column, num_rows)
+        columns.append(values)
+    data = {
+        'fields': [column['name'] for column in header['columns']],
+        'rows': list(zip(*columns)) if columns else [[] for _ in range(num_rows)],
+    }
+    if header['config']:
+        data['config'] = header['config']
+    return {'data': data}
+
+
+def decode_message(message_bytes, attributes=None):
+    """The payload of a message, columnar or JSON.
+
+    Columnar messages are recognized by their attribute, or by their magic
+    bytes when the attributes were lost (e.g. a message replayed by hand).
+    """
+    attributes = attributes or {}
+    if attributes.get(ENCODING_ATTRIBUTE) == COLUMNAR or message_bytes[:len(MAGIC)] == MAGIC:
+        return decode_columnar(message_bytes)
+    return json.loads(message_bytes.decode('ascii'))
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Precomputed SKU -> margin index, memory mapped.
+#
+# A snapshot file holds a 64 byte header, the sorted 64 bit hashes of the SKUs
+# and their float32 margins. Opening one maps the file without reading it, so
+# every process on the host shares the same pages through the page cache, and
+# lookups are a binary search (numpy.searchsorted) over the hash array.
+#
+# Snapshots live in a directory as margins-<version>.idx; CURRENT names the
+# latest one and is replaced atomically, so readers never see a partial file.
+# The version (build time plus a digest of the content) is what a run records
+# to know which margins it used.
+#
+#   python margin_index.py build --margins ../solution_test/client_profit.csv \
+#     --directory /tmp/margins
+#   python margin_index.py lookup --directory /tmp/margins GGOEGAAX0037 GGOEYHPB072210
+
+import argparse
+import datetime
+import hashlib
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'PBMARGN1'
+FORMAT_VERSION = 1
+# magic, format version, key hash scheme, number of SKUs, snapshot version
+HEADER = struct.Struct('<8sII Q 40s')
+HEADER_BYTES = 64
+HASH_BLAKE2B_64 = 1
+CURRENT_FILE = 'CURRENT'
+
+
+def sku_hashes(skus):
+    """Signed 64 bit blake2b digests of SKUs, stable across processes."""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(str(sku).encode('utf-8'), digest_size=8).digest(),
+                        'little', signed=True) for sku in skus),
+        dtype=np.int64, count=len(skus))
+
+
+def snapshot_path(directory, version):
+    return os.path.join(directory, f'margins-{version}.idx')
+
+
+def build_snapshot(skus, margins, directory):
+    """Writes a snapshot of the (sku, margin) pairs and makes it current.
+    Args:
+        skus(:obj:`list`): SKUs, duplicates keep their first margin
+        margins(:obj:`list`): margins of the SKUs
+        directory(:obj:`str`): snapshot directory, created when missing
+    Returns:
+      str: the version of the new snapshot
+    """
+    table = pd.DataFrame({'sku': pd.Series(skus, dtype=object).astype(str),
+                          'margin': np.asarray(margins, dtype=np.float32)})
+    duplicated = table['sku'].duplicated()
+    if duplicated.any():
+        print(f'Margin index: {int(duplicated.sum())} duplicated SKUs, keeping the first margin')
+        table = table[~duplicated]
+    keys = sku_hashes(table['sku'].tolist())
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = table['margin'].to_numpy()[order]
+    if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+        raise ValueError('SKU hash collision, the margin index cannot be built')
+
+    digest = hashlib.sha256(keys.tobytes() + values.tobytes()).hexdigest()[:12]
+    version = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ') + '-' + digest
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory, version)
+    with open(path + '.tmp', 'wb') as snapshot:
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, HASH_BLAKE2B_64, len(keys), version.encode('ascii'))
+        snapshot.write(header.ljust(HEADER_BYTES, b'\0'))
+        snapshot.write(keys.tobytes())
+        snapshot.write(values.tobytes())
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(path + '.tmp', path)
+    with open(os.path.join(directory, CURRENT_FILE + '.tmp'), 'w') as current:
+        current.write(version)
+    os.replace(os.path.join(directory, CURRENT_FILE + '.tmp'), os.path.join(directory, CURRENT_FILE))
+    print(f'Margin index: wrote {len(keys)} SKUs to {path}')
+    return version
+
+
+def build_from_table(margin_table, directory, sku_col='sku', profit_col='profit'):
+    """Builds a snapshot from the client margin table (CSV/Parquet export or DataFrame)."""
+    if isinstance(margin_table, str):
+        margin_table = pd.read_parquet(margin_table) if margin_table.endswith('.parquet') \
+            else pd.read_csv(margin_table, dtype={sku_col: str})
+    margin_table = margin_table.dropna(subset=[sku_col])
+    return build_snapshot(margin_table[sku_col].tolist(), margin_table[profit_col].fillna(0.0), directory)
+
+
+def current_version(directory):
+    with open(os.path.join(directory, CURRENT_FILE)) as current:
+        return current.read().strip()
+
+
+def list_versions(directory):
+    return sorted(name[len('margins-'):-len('.idx')] for name in os.listdir(directory)
+                  if name.startswith('margins-') and name.endswith('.idx'))
+
+
+class MarginIndex(object):
+    """Read-only, memory mapped view of a margin snapshot."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            header = snapshot.read(HEADER_BYTES)
+        magic, format_version, hash_scheme, count, version = HEADER.unpack_from(header)
+        if magic != MAGIC or format_version != FORMAT_VERSION or hash_scheme != HASH_BLAKE2B_64:
+            raise ValueError(f'{path} is not a margin index snapshot this version can read')
+        self.path = path
+        self.version = version.rstrip(b'\0').decode('ascii')
+        self.keys = np.memmap(path, dtype=np.int64, mode='r', offset=HEADER_BYTES, shape=(count,)) \
+            if count else np.empty(0, dtype=np.int64)
+        self.margins = np.memmap(path, dtype=np.float32, mode='r', offset=HEADER_BYTES + 8 * count,
+                                 shape=(count,)) if count else np.empty(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup_hashes(self, keys, default=np.nan):
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, max(len(self.keys) - 1, 0))
+        found = (self.keys[positions] == keys) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        return np.where(found, self.margins[positions] if len(self.keys) else default, default)
+
+    def lookup(self, skus, default=np.nan):
+        """Margins of the SKUs as float64, default for unknown SKUs."""
+        skus = pd.Series(skus, dtype=object).astype(str)
+        # hash every distinct SKU once, baskets repeat them a lot
+        codes, uniques = pd.factorize(skus)
+        margins = self.lookup_hashes(sku_hashes(uniques), default)
+        # widen through the shortest decimal repr so 0.19 comes back as the
+        # float64 0.19 of the table, not 0.1899999976, and profits round alike
+        margins = margins.astype(np.float32).astype(str).astype(np.float64)
+        return margins[codes]
+
+
+def open_snapshot(directory, version=None):
+    """Opens a snapshot of the directory, the current one by default."""
+    return MarginIndex(snapshot_path(directory, version or current_version(directory)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SKU margin index')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build')
+    build.add_argument('--margins', required=True, help='CSV or Parquet export of the margin table')
+    build.add_argument('--directory', required=True)
+    build.add_argument('--sku-col', default='sku')
+    build.add_argument('--profit-col', default='profit')
+    lookup = commands.add_parser('lookup')
+    lookup.add_argument('--directory', required=True)
+    lookup.add_argument('--version')
+    lookup.add_argument('skus', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        print(build_from_table(args.margins, args.directory, args.sku_col, args.profit_col))
+    else:
+        index = open_snapshot(args.directory, args.version)
+        print(f'Snapshot {index.version}, {len(index)} SKUs')
+        for sku, margin in zip(args.skus, index.lookup(args.skus)):
+            print(f'{sku}\t{margin}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local, vectorized equivalent of sql_query/profit_gen_query_template.sql.
+#
+# Reads the SA360 conversion and campaign tables and the client margin table
+# from CSV or Parquet and produces the same columns and values as the query,
+# for on-prem precompute and for regression tests of the SQL. Every step of
+# the query maps to pandas column operations (regex extraction, splitting,
+# explode, merge, group-by); no row is processed in a Python loop.
+#
+#   python profit_gen.py \
+#     --conversions ../solution_test/p_Conversion_43939335402485897.csv \
+#     --conversions-schema ../solution_test/p_Conversion_schema.json \
+#     --campaigns ../solution_test/p_Campaign_43939335402485897.csv \
+#     --campaigns-schema ../solution_test/p_Campaign_schema.json \
+#     --margins ../solution_test/client_profit.csv \
+#     --output /tmp/conversion_final.csv
+#
+# Not reproduced: the _PARTITIONTIME filters (files carry no partitions) and
+# the --<test> conversionDate filter, which is disabled in the template too.
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from margin_index import MarginIndex
+from margin_index import open_snapshot
+
+# same values install.sh substitutes into the query template
+DEFAULT_PARAMS = {
+    'floodlight_name': 'My Sample Floodlight Activity',
+    'account_type': 'Other engines',
+    'client_profit_data_sku_col': 'sku',
+    'client_profit_data_profit_col': 'profit',
+    'target_floodlight_name': 'My Sample Floodlight Activity',
+    'product_sku_var': 'u9',
+    'product_quantity_var': 'u10',
+    'product_unit_price_var': 'u11',
+    'product_sku_regex': '(.*?);',
+    'product_quantity_regex': '(.*?);',
+    'product_unit_price_regex': '(.*?);',
+    'product_sku_delim': '|',
+    'product_quantity_delim': '|',
+    'product_unit_price_delim': '|',
+}
+
+# columns of the final SELECT, in order
+OUTPUT_COLUMNS = [
+    'account', 'accountId', 'accountType', 'advertiser', 'advertiserId',
+    'agency', 'agencyId', 'campaignId', 'campaign', 'conversionId',
+    'conversionAttributionType', 'conversionDate', 'conversionTimestamp',
+    'conversionTimestampMillis', 'conversionTimestampMicros',
+    'conversionRevenue', 'conversionQuantity', 'floodlightActivity',
+    'conversionSearchTerm', 'conversionType', 'conversionVisitExternalClickId',
+    'conversionVisitId', 'conversionVisitTimestamp', 'deviceSegment',
+    'CALCULATED_PROFIT', 'CALCULATED_REVENUE', 'originalConversionRevenue',
+    'originalFloodlightActivity', 'originalFloodlightActivityId',
+    'originalFloodlightActivityTag', 'originalFloodlightRevenue',
+    'floodlightEventRequestString', 'floodlightOrderId',
+]
+
+# non aggregated columns of all_conversions (its GROUP BY), taken from the
+# conversion side of the join
+CONVERSION_GROUP_COLUMNS = [
+    'account', 'accountId', 'accountType', 'advertiser', 'agency', 'agencyId',
+    'campaign', 'conversionAttributionType', 'conversionDate',
+    'conversionLastModifiedTimestamp', 'conversionQuantity',
+    'conversionRevenue', 'conversionSearchTerm', 'conversionTimestamp',
+    'conversionType', 'conversionVisitExternalClickId', 'conversionVisitId',
+    'conversionVisitTimestamp', 'deviceSegment', 'floodlightActivity',
+    'floodlightActivityId', 'floodlightActivityTag',
+    'floodlightEventRequestString', 'floodlightOrderId',
+    'floodlightOriginalRevenue', 'status',
+]
+JOIN_KEYS = ['advertiserId', 'campaignId', 'conversionId']
+
+
+def bq_round(values, digits=0):
+    """ROUND of BigQuery: halfway cases away from zero."""
+    scale = 10.0 ** digits
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
+
+
+def apply_schema(frame, schema):
+    """Casts CSV columns to the types of a BigQuery JSON schema."""
+    for field in schema:
+        name, field_type = field['name'], field['type']
+        if name not in frame:
+            continue
+        if field_type == 'TIMESTAMP':
+            frame[name] = pd.to_datetime(
+                frame[name].str.replace(' UTC', '', regex=False), utc=True, format='ISO8601')
+        elif field_type == 'DATE':
+            frame[name] = pd.to_datetime(frame[name], format='%Y-%m-%d').dt.date
+        elif field_type in ('FLOAT', 'FLOAT64', 'NUMERIC'):
+            frame[name] = pd.to_numeric(frame[name])
+        elif field_type in ('INTEGER', 'INT64'):
+            frame[name] = pd.to_numeric(frame[name]).astype('Int64')
+        elif field_type in ('BOOLEAN', 'BOOL'):
+            frame[name] = frame[name].map({'True': True, 'False': False, 'true': True, 'false': False})
+    return frame
+
+
+def read_table(path, schema_path=None):
+    """Loads a CSV (typed with an optional BigQuery JSON schema) or Parquet file."""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if schema_path:
+        # BigQuery loads empty CSV fields as NULL, read everything as text first
+        frame = pd.read_csv(path, dtype=str)
+        with open(schema_path) as schema_file:
+            return apply_schema(frame, json.load(schema_file))
+    return pd.read_csv(path)
+
+
+def latest_campaigns(campaigns):
+    # campaigns CTE: latest version of every campaign (row_num = 1)
+    latest = campaigns.sort_values('lastModifiedTimestamp', ascending=False, kind='stable')
+    latest = latest.drop_duplicates('campaignId')
+    return latest[['campaign', 'campaignId']].drop_duplicates()
+
+
+def expand_conversions(conversions, campaigns, params):
+    # expanded_conversions CTE
+    selected = conversions[
+        (conversions['floodlightActivity'] == params['floodlight_name']) &
+        (conversions['accountType'] == params['account_type'])]
+    selected = selected.drop(columns=['campaign'], errors='ignore')
+    return selected.merge(latest_campaigns(campaigns), on='campaignId', how='left')
+
+
+def split_variable(requests, var, regex, delim, name):
+    # SPLIT(REGEXP_EXTRACT(floodlightEventRequestString, "<var>=<regex>"), "<delim>")
+    extracted = requests.str.extract(var + '=' + regex, expand=False)
+    values = extracted.dropna().str.split(delim, regex=False).explode()
+    frame = values.to_frame(name)
+    # WITH OFFSET
+    frame['pos'] = frame.groupby(level=0).cumcount()
+    return frame.set_index('pos', append=True)
+
+
+def flatten_conversions(expanded, params):
+    # flattened_conversions CTE: one row per position present in u9, u10 and
+    # u11 (pos1 = pos2 = pos3), joined on the position instead of a cross join
+    requests = expanded['floodlightEventRequestString']
+    items = split_variable(requests, params['product_sku_var'], params['product_sku_regex'],
+                           params['product_sku_delim'], 'skuId')
+    items = items.join(split_variable(requests, params['product_quantity_var'],
+                                      params['product_quantity_regex'],
+                                      params['product_quantity_delim'], 'quantity'), how='inner')
+    items = items.join(split_variable(requests, params['product_unit_price_var'],
+                                      params['product_unit_price_regex'],
+                                      params['product_unit_price_delim'], 'cost'), how='inner')
+    items = items.reset_index(level='pos')
+    items = items[items['skuId'] != '']
+    keys = expanded.loc[items.index, JOIN_KEYS]
+    flattened = pd.concat([keys, items], axis=1).reset_index(drop=True)
+    # GROUP BY 1,2,3,4,5,6,7,8,9
+    return flattened.drop_duplicates()
+
+
+def inject_margin(flattened, margins, params):
+    # inject_gmc_margin CTE
+    if isinstance(margins, MarginIndex):
+        injected = flattened.copy()
+        injected['cost'] = injected['cost'].where(injected['cost'] != '', '0')
+        injected['margin'] = margins.lookup(injected['skuId'], default=0.0)
+        return injected.drop_duplicates()
+    sku_col = params['client_profit_data_sku_col']
+    profit_col = params['client_profit_data_profit_col']
+    margin_table = margins[[sku_col, profit_col]].dropna(subset=[sku_col])
+    margin_table = margin_table.astype({sku_col: str})
+    injected = flattened.merge(margin_table, left_on='skuId', right_on=sku_col, how='left')
+    injected['cost'] = injected['cost'].where(injected['cost'] != '', '0')
+    injected['margin'] = injected[profit_col].fillna(0.0).astype(float)
+    if sku_col != 'sku':
+        injected = injected.rename(columns={sku_col: 'sku'})
+    injected = injected.drop(columns=[profit_col])
+    # GROUP BY 1..11
+    return injected.drop_duplicates()
+
+
+def aggregate_conversions(injected, expanded):
+    # all_conversions CTE; NULL keys never match in a SQL join
+    conversions = expanded[JOIN_KEYS + CONVERSION_GROUP_COLUMNS].dropna(subset=JOIN_KEYS)
+    joined = injected[JOIN_KEYS + ['cost', 'margin']].merge(conversions, on=JOIN_KEYS, how='left')
+    cost = pd.to_numeric(joined['cost']).astype(float)
+    joined['revenue_item'] = np.floor(cost)
+    joined['profit_item'] = cost * joined['margin']
+    grouped = joined.groupby(JOIN_KEYS + CONVERSION_GROUP_COLUMNS, dropna=False, sort=False)
+    result = grouped.agg(
+        CALCULATED_REVENUE=('revenue_item', 'sum'),
+        CALCULATED_PROFIT=('profit_item', 'sum')).reset_index()
+    result['CALCULATED_PROFIT'] = bq_round(result['CALCULATED_PROFIT'], 2)
+    result['conversionId'] = result['conversionId'] + '00'
+    result['conversionQuantity'] = bq_round(result['conversionQuantity']).astype('Int64')
+    # UNIX_MILLIS/UNIX_MICROS of the conversion timestamp
+    epoch = pd.Timestamp(0, tz='UTC')
+    micros = ((result['conversionTimestamp'] - epoch) // pd.Timedelta(microseconds=1)).astype('Int64')
+    result['conversionTimestampMillis'] = micros // 1000
+    result['conversionTimestampMicros'] = micros
+    return result
+
+
+def generate_profit(conversions, campaigns, margins, params=None):
+    """Runs the profit generation query on DataFrames.
+    Args:
+        conversions(:obj:`pandas.DataFrame`): p_Conversion_<advertiser_id>
+        campaigns(:obj:`pandas.DataFrame`): p_Campaign_<advertiser_id>
+        margins(:obj:`pandas.DataFrame`): client margin table, or the
+          :obj:`MarginIndex` snapshot built from it
+        params(:obj:`dict`): template placeholders, defaults to DEFAULT_PARAMS
+    Returns:
+      pandas.DataFrame: the rows and columns of the query result
+    """
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    expanded = expand_conversions(conversions, campaigns, params)
+    flattened = flatten_conversions(expanded, params)
+    injected = inject_margin(flattened, margins, params)
+    result = aggregate_conversions(injected, expanded)
+    result = result.rename(columns={
+        'conversionRevenue': 'originalConversionRevenue',
+        'floodlightActivity': 'originalFloodlightActivity',
+        'floodlightActivityId': 'originalFloodlightActivityId',
+        'floodlightActivityTag': 'originalFloodlightActivityTag',
+        'floodlightOriginalRevenue': 'originalFloodlightRevenue',
+    })
+    result['conversionRevenue'] = result['CALCULATED_PROFIT']
+    result['floodlightActivity'] = params['target_floodlight_name']
+    result = result[result['CALCULATED_PROFIT'] > 0.0]
+    result = result.sort_values('account', kind='stable', na_position='first')
+    return result[OUTPUT_COLUMNS].reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local profit generation')
+    parser.add_argument('--conversions', required=True)
+    parser.add_argument('--conversions-schema')
+    parser.add_argument('--campaigns', required=True)
+    parser.add_argument('--campaigns-schema')
+    parser.add_argument('--margins', help='CSV or Parquet export of the margin table')
+    parser.add_argument('--margin-index', help='margin_index.py snapshot directory, instead of --margins')
+    parser.add_argument('--params', help='JSON file overriding DEFAULT_PARAMS')
+    parser.add_argument('--output', required=True, help='.csv or .parquet')
+    args = parser.parse_args()
+
+    if bool(args.margins) == bool(args.margin_index):
+        parser.error('one of --margins or --margin-index is required')
+    params = None
+    if args.params:
+        with open(args.params) as params_file:
+            params = json.load(params_file)
+    if args.margin_index:
+        margins = open_snapshot(args.margin_index)
+        print(f'Using margin snapshot {margins.version}')
+    else:
+        margins = read_table(args.margins)
+    result = generate_profit(
+        read_table(args.conversions, args.conversions_schema),
+        read_table(args.campaigns, args.campaigns_schema),
+        margins,
+        params)
+    if args.output.endswith('.parquet'):
+        result.to_parquet(args.output, index=False)
+    else:
+        result.to_csv(args.output, index=False)
+    print(f'{len(result)} conversions written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
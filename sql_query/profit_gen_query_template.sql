@@ -85,24 +85,26 @@ campaigns AS (
 )
 ,flattened_conversions AS (
     -- Flattens the extracted product data for each conversion which leaves us with a row
-    -- of data for each product purchased as part of a given conversion
-    SELECT
+    -- of data for each product purchased as part of a given conversion.
+    -- The three arrays are zipped with a single UNNEST over the positions they all have,
+    -- one row per product instead of one per combination of positions.
+    SELECT DISTINCT
+        -- duplicated conversions flatten to the same rows
         advertiserId,
         campaignId,
         conversionId,
-        skuId,
-        pos1,
-        quantity,
-        pos2,
-        cost,
-        pos3
+        expanded_conversions.u9[OFFSET(pos)] AS skuId,
+        pos AS pos1,
+        expanded_conversions.u10[OFFSET(pos)] AS quantity,
+        pos AS pos2,
+        expanded_conversions.u11[OFFSET(pos)] AS cost,
+        pos AS pos3
     FROM expanded_conversions,
-    UNNEST(expanded_conversions.u9) AS skuId WITH OFFSET pos1,
-    UNNEST(expanded_conversions.u10) AS quantity WITH OFFSET pos2,
-    UNNEST(expanded_conversions.u11) AS cost WITH OFFSET pos3
-    WHERE pos1 = pos2 AND pos1 = pos3 AND skuId != ''
-    GROUP BY 1,2,3,4,5,6,7,8,9
-    ORDER BY conversionId
+    UNNEST(GENERATE_ARRAY(0, LEAST(
+        ARRAY_LENGTH(expanded_conversions.u9),
+        ARRAY_LENGTH(expanded_conversions.u10),
+        ARRAY_LENGTH(expanded_conversions.u11)) - 1)) AS pos
+    WHERE expanded_conversions.u9[OFFSET(pos)] != ''
 )
 --<test> ,gmc AS (
 --<test>     -- Extract all relevant fields from GMC product feed to help identify what margin value